@@ -41,7 +41,7 @@ def loc(activate=True, py=None, ref=None, invenio='master', **kwargs):
     env = env_create('loc', name=env_make_name('inspireinvenio', py or '', ref or ''),
                      activate=activate, python=py, **kwargs)
 
-    # Do not use git-new-workdir
+    # Do not use git worktrees
     env.WITH_WORKDIR = False
     env.CFG_SRCWORKDIR = env.CFG_SRCDIR
 
@@ -29,11 +29,11 @@ from inveniofab.apache import apache_start, apache_restart, apache_stop, \
 from inveniofab.env import env_defaults, env_get, env_create, env_override, \
     env_make_name
 from inveniofab.git import repo_update, repo_setup, repo_prepare, \
-    repo_install, repo_make, repo_configure, repo_check
+    repo_install, repo_make, repo_configure, repo_check, repo_worktrees
 from inveniofab.invenio import invenio_conf, invenio_create_demosite, \
     invenio_createdb, invenio_upgrade
 from inveniofab.mysql import mysql_dropdb, mysql_createdb, mysql_load, \
-    mysql_dump, mysql_copy, mysql_conf
+    mysql_dump, mysql_copy, mysql_conf, mysql_verify
 from inveniofab.test import test_load, test_dump, test_clean, test_reset_admin
 from inveniofab.venv import venv_create, venv_dump, venv_load, venv_drop, \
     venv_requirements, venv_pyuno_install, venv_libxslt_install
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 CERN.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""
+Content-defined chunking of table dumps for the dump repository (see
+:meth:`inveniofab.mysql.mysql_dump_repository`).
+
+The script is copied into the repository and run on the host taking the
+dump, so it only depends on the standard library. It reads the output of
+``mysqldump --skip-extended-insert`` (one row per line) for a table and
+splits it into chunks at row boundaries chosen from the content of the
+rows, so inserting or deleting rows only changes the chunks around them.
+Each chunk is stored compressed under ``<chunkdir>/<xx>/<sha1><ext>``
+unless a chunk with the same content already exists. Consecutive rows of a
+chunk are joined into extended ``INSERT`` statements, so chunks load as
+fast as a normal dump.
+
+Usage::
+
+  mysqldump ... | python chunker.py <chunkdir> <ext> <compress> <listfile>
+
+The relative paths of the chunks are written to ``listfile`` and a summary
+line ``CHUNKED <chunks> <new chunks> <bytes> <new bytes>`` to stdout.
+"""
+
+import hashlib
+import os
+import subprocess
+import sys
+import zlib
+
+AVG_SIZE = 1024 * 1024
+MIN_SIZE = AVG_SIZE // 4
+MAX_SIZE = AVG_SIZE * 8
+BATCH_SIZE = 1024 * 1024
+
+
+def rebatch(lines):
+    """
+    Join consecutive single row ``INSERT`` statements into extended inserts
+    of at most ``BATCH_SIZE`` bytes.
+    """
+    out = []
+    prefix = None
+    values = []
+    size = 0
+
+    for line in lines:
+        head, sep, tail = line.partition(b' VALUES ')
+        if sep and line.startswith(b'INSERT INTO ') and line.endswith(b');\n'):
+            if values and (head != prefix or size > BATCH_SIZE):
+                out.append(prefix + sep + b','.join(values) + b';\n')
+                values, size = [], 0
+            prefix = head
+            values.append(tail[:-2])
+            size += len(tail)
+        else:
+            if values:
+                out.append(prefix + b' VALUES ' + b','.join(values) + b';\n')
+                values, size = [], 0
+            out.append(line)
+
+    if values:
+        out.append(prefix + b' VALUES ' + b','.join(values) + b';\n')
+    return out
+
+
+def store(lines, chunkdir, ext, compress):
+    """ Store a chunk, return its relative path and whether it is new """
+    data = b''.join(rebatch(lines))
+    digest = hashlib.sha1(data).hexdigest()
+    relpath = "%s/%s%s" % (digest[:2], digest, ext)
+    path = os.path.join(chunkdir, relpath)
+    if os.path.exists(path):
+        return (relpath, len(data), False)
+
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by a concurrent worker
+            pass
+
+    # Write to a temporary file first, so concurrent workers storing the
+    # same chunk never see a partial file.
+    tmppath = "%s.%s.tmp" % (path, os.getpid())
+    out = open(tmppath, 'wb')
+    proc = subprocess.Popen(compress, shell=True, stdin=subprocess.PIPE,
+                            stdout=out)
+    proc.communicate(data)
+    out.close()
+    if proc.returncode != 0:
+        os.unlink(tmppath)
+        raise IOError("Compression of chunk %s failed" % digest)
+    os.rename(tmppath, path)
+    return (relpath, len(data), True)
+
+
+def main(chunkdir, ext, compress, listfile):
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    chunklist = open(listfile, 'w')
+    stats = [0, 0, 0, 0]
+
+    def _flush(lines):
+        relpath, size, new = store(lines, chunkdir, ext, compress)
+        chunklist.write(relpath + "\n")
+        stats[0] += 1
+        stats[2] += size
+        if new:
+            stats[1] += 1
+            stats[3] += size
+
+    lines = []
+    size = 0
+    for line in iter(stdin.readline, b''):
+        lines.append(line)
+        size += len(line)
+        # A boundary after a line is chosen with a probability proportional
+        # to its length, so chunks are AVG_SIZE bytes on average.
+        if size >= MAX_SIZE or (size >= MIN_SIZE and
+                (zlib.crc32(line) & 0xffffffff) % AVG_SIZE < len(line)):
+            _flush(lines)
+            lines, size = [], 0
+    if lines:
+        _flush(lines)
+
+    chunklist.close()
+    sys.stdout.write("CHUNKED %s %s %s %s\n" % tuple(stats))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        sys.stderr.write("Usage: %s <chunkdir> <ext> <compress> <listfile>\n" % sys.argv[0])
+        sys.exit(2)
+    main(*sys.argv[1:])
@@ -104,14 +104,20 @@ def install(quite=False, **kwargs):
 
 @task
 @roles('web')
-def dump():
+def dump(parallel=False, repository=False):
     """
     Archive installation
 
     Dump a database and virtual environment to an archive which can later be
     restored with :meth:`~load`.
+
+    :param parallel: Default ``False``. Set to ``True`` to dump the database
+        tables in parallel into a dump directory (see
+        :meth:`inveniofab.mysql.mysql_dump`).
+    :param repository: Default ``False``. Set to ``True`` to add a snapshot
+        of the database to the dump repository instead.
     """
-    mysql_dump()
+    mysql_dump(parallel=parallel, repository=repository)
     venv_dump()
 
 
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 CERN.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""
+Consistent parallel table dumps for dump directories and dump repositories
+(see :meth:`inveniofab.mysql.mysql_dump_dir` and
+:meth:`inveniofab.mysql.mysql_dump_repository`).
+
+The script is copied to and run on the host taking the dump, so it only
+depends on the standard library. A ``mysql`` client takes a global read
+lock and reads the binary log position, then one ``mysqldump
+--single-transaction`` process is started per group of tables. The lock is
+released as soon as every mysqldump has started its transaction (i.e. the
+first table shows up in its output), so all tables are dumped as of the
+recorded binary log position, while writes are only blocked for the time
+it takes to start the workers. A transaction is no snapshot of
+non-transactional (e.g. MyISAM) tables, so with ``hold`` the lock is kept
+until all workers are done instead.
+
+The output of each mysqldump is split by table (at the ``LOCK TABLES``
+statements written by ``--add-locks``) and each table is piped with the
+header of the dump into the shell command ``sink``, which is called with the
+table name as ``$1``, e.g. to compress it into a file. The rows of each
+table are counted from its ``INSERT`` statements on the way, so the counts
+match the dumped data.
+
+Usage::
+
+  python dumper.py <config>
+  mysqldump ... | python dumper.py --count <result> | gzip > dump.sql.gz
+
+The configuration is a JSON file with the keys:
+
+ * ``mysql`` - command line of the ``mysql`` client taking the lock, or
+   ``null`` to dump without lock and binary log position.
+ * ``mysqldump`` - command line of ``mysqldump``, without the table names.
+ * ``hold`` - keep the lock until all tables are dumped.
+ * ``groups`` - list of the lists of tables dumped by each worker.
+ * ``sink`` - shell command writing a table, run in the directory ``dir``.
+   Its output is collected, so it must be short.
+ * ``result`` - file to write the result to, as a JSON object with the
+   binary log position (``binlog``) and the row count (``rows``) and
+   output of the sink (``output``) of each table (``tables``).
+
+The name of each finished table is written to stdout, for progress meters.
+The passwords of both clients are read from ``MYSQL_PWD``.
+
+With ``--count``, a dump is copied from stdin to stdout instead, and the row
+count of each table is written to ``result``.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+LOCK_SQL = "FLUSH LOCAL TABLES; FLUSH TABLES WITH READ LOCK; SHOW MASTER STATUS;"
+LOCK = b'LOCK TABLES `'
+UNLOCK = b'UNLOCK TABLES;'
+DATA_COMMENT = b'-- Dumping data for table'
+INSERT = b'INSERT INTO '
+STRING = re.compile(br"'(?:[^'\\]|\\.)*'", re.S)
+
+
+def warn(message):
+    sys.stderr.write("Warning: %s\n" % message)
+    sys.stderr.flush()
+
+
+def count_rows(line):
+    """ Number of rows of an (extended) ``INSERT`` statement """
+    return STRING.sub(b"''", line).count(b"),(") + 1
+
+
+#
+# Coordinator
+#
+
+def session_send(client, sql):
+    """
+    Send statements to a ``mysql`` client, return result rows and errors
+    """
+    marker = "-- dumper %s" % os.getpid()
+    try:
+        client.stdin.write(("%s\nSELECT '%s';\n" % (sql, marker)).encode('utf-8'))
+        client.stdin.flush()
+    except IOError:
+        # Client exited, its error message is read below.
+        pass
+
+    rows, errors = [], []
+    while True:
+        line = client.stdout.readline().decode('utf-8')
+        if not line:
+            errors.append("Lost connection to MySQL server")
+            break
+        line = line.rstrip("\r\n")
+        if line == marker:
+            break
+        if line.startswith("ERROR"):
+            errors.append(line)
+        elif line.strip():
+            rows.append(line.split("\t"))
+    return rows, errors
+
+
+def lock(config):
+    """
+    Take the global read lock and read the binary log position
+
+    :return: Tuple ``(client, binlog)``, with ``client`` set to ``None`` if
+        the lock could not be taken.
+    """
+    client = subprocess.Popen(
+        config['mysql'] + ['-N', '-B', '--unbuffered', '--force'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    rows, errors = session_send(client, LOCK_SQL)
+    if errors:
+        warn("Cannot lock tables, the workers do not share a snapshot and "
+             "the binary log position is not recorded (%s)" % errors[0])
+        unlock(client)
+        return None, None
+    if not rows:
+        return client, None
+    return client, {'file': rows[0][0], 'position': int(rows[0][1])}
+
+
+def unlock(client):
+    """ Release the global read lock by closing the client """
+    if client and client.poll() is None:
+        client.stdin.close()
+        client.wait()
+
+
+def read_worker(index, worker, queue):
+    """ Forward the output lines of a worker to the queue """
+    for line in iter(worker.stdout.readline, b''):
+        queue.put((index, line.decode('utf-8').rstrip("\n")))
+    queue.put((index, None))
+
+
+def coordinate(path):
+    config = json.load(open(path))
+    client, binlog = None, None
+    if config.get('mysql'):
+        client, binlog = lock(config)
+
+    queue = Queue()
+    workers = []
+    try:
+        for index in range(len(config['groups'])):
+            worker = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--worker', path,
+                 str(index)], stdout=subprocess.PIPE)
+            workers.append(worker)
+            thread = threading.Thread(target=read_worker,
+                                      args=(index, worker, queue))
+            thread.daemon = True
+            thread.start()
+
+        started = set()
+        finished = 0
+        tables = {}
+        while finished < len(workers):
+            try:
+                index, line = queue.get(True, 1)
+            except Empty:
+                continue
+            if line is None:
+                finished += 1
+                started.add(index)
+            elif line == 'STARTED':
+                started.add(index)
+            elif line.startswith('TABLE\t'):
+                name, rows, output = line.split("\t", 3)[1:]
+                tables[name] = {'rows': int(rows), 'output': output}
+                sys.stdout.write("%s\n" % name)
+                sys.stdout.flush()
+            if client and len(started) == len(workers) and not config.get('hold'):
+                unlock(client)
+                client = None
+    finally:
+        unlock(client)
+
+    failed = [w for w in workers if w.wait() != 0]
+    out = open(config['result'], 'w')
+    json.dump({'binlog': binlog, 'tables': tables}, out)
+    out.close()
+    return 1 if failed else 0
+
+
+#
+# Worker
+#
+
+class Sink(object):
+    """ Sink command writing the data of one table """
+
+    def __init__(self, config, name):
+        self.name = name
+        self.rows = 0
+        self.process = subprocess.Popen(
+            ['bash', '-o', 'pipefail', '-c', config['sink'], '_', name],
+            cwd=config['dir'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            bufsize=65536)
+
+    def write(self, lines):
+        for line in lines:
+            self.process.stdin.write(line)
+
+    def close(self):
+        self.process.stdin.close()
+        output = self.process.stdout.read().decode('utf-8')
+        if self.process.wait() != 0:
+            raise IOError("Sink of table %s failed" % self.name)
+        sys.stdout.write("TABLE\t%s\t%s\t%s\n" % (
+            self.name, self.rows, " ".join(output.split())))
+        sys.stdout.flush()
+
+
+def table_name(line):
+    """ Table name of a ``LOCK TABLES `name` WRITE;`` statement """
+    name = line[len(LOCK):line.rindex(b'`')]
+    return name.replace(b'``', b'`').decode('utf-8')
+
+
+def split_header(lines):
+    """
+    Split the lines before the first table into the header of the dump and
+    the comment introducing the table
+    """
+    for i, line in enumerate(lines):
+        if line.startswith(DATA_COMMENT):
+            if i > 0 and lines[i - 1].strip() == b'--':
+                i -= 1
+            return lines[:i], lines[i:]
+    return lines, []
+
+
+def work(path, index):
+    config = json.load(open(path))
+    tables = config['groups'][index]
+    dump = subprocess.Popen(config['mysqldump'] + tables,
+                            stdout=subprocess.PIPE)
+
+    header = None
+    pending = []
+    sink = None
+    in_table = False
+    dumped = set()
+
+    def _started():
+        sys.stdout.write("STARTED\n")
+        sys.stdout.flush()
+
+    try:
+        for line in iter(dump.stdout.readline, b''):
+            if in_table:
+                sink.write([line])
+                if line.startswith(INSERT):
+                    sink.rows += count_rows(line)
+                elif line.startswith(UNLOCK):
+                    in_table = False
+            elif line.startswith(LOCK):
+                if header is None:
+                    header, pending = split_header(pending)
+                    _started()
+                if sink:
+                    # The footer of the dump is only known at the end, the
+                    # end of each table is marked like a complete dump.
+                    if header and header[0].startswith(b'-- '):
+                        sink.write([time.strftime(
+                            "-- Dump completed on %Y-%m-%d %H:%M:%S\n").encode('utf-8')])
+                    sink.close()
+                sink = Sink(config, table_name(line))
+                dumped.add(sink.name)
+                sink.write(header + pending + [line])
+                pending = []
+                in_table = True
+            else:
+                pending.append(line)
+
+        if dump.wait() != 0:
+            raise IOError("mysqldump exited with status %s" % dump.returncode)
+        if header is None:
+            header, pending = pending, []
+            _started()
+        if sink:
+            sink.write(pending)
+            sink.close()
+        # Views have no data section, but still get a (empty) file.
+        for name in tables:
+            if name not in dumped:
+                sink = Sink(config, name)
+                sink.write(header + pending)
+                sink.close()
+    except (IOError, OSError):
+        e = sys.exc_info()[1]
+        sys.stderr.write("Error dumping %s: %s\n" % (", ".join(tables), e))
+        if dump.poll() is None:
+            dump.kill()
+        return 1
+    return 0
+
+
+#
+# Row counts of a single stream
+#
+
+def count(result):
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    rows = {}
+    name = None
+    for line in iter(stdin.readline, b''):
+        stdout.write(line)
+        if line.startswith(INSERT) and name is not None:
+            rows[name] += count_rows(line)
+        elif line.startswith(LOCK):
+            name = table_name(line)
+            rows.setdefault(name, 0)
+    stdout.flush()
+
+    out = open(result, 'w')
+    json.dump(rows, out)
+    out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--worker':
+        sys.exit(work(sys.argv[2], int(sys.argv[3])))
+    if len(sys.argv) == 3 and sys.argv[1] == '--count':
+        sys.exit(count(sys.argv[2]))
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s <config>\n" % sys.argv[0])
+        sys.exit(2)
+    sys.exit(coordinate(sys.argv[1]))
@@ -207,10 +207,12 @@ GLOBAL_REFS_OVERRIDE = {
         'origin/v0.99.0': {
             'bootstrap_targets': ['all', 'install'],
             'deploy_targets': ['all', 'install'],
+            'serial_targets': ['all', 'install'],
         },
         'origin/v0.99.5': {
             'bootstrap_targets': ['all', 'install'],
             'deploy_targets': ['all', 'install'],
+            'serial_targets': ['all', 'install'],
         },
     },
 }
@@ -339,11 +341,29 @@ def env_defaults(env, name='invenio', prefix=None, python=None, **kwargs):
         'PYTHON': pythonbin,
         'ACTIVATE': '. %(CFG_INVENIO_PREFIX)s/bin/activate',
         'CFG_INVENIO_REPOS': [],
+        # Concurrent git processes for repo_update:parallel=1
+        'CFG_GIT_WORKERS': 4,
+        # Jobs for make (None means number of cores)
+        'CFG_MAKE_JOBS': None,
+        # Cache of installed files shared by environments (None to disable)
+        # and its maximum size in MB
+        'CFG_BUILD_CACHE_DIR': os.environ.get('CFG_BUILD_CACHE_DIR', None),
+        'CFG_BUILD_CACHE_SIZE': 4096,
+        # Wheelhouse on the hosts (None to install from the index) and its
+        # copy on the machine running fab, shared by all hosts
+        'CFG_WHEELHOUSE_DIR': os.environ.get('CFG_WHEELHOUSE_DIR', None),
+        'CFG_WHEELHOUSE_CACHE': '~/.inveniofab/wheelhouse',
+        # Directory of bare mirrors shared by all environments on a host
+        'CFG_GIT_MIRROR_DIR': os.environ.get('CFG_GIT_MIRROR_DIR', None),
+        # 'direct' or 'bundle' (fetch on the fab machine, send git bundles)
+        'CFG_GIT_TRANSPORT': 'direct',
+        'CFG_GIT_BUNDLE_DIR': '~/.inveniofab/mirrors',
         'CFG_INVENIO_CONF': 'etc/invenio-local.conf',
         'CFG_INVENIO_PREFIX': prefix,
         'CFG_INVENIO_SRCDIR': os.path.join(prefix, 'src/invenio'),
         'CFG_SRCDIR': os.environ.get('CFG_SRCDIR', os.path.join(prefix, 'src')),
-        # Only use CFG_SRCWORKDIR if WITH_WORKDIR is True
+        # Only use CFG_SRCWORKDIR if WITH_WORKDIR is True. Work directories
+        # are git worktrees sharing the objects of the clones in CFG_SRCDIR.
         'CFG_SRCWORKDIR': os.path.join(prefix, 'src'),
         'CFG_INVENIO_HOSTNAME': "localhost",
         'CFG_INVENIO_DOMAINNAME': "",
@@ -363,6 +383,37 @@ def env_defaults(env, name='invenio', prefix=None, python=None, **kwargs):
         'CFG_DATABASE_USER': name,
         'CFG_DATABASE_PASS': 'qwerty',
         'CFG_DATABASE_DROP_ALLOWED': True,
+        'CFG_DATABASE_DUMP_WORKERS': 4,
+        'CFG_DATABASE_LOAD_WORKERS': 4,
+        'CFG_DATABASE_COPY_LIMIT': None,
+        'CFG_DATABASE_COPY_CHECKPOINTDIR': None,
+        # Dumps and copies are read from a db-slave host if its replication
+        # lag is below the limit (in seconds).
+        'CFG_DATABASE_SLAVE_PORT': None,
+        'CFG_DATABASE_MAX_SLAVE_LAG': 60,
+        # Glob patterns of tables to dump/copy without data
+        'CFG_DATABASE_DUMP_INCLUDE': [],
+        'CFG_DATABASE_DUMP_EXCLUDE': [],
+        'CFG_DATABASE_DUMP_SCHEMA_ONLY': [],
+        # Days to keep snapshots in the dump repository
+        'CFG_DATABASE_DUMP_RETENTION': 7,
+        # File to append a JSON summary of each dump, load and copy to
+        # (default mysql-stats.json in CFG_DATABASE_DUMPDIR)
+        'CFG_DATABASE_STATS_FILE': None,
+        # Workload profiles (see inveniofab.mysql.MYSQL_PROFILES) used to
+        # compute my.cnf settings, and optionally switched to during
+        # mysql_load (e.g. 'bulk-load', which changes global variables of
+        # the server for the duration of the load).
+        'CFG_DATABASE_DATADIR': '/var/lib/mysql',
+        'CFG_DATABASE_PROFILE': 'invenio',
+        'CFG_DATABASE_LOAD_PROFILE': None,
+        'CFG_DATABASE_TUNING': {},
+
+        # Compression of database dumps and virtualenv archives (gzip, pigz,
+        # zstd or lz4). Threads set to 0 means all cores.
+        'CFG_DUMP_CODEC': 'gzip',
+        'CFG_DUMP_CODEC_LEVEL': None,
+        'CFG_DUMP_CODEC_THREADS': 0,
 
         # FIXME: Set to localhost or leave empty?
         'CFG_MISCUTIL_SMTP_HOST': '127.0.0.1',
@@ -392,6 +443,11 @@ def env_defaults(env, name='invenio', prefix=None, python=None, **kwargs):
             'requirements': ['requirements.txt', 'requirements-extra.txt', ],
             #'configure_hook': None, # Can be specified if you want to override default behaviour (./configure --with-prefix=.. --with-python=..)
             #'prepare_hook': None, # Can be specified if you want to override default behaviour  (aclocal && autoconf && automake)
+            #'parallel_targets': [], # Make targets which can be run with -j (besides git.PARALLEL_SAFE_TARGETS)
+            #'serial_targets': [], # Make targets which must not be run with -j
+            #'transport': 'bundle', # Send history from the machine running fab
+            #'depth': 1, # Shallow clone with history truncated to the given number of commits
+            #'filter': 'blob:none', # Partial clone, file contents are fetched on demand
         }),
     ]
 
@@ -20,11 +20,54 @@ Task for checking out source code from a repository, and running configure,
 make on it.
 """
 
-from fabric.api import task, puts, env, settings, abort, hide, roles
+from fabric.api import task, puts, env, settings, abort, hide, roles, \
+    local, put, warn
 from fabric.contrib.console import confirm
 from fabric.colors import cyan, red
-from inveniofab.utils import exists_local, sudo_local
+from inveniofab.utils import exists_local, sudo_local, read_file, write_file, \
+    python_version, is_local
+from pipes import quote
+import hashlib
+import json
 import os
+import re
+import tempfile
+import time
+
+GIT_DEEPEN_STEP = 100
+""" Commits fetched at a time when deepening a shallow clone """
+
+PARALLEL_SAFE_TARGETS = ['install-mathjax-plugin', 'install-ckeditor-plugin',
+    'install-pdfa-helper-files', 'install-jquery-plugins',
+    'install-jquery-tokeninput', 'install-plupload-plugin',
+    'install-js-test-driver', 'install-mediaelement', 'install-bootstrap', ]
+"""
+Make targets which are independent of each other (mostly downloading and
+unpacking of external plugins), so consecutive ones are run by a single
+parallel make. All other targets are run with ``-j1``, unless listed in a
+repository's ``parallel_targets``. Targets listed in a repository's
+``serial_targets`` (e.g. set via :data:`inveniofab.env.GLOBAL_REFS_OVERRIDE`)
+are always run with ``-j1``.
+"""
+
+BUILD_CACHE_DIRS = ['bin', 'etc', 'include', 'lib', 'share', 'var/www']
+"""
+Directories of the installation prefix from which files installed by a
+build are stored in the build cache. The rest of ``var/`` (data, logs,
+run and cache files) is runtime state, not build output.
+"""
+
+BUILD_STATE_ENV = ['CFG_INVENIO_PREFIX', 'CFG_INVENIO_USER', 'PYTHON']
+"""
+Environment values recorded in the build state of a repository (see
+:meth:`~repo_build_state`). A change in any of them configures the
+repository again.
+"""
+
+BUILD_STATE_FILES = ['configure']
+"""
+Files whose checksums are recorded as configure inputs in the build state.
+"""
 
 
 #
@@ -39,6 +82,7 @@ def repo_configure(repo):
     puts(cyan(">>> Configuring repository: %s ..." % repo))
 
     ctx = {
+        'repo': repo,
         'topsrcdir': topsrcdir,
     }
     ctx.update(env)
@@ -49,31 +93,68 @@ def repo_configure(repo):
 @task
 @roles('web')
 def repo_make(repo, *targets):
-    """ Run make in repository """
+    """
+    Run make in repository
+
+    Targets from :data:`PARALLEL_SAFE_TARGETS` and the repository's
+    ``parallel_targets`` run with ``env.CFG_MAKE_JOBS`` jobs (default number
+    of cores on the host), consecutive ones together by one make. All other
+    targets run with ``-j1``, as not all Makefiles support parallel builds.
+    """
     topsrcdir = repo_check(repo, workdir=True)
+    info = dict(env.CFG_INVENIO_REPOS)[repo]
 
     if not targets:
         try:
-            targets = dict(env.CFG_INVENIO_REPOS)[repo]['targets']
+            targets = info['targets']
         except KeyError:
             abort(red("No default targets found for repository %s" % repo))
 
-    puts(cyan(">>> Running make for %s targets: %s ..." % (repo, " ".join(targets))))
+    jobs = repo_make_jobs()
+    serial = info.get('serial_targets', [])
+    parallel = PARALLEL_SAFE_TARGETS + info.get('parallel_targets', [])
 
-    ctx = {
-        'topsrcdir': topsrcdir,
-        'targets': " ".join(targets),
-    }
-    ctx.update(env)
+    # Group consecutive parallel safe targets
+    batches = []
+    for t in targets:
+        safe = t in parallel and t not in serial
+        if safe and batches and batches[-1][0]:
+            batches[-1][1].append(t)
+        else:
+            batches.append((safe, [t]))
 
-    sudo_local("cd %(topsrcdir)s && make %(targets)s" % ctx, user=env.CFG_INVENIO_USER)
+    puts(cyan(">>> Running make for %s targets: %s (up to %s jobs) ..." % (repo, " ".join(targets), jobs)))
+
+    for safe, batch in batches:
+        ctx = {
+            'topsrcdir': topsrcdir,
+            'targets': " ".join(batch),
+            'jobs': jobs if safe else 1,
+        }
+        ctx.update(env)
+
+        sudo_local("cd %(topsrcdir)s && make -j%(jobs)s %(targets)s" % ctx, user=env.CFG_INVENIO_USER)
 
 
 @task
 @roles('web')
-def repo_install(repo=None, targets_key='install_targets'):
-    """ Run configure and make """
-    repo_all_configure_make(repo, targets_key)
+def repo_install(repo=None, targets_key='install_targets', force=False):
+    """
+    Run configure and make
+
+    The commit, configure inputs and environment values each repository was
+    built with are recorded in a build state file in
+    ``<CFG_INVENIO_PREFIX>/var/inveniofab/``. A repository whose commit and
+    targets are unchanged since the last successful install is skipped, and
+    configure (with its ``make clean``) is skipped when its inputs are
+    unchanged. Set ``force`` to configure and make all repositories.
+
+    If ``env.CFG_BUILD_CACHE_DIR`` is set, the files installed into the
+    prefix by make are stored there, keyed by commit, Python version,
+    targets and configure inputs (see :meth:`~repo_cache_key`), and restored
+    instead of building when the key matches.
+    """
+    repo_all_configure_make(repo, targets_key, force=force)
 
 
 @task
@@ -117,13 +198,33 @@ def repo_setup(repo, ref):
     if not exists_local(workdir):
         git_newworkdir(repo)
     git_checkout(repo, ref)
+    # The prepare hook runs git-version-gen, which needs a tag in the history
+    if git_shallow_options(repo):
+        git_deepen_to_tag(repo)
     repo_prepare(repo)
 
 
 @task
 @roles('web')
-def repo_update(**kwargs):
-    """ Pull repository updates """
+def repo_update(parallel=False, workers=None, **kwargs):
+    """
+    Pull repository updates
+
+    Repositories are given as keyword arguments with the ref to update to,
+    e.g. ``repo_update:invenio=master``; other repositories are updated to
+    the ref configured in ``env.CFG_INVENIO_REPOS``.
+
+    If ``parallel`` is set, all repositories are fetched concurrently by
+    ``workers`` (default ``env.CFG_GIT_WORKERS``) git processes before they
+    are checked out. What to do with uncommitted changes is asked for all
+    repositories before fetching, so the questions are not interleaved with
+    the output of the fetches.
+
+    Repositories whose HEAD is already at the requested ref are neither
+    fetched nor checked out (branches are compared with ``git ls-remote``,
+    tags and commit ids locally). The repositories which actually changed
+    are stored in ``env.repos_changed``.
+    """
     # Check repositories to update/setup
     repo_refs = []
     for repo, info in env.CFG_INVENIO_REPOS:
@@ -144,26 +245,153 @@ def repo_update(**kwargs):
         for repo, ref in kwargs.items():
             abort(red("Invalid repository %s" % repo))
 
-    # Run update
-    for repo, ref in repo_refs:
-        topsrcdir = repo_check(repo, check_path=False, workdir=True)
-        gitdir = os.path.join(topsrcdir, '.git')
+    env.repos_changed = []
 
-        if not exists_local(gitdir):
-            repo_setup(repo, ref)
-        else:
-            if ref:
-                puts(cyan(">>> Updating repository %s to ref %s..." % (repo, ref)))
-                git_fetch(repo)
-                git_checkout(repo, ref)
+    if parallel:
+        repo_update_parallel(repo_refs, workers=workers)
+    else:
+        # Run update
+        for repo, ref in repo_refs:
+            topsrcdir = repo_check(repo, check_path=False, workdir=True)
+            gitdir = os.path.join(topsrcdir, '.git')
+
+            if not exists_local(gitdir):
+                repo_setup(repo, ref)
+                env.repos_changed.append(repo)
             else:
-                commit_id = git_describe(repo)
-                puts(cyan(">>> No ref specified for repository %s (currently at HEAD, commit %s) ..." % (repo, commit_id)))
+                if ref:
+                    if repo_is_current(repo, ref):
+                        continue
+                    puts(cyan(">>> Updating repository %s to ref %s..." % (repo, ref)))
+                    head = git_head(repo)
+                    git_fetch(repo)
+                    git_checkout(repo, ref)
+                    if git_head(repo) != head:
+                        env.repos_changed.append(repo)
+                else:
+                    commit_id = git_describe(repo)
+                    puts(cyan(">>> No ref specified for repository %s (currently at HEAD, commit %s) ..." % (repo, commit_id)))
+
+    if env.repos_changed:
+        puts(cyan(">>> Changed repositories: %s" % ", ".join(env.repos_changed)))
+    else:
+        puts(cyan(">>> No repositories changed"))
+
+
+@task
+@roles('web')
+def repo_worktrees(prune=False):
+    """
+    List the worktrees of all environments sharing ``env.CFG_SRCDIR``
+
+    Worktrees whose directory no longer exists are marked as stale. If
+    ``prune`` is set, they are removed from the registry and from the
+    repositories.
+    """
+    for name, repo, path in git_worktree_registry():
+        stale = not exists_local(path)
+        puts("%s %s %s%s" % (name, repo, path, " (stale)" if stale else ""))
+        if stale and prune:
+            with settings(NAME=name):
+                git_worktree_register(repo, path, remove=True)
+
+    if prune:
+        for repo, info in env.CFG_INVENIO_REPOS:
+            srcdir = repo_check(repo, check_path=False)
+            if exists_local(os.path.join(srcdir, '.git')):
+                sudo_local("cd %s; git worktree prune" % srcdir, user=env.CFG_INVENIO_USER)
 
 
 #
 # Helpers
 #
+def repo_update_parallel(repo_refs, workers=None):
+    """
+    Update repositories, fetching them concurrently (see
+    :meth:`~repo_update`).
+    """
+    workers = int(workers or env.CFG_GIT_WORKERS)
+
+    # Repositories not yet cloned are set up one by one (may prompt)
+    update = []
+    for repo, ref in repo_refs:
+        topsrcdir = repo_check(repo, check_path=False, workdir=True)
+        if not exists_local(os.path.join(topsrcdir, '.git')):
+            repo_setup(repo, ref)
+            env.repos_changed.append(repo)
+        elif ref:
+            if not repo_is_current(repo, ref):
+                update.append((repo, ref))
+        else:
+            commit_id = git_describe(repo)
+            puts(cyan(">>> No ref specified for repository %s (currently at HEAD, commit %s) ..." % (repo, commit_id)))
+
+    if not update:
+        return
+
+    # Ask all questions up front
+    actions = {}
+    for repo, ref in update:
+        actions[repo] = git_dirty_action(repo_check(repo, workdir=True))
+
+    puts(cyan(">>> Fetching %s repositories with %s workers ..." % (len(update), workers)))
+    git_fetch_all([repo for repo, ref in update], workers=workers)
+
+    for repo, ref in update:
+        puts(cyan(">>> Updating repository %s to ref %s..." % (repo, ref)))
+        head = git_head(repo)
+        git_checkout(repo, ref, dirty_action=actions[repo])
+        if git_head(repo) != head:
+            env.repos_changed.append(repo)
+
+
+def repo_is_current(repo, ref):
+    """
+    Check if a clean working directory already has ``ref`` checked out, so
+    fetching and checking out can be skipped.
+
+    Commit ids and tags known locally are resolved locally, anything else is
+    resolved as a tag or branch on the remote with ``git ls-remote``. Refs
+    given as remote branches (e.g. ``origin/maint-1.1``) are resolved
+    without the ``origin/`` prefix.
+    """
+    topsrcdir = repo_check(repo, workdir=True)
+    head = git_head(repo)
+    name = ref[len('origin/'):] if ref.startswith('origin/') else ref
+
+    if re.match(r'^[0-9a-f]{40}$', ref):
+        commit = ref
+    elif git_has_commit(topsrcdir, 'refs/tags/%s' % name):
+        commit = git_resolve(topsrcdir, 'refs/tags/%s' % name)
+    elif git_transport(repo) == 'bundle':
+        # Hosts using bundles get their refs from the control machine
+        ctx = {
+            'mirror': git_bundle_mirror_update(repo),
+            'tag': quote('refs/tags/%s^{commit}' % name),
+            'branch': quote('refs/heads/%s^{commit}' % name),
+        }
+        with settings(hide('everything'), warn_only=True):
+            output = local("git --git-dir=%(mirror)s rev-parse -q --verify %(tag)s || "
+                           "git --git-dir=%(mirror)s rev-parse -q --verify %(branch)s" % ctx, capture=True)
+        commit = output.strip() if output.return_code == 0 else None
+    else:
+        # Annotated tags are listed with the commit they point to as <tag>^{}
+        patterns = ['refs/tags/%s^{}' % name, 'refs/tags/%s' % name, 'refs/heads/%s' % name]
+        with settings(hide('everything'), warn_only=True):
+            output = sudo_local("cd %s && git ls-remote origin %s" % (topsrcdir, " ".join([quote(p) for p in patterns])),
+                                capture=True, user=env.CFG_INVENIO_USER)
+        refs = {}
+        if output.return_code == 0:
+            refs = dict([line.split()[::-1] for line in output.splitlines() if len(line.split()) == 2])
+        commit = ([refs[p] for p in patterns if p in refs] or [None])[0]
+
+    if not commit or commit != head or git_isdirty(topsrcdir):
+        return False
+
+    puts(cyan(">>> Repository %s already at ref %s (commit %s), skipping..." % (repo, ref, head[:7])))
+    return True
+
+
 def repo_check(repo, check_path=True, workdir=False):
     all_repos = [x[0] for x in env.CFG_INVENIO_REPOS]
 
@@ -179,21 +407,247 @@ def repo_check(repo, check_path=True, workdir=False):
     return repo_path
 
 
-def repo_all_configure_make(repo, target_key):
+def repo_all_configure_make(repo, target_key, force=False):
     if repo:
         repo_check(repo)
         repos = [(repo, dict(env.CFG_INVENIO_REPOS)[repo])]
     else:
         repos = env.CFG_INVENIO_REPOS
 
+    build = []
     for r, info in repos:
-        repo_configure(r)
+        targets = info.get(target_key, ['all', 'install'])
+        old_state = repo_build_state(r)
+        state = repo_build_state(r, targets=targets, current=True)
+
+        if not force and old_state and not state['dirty'] and \
+           [old_state.get(k) for k in ('commit', 'targets', 'configure')] == \
+           [state[k] for k in ('commit', 'targets', 'configure')]:
+            puts(cyan(">>> Repository %s already installed at commit %s, skipping..." % (r, state['commit'][:7])))
+            continue
+
+        cache_key = None
+        if env.CFG_BUILD_CACHE_DIR and not state['dirty']:
+            cache_key = repo_cache_key(r, state)
+            if not force and repo_cache_restore(r, cache_key):
+                # The source tree itself has not been configured
+                state['configured'] = False
+                repo_build_state_save(r, state)
+                continue
+
+        if not force and old_state and old_state.get('configured', True) and \
+           old_state['configure'] == state['configure']:
+            puts(cyan(">>> Configure inputs of %s unchanged, skipping configure..." % r))
+        else:
+            repo_configure(r)
+            # Configuring may regenerate files recorded as inputs
+            state = repo_build_state(r, targets=targets, current=True)
+        build.append((r, targets, state, cache_key))
 
-    for r, info in repos:
+    for r, targets, state, cache_key in build:
+        marker = repo_cache_marker() if cache_key else None
+        repo_make(r, *targets)
+        repo_build_state_save(r, state)
+        if cache_key:
+            repo_cache_store(r, cache_key, marker)
+
+
+def repo_make_jobs():
+    """
+    Number of make jobs: ``env.CFG_MAKE_JOBS`` or the number of cores of the
+    current host (probed once per host).
+    """
+    if env.CFG_MAKE_JOBS:
+        return int(env.CFG_MAKE_JOBS)
+
+    if 'make_jobs' not in env:
+        env.make_jobs = {}
+    if env.host not in env.make_jobs:
+        with settings(hide('everything'), warn_only=True):
+            output = sudo_local("nproc 2>/dev/null || grep -c ^processor /proc/cpuinfo",
+                                capture=True, user=env.CFG_INVENIO_USER)
         try:
-            repo_make(r, *info[target_key])
-        except KeyError:
-            repo_make(r, *['all', 'install'])
+            env.make_jobs[env.host] = max(int(output.strip()), 1)
+        except ValueError:
+            env.make_jobs[env.host] = 1
+    return env.make_jobs[env.host]
+
+
+def repo_build_state(repo, targets=None, current=False):
+    """
+    Get the recorded build state of a repository, or with ``current`` the
+    state it would be recorded with now.
+
+    The state is a dictionary with the ``commit``, the make ``targets``,
+    whether the working directory is ``dirty``, and the ``configure``
+    inputs: configure hook, checksums of :data:`BUILD_STATE_FILES` and
+    values of :data:`BUILD_STATE_ENV`.
+    """
+    if not current:
+        path = repo_build_state_file(repo)
+        if not exists_local(path):
+            return None
+        try:
+            return json.loads(read_file(path))
+        except ValueError:
+            return None
+
+    topsrcdir = repo_check(repo, workdir=True)
+
+    checksums = {}
+    with settings(hide('everything'), warn_only=True):
+        output = sudo_local("cd %s && md5sum %s" % (topsrcdir, " ".join(BUILD_STATE_FILES)),
+                            capture=True, user=env.CFG_INVENIO_USER)
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            checksums[parts[1]] = parts[0]
+
+    hook = dict(env.CFG_INVENIO_REPOS)[repo].get('configure_hook', default_configure_hook)
+    return {
+        'commit': git_head(repo),
+        'targets': list(targets or []),
+        'dirty': git_isdirty(topsrcdir),
+        'configure': {
+            'hook': hook.__name__ if hook else None,
+            'files': checksums,
+            'env': dict([(k, env.get(k)) for k in BUILD_STATE_ENV]),
+        },
+    }
+
+
+def repo_build_state_file(repo):
+    return os.path.join(env.CFG_INVENIO_PREFIX, 'var/inveniofab', 'build-%s.json' % repo)
+
+
+def repo_build_state_save(repo, state):
+    """ Record the state of a successful install """
+    path = repo_build_state_file(repo)
+    if not exists_local(os.path.dirname(path)):
+        sudo_local("mkdir -p %s" % os.path.dirname(path), user=env.CFG_INVENIO_USER)
+    state = dict(state)
+    if state.pop('dirty'):
+        # Built from uncommitted changes, so the commit does not identify it
+        state['commit'] = None
+    state.setdefault('configured', True)
+    write_file(path, json.dumps(state, indent=2, sort_keys=True), use_sudo=True)
+
+
+def repo_cache_key(repo, state):
+    """
+    Key of the build cache entry for a repository in a given build state.
+
+    The installation prefix is not part of the key, so entries can be
+    shared between environments (see :meth:`~repo_cache_restore`).
+    """
+    configure = dict(state['configure'])
+    configure['env'] = dict([(k, v) for k, v in configure['env'].items()
+                             if k != 'CFG_INVENIO_PREFIX'])
+    key = {
+        'repo': repo,
+        'commit': state['commit'],
+        'python': python_version().strip(),
+        'targets': state['targets'],
+        'configure': configure,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def repo_cache_marker():
+    """
+    Create a timestamp file, to find the files installed by a later make
+    """
+    with settings(hide('everything')):
+        return sudo_local("mktemp", capture=True, user=env.CFG_INVENIO_USER).strip()
+
+
+def repo_cache_store(repo, key, marker):
+    """
+    Store the files in the :data:`BUILD_CACHE_DIRS` of the prefix installed
+    since ``marker`` was created in the build cache, then evict least
+    recently used entries above ``env.CFG_BUILD_CACHE_SIZE`` MB.
+
+    Installed files are found by their change time, since ``install -p`` and
+    ``cp -p`` keep the (older) modification time of the source.
+    """
+    ctx = {
+        'prefix': env.CFG_INVENIO_PREFIX,
+        'marker': marker,
+        'archive': os.path.join(env.CFG_BUILD_CACHE_DIR, '%s.tar.gz' % key),
+        'dirs': " ".join(BUILD_CACHE_DIRS),
+    }
+
+    puts(cyan(">>> Storing installed files of %s in build cache..." % repo))
+    sudo_local("mkdir -p %s" % env.CFG_BUILD_CACHE_DIR, user=env.CFG_INVENIO_USER)
+    sudo_local("cd %(prefix)s && for d in %(dirs)s; do [ ! -d $d ] || "
+               "find $d \\( -type f -o -type l \\) -cnewer %(marker)s -print; done > %(marker)s.list && "
+               "tar -czf %(archive)s.$$ -C %(prefix)s -T %(marker)s.list && "
+               "mv %(archive)s.$$ %(archive)s; rm -f %(marker)s %(marker)s.list" % ctx,
+               user=env.CFG_INVENIO_USER)
+    write_file(os.path.join(env.CFG_BUILD_CACHE_DIR, '%s.json' % key), json.dumps({
+        'repo': repo,
+        'commit': git_head(repo),
+        'prefix': env.CFG_INVENIO_PREFIX,
+    }, indent=2, sort_keys=True), use_sudo=True)
+
+    repo_cache_evict()
+
+
+def repo_cache_restore(repo, key):
+    """
+    Restore the files installed by a build from the cache. Files built for
+    another prefix are relocated by replacing the old prefix in all text
+    files, where it appears as a whole path (i.e. ``/opt/a`` is not replaced
+    in ``/opt/ab``). Binary files, including compiled ``.pyc`` files, are not
+    relocated and keep referring to the old prefix.
+
+    :return: ``True`` if the key was found in the cache.
+    """
+    archive = os.path.join(env.CFG_BUILD_CACHE_DIR, '%s.tar.gz' % key)
+    if not exists_local(archive):
+        return False
+
+    try:
+        info = json.loads(read_file(os.path.join(env.CFG_BUILD_CACHE_DIR, '%s.json' % key)))
+    except (ValueError, IOError):
+        return False
+
+    ctx = {
+        'prefix': env.CFG_INVENIO_PREFIX,
+        'archive': archive,
+        'old': quote(info['prefix'].rstrip('/')),
+        'new': quote(env.CFG_INVENIO_PREFIX.rstrip('/')),
+        'relocate': quote("s{(?<![\\w./-])\\Q$ENV{OLD}\\E(?![\\w.-])}{$ENV{NEW}}g"),
+    }
+
+    puts(cyan(">>> Restoring %s at commit %s from build cache..." % (repo, info['commit'][:7])))
+    sudo_local("tar -xzf %(archive)s -C %(prefix)s && touch %(archive)s" % ctx, user=env.CFG_INVENIO_USER)
+    if info['prefix'] != env.CFG_INVENIO_PREFIX:
+        sudo_local("cd %(prefix)s && tar -tzf %(archive)s | grep -v '/$' | "
+                   "xargs -d '\\n' grep -lIF -- %(old)s | "
+                   "OLD=%(old)s NEW=%(new)s xargs -d '\\n' -r perl -pi -e %(relocate)s" % ctx,
+                   user=env.CFG_INVENIO_USER)
+    return True
+
+
+def repo_cache_evict():
+    """
+    Remove least recently used build cache entries until the cache is below
+    ``env.CFG_BUILD_CACHE_SIZE`` MB.
+    """
+    with settings(hide('everything')):
+        output = sudo_local("find %s -maxdepth 1 -name '*.tar.gz' -printf '%%T@ %%s %%p\\n'" % env.CFG_BUILD_CACHE_DIR,
+                            capture=True, user=env.CFG_INVENIO_USER)
+    entries = sorted([line.split(" ", 2) for line in output.splitlines() if line.strip()],
+                     key=lambda x: float(x[0]), reverse=True)
+
+    total = 0
+    limit = int(env.CFG_BUILD_CACHE_SIZE) * 1024 * 1024
+    for mtime, size, path in entries:
+        total += int(size)
+        if total > limit:
+            puts(">>> Evicting %s from build cache" % os.path.basename(path))
+            sudo_local("rm -f %s %s" % (path, path[:-len('.tar.gz')] + '.json'), user=env.CFG_INVENIO_USER)
 
 
 #
@@ -204,6 +658,8 @@ def git_describe(repo):
     version_gen = os.path.join(topsrcdir, 'git-version-gen')
 
     if exists_local(version_gen):
+        if git_shallow_options(repo):
+            git_deepen_to_tag(repo)
         output = sudo_local("cd %s; %s" % (topsrcdir, version_gen), capture=True, user=env.CFG_INVENIO_USER)
     else:
         output = sudo_local("cd %s; git describe --always --abbrev=4 HEAD" % topsrcdir, capture=True, user=env.CFG_INVENIO_USER)
@@ -226,7 +682,12 @@ def git_reset(repo, ref):
 
 
 def git_newworkdir(repo):
-    if env.WITH_WORKDIR and env.CFG_SRCDIR != env.CFG_SRCWORKDIR:
+    """
+    Create the work directory of a repository as a worktree of the clone in
+    ``env.CFG_SRCDIR``, sharing its object store, and add it to the
+    worktree registry (see :meth:`~git_worktree_registry`).
+    """
+    if git_use_worktree():
         srcdir = repo_check(repo, workdir=False, check_path=False)
         srcworkdir = repo_check(repo, workdir=True, check_path=False)
 
@@ -236,7 +697,46 @@ def git_newworkdir(repo):
         }
         ctx.update(env)
 
-        sudo_local("%(CFG_INVENIO_PREFIX)s/bin/git-new-workdir %(srcdir)s %(srcworkdir)s" % ctx, user=env.CFG_INVENIO_USER)
+        # Forget worktrees which have been removed (e.g. by venv_drop)
+        sudo_local("cd %(srcdir)s; git worktree prune" % ctx, user=env.CFG_INVENIO_USER)
+        sudo_local("cd %(srcdir)s; git worktree add --detach %(srcworkdir)s HEAD" % ctx, user=env.CFG_INVENIO_USER)
+        git_worktree_register(repo, srcworkdir)
+
+
+def git_use_worktree():
+    """
+    Check if work directories are worktrees separate from ``env.CFG_SRCDIR``
+    """
+    return env.WITH_WORKDIR and env.CFG_SRCDIR != env.CFG_SRCWORKDIR
+
+
+def git_worktree_registry():
+    """
+    Read the worktree registry ``<CFG_SRCDIR>/.worktrees``, which lists the
+    environment name, repository and path of each worktree created from the
+    clones in ``env.CFG_SRCDIR``.
+
+    :return: List of ``(name, repo, path)`` tuples.
+    """
+    registry = os.path.join(env.CFG_SRCDIR, '.worktrees')
+    if not exists_local(registry):
+        return []
+    with settings(hide('everything')):
+        output = sudo_local("cat %s" % registry, capture=True, user=env.CFG_INVENIO_USER)
+    return [tuple(line.split(None, 2)) for line in output.splitlines() if len(line.split(None, 2)) == 3]
+
+
+def git_worktree_register(repo, path, remove=False):
+    """
+    Add (or remove) the worktree of a repository for the current environment
+    in the worktree registry.
+    """
+    entries = [e for e in git_worktree_registry() if e[:2] != (env.NAME, repo)]
+    if not remove:
+        entries.append((env.NAME, repo, path))
+    content = "".join(["%s %s %s\n" % e for e in entries])
+    sudo_local("printf '%%s' %s > %s" % (quote(content), os.path.join(env.CFG_SRCDIR, '.worktrees')),
+               user=env.CFG_INVENIO_USER)
 
 
 def git_isdirty(dir):
@@ -248,9 +748,28 @@ def git_isdirty(dir):
     return output.return_code != 0
 
 
-def git_checkout(repo, ref):
+def git_dirty_action(topsrcdir):
+    """
+    Ask what to do with uncommitted changes in a working directory.
+
+    :return: ``stash``, ``reset`` or ``None`` if there are no changes.
+    """
+    if not git_isdirty(topsrcdir):
+        return None
+    if confirm("Working directory %s contains uncommited changes. Do you want to stash the changes?" % topsrcdir):
+        return 'stash'
+    if confirm("Do you want to reset the changes (required to continue)?"):
+        return 'reset'
+    abort("Cannot continue unless uncommitted changes are stashed or reset.")
+
+
+def git_checkout(repo, ref, dirty_action=None):
     """
     Checkout a specific git reference.
+
+    :param dirty_action: What to do with uncommitted changes (``stash`` or
+        ``reset``), if already decided with :meth:`~git_dirty_action`.
+        Otherwise the user is asked if there are uncommitted changes.
     """
     topsrcdir = repo_check(repo, workdir=True)
 
@@ -261,25 +780,105 @@ def git_checkout(repo, ref):
     ctx.update(env)
 
     # Stash uncommited changes
-    if git_isdirty(topsrcdir):
-        if not confirm("Working directory %(topsrcdir)s contains uncommited changes. Do you want to stash the changes?" % ctx):
-            if not confirm("Do you want to reset the changes (required to continue)?" % ctx):
-                abort("Cannot continue unless uncommitted changes are stashed or reset.")
-            else:
-                sudo_local("cd %(topsrcdir)s; git reset --hard HEAD" % ctx, user=env.CFG_INVENIO_USER)
-        else:
-            sudo_local("cd %(topsrcdir)s; git stash" % ctx, user=env.CFG_INVENIO_USER)
+    if not dirty_action:
+        dirty_action = git_dirty_action(topsrcdir)
+    elif not git_isdirty(topsrcdir):
+        dirty_action = None
+
+    if dirty_action == 'reset':
+        sudo_local("cd %(topsrcdir)s; git reset --hard HEAD" % ctx, user=env.CFG_INVENIO_USER)
+    elif dirty_action == 'stash':
+        sudo_local("cd %(topsrcdir)s; git stash" % ctx, user=env.CFG_INVENIO_USER)
 
-    sudo_local("cd %(topsrcdir)s; git checkout -f %(ref)s" % ctx, user=env.CFG_INVENIO_USER)
+    # Shallow clones only have the branches, and the tags pointing into
+    # their history - fetch any other ref explicitly.
+    if git_shallow_options(repo) and not git_has_commit(topsrcdir, ref):
+        ctx['source'] = git_mirror(repo) or 'origin'
+        ctx['options'] = git_shallow_options(repo)
+        sudo_local("cd %(topsrcdir)s; git fetch %(options)s %(source)s %(ref)s" % ctx, user=env.CFG_INVENIO_USER)
+        if not git_has_commit(topsrcdir, ref):
+            ctx['ref'] = 'FETCH_HEAD'
+
+    # A branch may be checked out in several environments at once
+    ctx['options'] = "--ignore-other-worktrees" if git_use_worktree() else ""
+    sudo_local("cd %(topsrcdir)s; git checkout -f %(options)s %(ref)s" % ctx, user=env.CFG_INVENIO_USER)
+
+
+def git_head(repo):
+    """ Commit id of HEAD of a repository's working directory """
+    return git_resolve(repo_check(repo, workdir=True), 'HEAD')
+
+
+def git_resolve(dir, ref):
+    """
+    Resolve a reference to a commit id locally, or ``None`` if it is unknown
+    """
+    with settings(hide('everything'), warn_only=True):
+        output = sudo_local("cd %s && git rev-parse -q --verify %s" % (dir, quote("%s^{commit}" % ref)),
+                            capture=True, user=env.CFG_INVENIO_USER)
+    return output.strip() if output.return_code == 0 else None
+
+
+def git_has_commit(dir, ref):
+    """
+    Check if a reference (or remote branch) resolves to a commit available
+    locally
+    """
+    with settings(hide('everything'), warn_only=True):
+        output = sudo_local("cd %s && (git rev-parse -q --verify %s || git rev-parse -q --verify %s)" % (
+            dir, quote("%s^{commit}" % ref), quote("origin/%s^{commit}" % ref)
+        ), capture=True, user=env.CFG_INVENIO_USER)
+    return output.return_code == 0
+
+
+def git_shallow_options(repo, clone=False):
+    """
+    Options for shallow (``depth``) and partial (``filter``, e.g.
+    ``blob:none``) clones of a repository, as configured in
+    ``env.CFG_INVENIO_REPOS``.
+
+    Repositories using bundles always have the complete history, so they
+    get no options (see :meth:`~git_bundle_fetch`).
+
+    :param clone: Return the options for ``git clone`` instead of
+        ``git fetch``.
+    """
+    info = dict(env.CFG_INVENIO_REPOS)[repo]
+    options = []
+    if git_transport(repo) == 'bundle':
+        return ""
+    if info.get('depth'):
+        options.append("--depth %s" % int(info['depth']))
+        if clone:
+            # Fetch all branches, not only the default one
+            options.append("--no-single-branch")
+    if info.get('filter'):
+        options.append("--filter=%s" % info['filter'])
+    return " ".join(options)
+
+
+def git_deepen_to_tag(repo):
+    """
+    Deepen a shallow clone until HEAD can be described by an annotated tag
+    (required by ``git-version-gen``), or the complete history is fetched.
+    Repositories using bundles are never shallow.
+    """
+    if git_transport(repo) == 'bundle':
+        return
+    topsrcdir = repo_check(repo, workdir=True)
+    ctx = {
+        'topsrcdir': topsrcdir,
+        'source': git_mirror(repo) or 'origin',
+        'step': GIT_DEEPEN_STEP,
+    }
+    sudo_local("cd %(topsrcdir)s; "
+               "while [ -f \"$(git rev-parse --git-common-dir)/shallow\" ] && ! git describe HEAD >/dev/null 2>&1; do "
+               "git fetch -q --deepen=%(step)s %(source)s || exit 1; done" % ctx, user=env.CFG_INVENIO_USER)
 
 
 def git_clone(repo):
     topsrcdir = repo_check(repo, check_path=False, workdir=False)
-
-    try:
-        repo_url = dict(env.CFG_INVENIO_REPOS)[repo]['repository']
-    except KeyError:
-        abort(red("Repository URL for %s not defined" % repo))
+    repo_url = git_repo_url(repo)
 
     basename = os.path.basename(topsrcdir)
     parent = os.path.dirname(topsrcdir)
@@ -299,14 +898,247 @@ def git_clone(repo):
         'parent': parent,
         'topsrcdir': topsrcdir,
         'url': repo_url,
+        'mirror': git_mirror(repo),
+        'options': git_shallow_options(repo, clone=True),
     }
 
-    sudo_local("cd %(parent)s; git clone %(url)s %(basename)s " % ctx, user=env.CFG_INVENIO_USER)
+    if git_transport(repo) == 'bundle':
+        bundle = git_bundle_send(repo, [], head=True)
+        sudo_local("cd %s; git clone %s %s" % (parent, bundle, basename), user=env.CFG_INVENIO_USER)
+        sudo_local("cd %s; git remote set-url origin %s" % (topsrcdir, repo_url), user=env.CFG_INVENIO_USER)
+        git_bundle_remove(bundle)
+    elif ctx['mirror']:
+        # Objects are copied from the mirror, only missing ones are fetched
+        sudo_local(git_mirror_update(repo), user=env.CFG_INVENIO_USER)
+        git_mirror_updated(repo)
+        sudo_local("cd %(parent)s; git clone %(options)s --reference %(mirror)s --dissociate %(url)s %(basename)s " % ctx, user=env.CFG_INVENIO_USER)
+    else:
+        sudo_local("cd %(parent)s; git clone %(options)s %(url)s %(basename)s " % ctx, user=env.CFG_INVENIO_USER)
 
 
 def git_fetch(repo):
     topsrcdir = repo_check(repo)
-    sudo_local("cd %s; git fetch origin" % topsrcdir, user=env.CFG_INVENIO_USER)
+    if git_transport(repo) == 'bundle':
+        return git_bundle_fetch(repo)
+    sudo_local("cd %s; %s" % (topsrcdir, git_fetch_command(repo)), user=env.CFG_INVENIO_USER)
+    git_mirror_updated(repo)
+
+
+def git_transport(repo):
+    """
+    How a host gets a repository's history: ``direct`` from the repository
+    URL (or ``env.CFG_GIT_MIRROR_DIR``), or ``bundle`` via git bundles
+    built on the machine running fab (see :meth:`~git_bundle_fetch`). Set
+    per repository with ``transport``, default ``env.CFG_GIT_TRANSPORT``.
+    """
+    return dict(env.CFG_INVENIO_REPOS)[repo].get('transport', env.CFG_GIT_TRANSPORT)
+
+
+def git_bundle_fetch(repo):
+    """
+    Fetch a repository from a bundle with the objects the host lacks.
+
+    The machine running fab keeps a mirror of the repository in
+    ``env.CFG_GIT_BUNDLE_DIR`` (refreshed once per run), so the upstream
+    repository is fetched once regardless of the number of hosts. Shallow
+    and partial clone options are not used with bundles.
+    """
+    topsrcdir = repo_check(repo)
+    with settings(hide('everything')):
+        known = sudo_local("cd %s && git for-each-ref --format='%%(objectname)' refs/remotes refs/tags refs/heads" % topsrcdir,
+                           capture=True, user=env.CFG_INVENIO_USER).split()
+
+    bundle = git_bundle_send(repo, known)
+    if not bundle:
+        puts(">>> Repository %s has all objects of the mirror" % repo)
+        return
+    sudo_local("cd %s; git fetch %s '+refs/heads/*:refs/remotes/origin/*' '+refs/tags/*:refs/tags/*'" % (topsrcdir, bundle),
+               user=env.CFG_INVENIO_USER)
+    git_bundle_remove(bundle)
+
+
+def git_bundle_mirror_update(repo):
+    """
+    Create or refresh (once per run) the mirror of a repository on the
+    machine running fab, return its path.
+    """
+    mirror = os.path.join(os.path.expanduser(env.CFG_GIT_BUNDLE_DIR), git_mirror_name(repo))
+    if 'git_bundle_mirrors_updated' not in env:
+        env.git_bundle_mirrors_updated = set()
+    if mirror not in env.git_bundle_mirrors_updated:
+        if os.path.exists(mirror):
+            local("git --git-dir=%s fetch -q --prune origin" % mirror)
+        else:
+            local("mkdir -p %s && git clone -q --mirror %s %s" % (os.path.dirname(mirror), git_repo_url(repo), mirror))
+        env.git_bundle_mirrors_updated.add(mirror)
+    return mirror
+
+
+def git_bundle_send(repo, known, head=False):
+    """
+    Create a bundle of all branches and tags of the mirror, without the
+    history of the ``known`` commits, and upload it to the host.
+
+    :param head: Include ``HEAD`` (needed to clone from the bundle).
+    :return: Path of the bundle on the host, or ``None`` if it would be
+        empty.
+    """
+    mirror = git_bundle_mirror_update(repo)
+
+    # Commits unknown to the mirror (e.g. local commits) cannot be excluded
+    fd, revsfile = tempfile.mkstemp(suffix='.revs')
+    os.close(fd)
+    local("for c in %s; do git --git-dir=%s cat-file -e $c^{commit} 2>/dev/null && echo ^$c; done > %s" % (
+          " ".join(sorted(set(known))), mirror, revsfile))
+    revs = "--branches --tags%s --stdin < %s" % (" HEAD" if head else "", revsfile)
+
+    with settings(hide('everything')):
+        new = local("git --git-dir=%s rev-list -n 1 %s" % (mirror, revs), capture=True).strip()
+    if not new:
+        os.unlink(revsfile)
+        return None
+
+    fd, bundle = tempfile.mkstemp(suffix='.bundle', prefix='inveniofab-%s-' % repo)
+    os.close(fd)
+    local("git --git-dir=%s bundle create %s %s" % (mirror, bundle, revs))
+    os.unlink(revsfile)
+    os.chmod(bundle, 0644)
+
+    if is_local():
+        return bundle
+
+    puts(">>> Uploading bundle of %s (%.1f MB)..." % (repo, os.path.getsize(bundle) / 1048576.0))
+    remote_bundle = "/tmp/%s" % os.path.basename(bundle)
+    put(bundle, remote_bundle, mode=0644)
+    os.unlink(bundle)
+    return remote_bundle
+
+
+def git_bundle_remove(bundle):
+    if is_local():
+        os.unlink(bundle)
+    else:
+        sudo_local("rm -f %s" % bundle)
+
+
+def git_fetch_command(repo, quiet=False, update=True):
+    """
+    Shell command fetching a repository (run inside its working directory).
+
+    With ``env.CFG_GIT_MIRROR_DIR`` the mirror is refreshed (once per run,
+    see :meth:`~git_mirror_update`; not at all without ``update``) and the
+    repository is fetched from the mirror instead of the remote, so history
+    shared by several environments is only downloaded once.
+    """
+    mirror = git_mirror(repo)
+    options = " ".join(filter(None, ["-q" if quiet else "", git_shallow_options(repo)]))
+    if not mirror:
+        return "git fetch %s origin" % options
+
+    return "%s && git fetch %s %s '+refs/heads/*:refs/remotes/origin/*' '+refs/tags/*:refs/tags/*'" % (
+        git_mirror_update(repo, quiet=quiet) if update else "true", options, mirror
+    )
+
+
+def git_mirror(repo):
+    """
+    Path of the bare mirror of a repository in ``env.CFG_GIT_MIRROR_DIR``,
+    or ``None`` if no mirror directory is configured.
+    """
+    if not env.CFG_GIT_MIRROR_DIR:
+        return None
+    return os.path.join(env.CFG_GIT_MIRROR_DIR, git_mirror_name(repo))
+
+
+def git_mirror_name(repo):
+    """ Directory name of the mirror of a repository, based on its URL """
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', git_repo_url(repo).split('://', 1)[-1]).strip('_')
+    if not name.endswith('.git'):
+        name += '.git'
+    return name
+
+
+def git_mirror_update(repo, quiet=False):
+    """
+    Shell command creating or refreshing the mirror of a repository. Each
+    mirror is only refreshed once per run on a host: once the command has
+    succeeded (see :meth:`~git_mirror_updated`), ``true`` is returned.
+    """
+    mirror = git_mirror(repo)
+    if (env.host, mirror) in env.get('git_mirrors_updated', set()):
+        return "true"
+
+    ctx = {
+        'mirror': mirror,
+        'parent': os.path.dirname(mirror),
+        'url': git_repo_url(repo),
+        'quiet': "-q " if quiet else "",
+    }
+    return ("(if [ -d %(mirror)s ]; then git --git-dir=%(mirror)s fetch %(quiet)s--prune origin; "
+            "else mkdir -p %(parent)s && git clone %(quiet)s--mirror %(url)s %(mirror)s; fi)" % ctx)
+
+
+def git_mirror_updated(repo):
+    """ Record that the mirror of a repository was refreshed on this host """
+    mirror = git_mirror(repo)
+    if not mirror:
+        return
+    if 'git_mirrors_updated' not in env:
+        env.git_mirrors_updated = set()
+    env.git_mirrors_updated.add((env.host, mirror))
+
+
+def git_repo_url(repo):
+    try:
+        return dict(env.CFG_INVENIO_REPOS)[repo]['repository']
+    except KeyError:
+        abort(red("Repository URL for %s not defined" % repo))
+
+
+def git_fetch_all(repos, workers=None):
+    """
+    Fetch repositories concurrently with ``workers`` git processes. Aborts
+    after all fetches are done if any of them failed. Repositories using
+    bundles are fetched one by one first.
+    """
+    for r in [r for r in repos if git_transport(r) == 'bundle']:
+        git_bundle_fetch(r)
+    repos = [r for r in repos if git_transport(r) != 'bundle']
+    if not repos:
+        return
+
+    # Repositories sharing a mirror refresh it only once
+    args = []
+    updates = {}
+    for r in repos:
+        update = git_mirror(r) not in [git_mirror(x) for x in updates.values()]
+        if update:
+            updates[repo_check(r)] = r
+        args.append("%s %s" % (quote(repo_check(r)), quote(git_fetch_command(r, quiet=True, update=update))))
+
+    ctx = {
+        'args': " ".join(args),
+        'workers': int(workers or env.CFG_GIT_WORKERS),
+        'worker': quote("cd \"$1\" && eval \"$2\" 2>&1 | sed \"s|^|$1: |\"; "
+                        "[ ${PIPESTATUS[0]} -eq 0 ] && echo \"FETCHED $1\" || echo \"FAILED $1\""),
+    }
+    output = sudo_local("bash -c %s" % quote(
+        "printf '%%s\\0' %(args)s | xargs -0 -n 2 -P %(workers)s bash -c %(worker)s _" % ctx
+    ), capture=True, user=env.CFG_INVENIO_USER)
+
+    failed = []
+    for line in output.splitlines():
+        parts = line.strip().split(" ", 1)
+        if parts[0] == 'FETCHED':
+            puts(">>> Fetched %s" % parts[1])
+            if parts[1] in updates:
+                git_mirror_updated(updates[parts[1]])
+        elif parts[0] == 'FAILED':
+            failed.append(parts[1])
+        elif line.strip():
+            puts(line.strip())
+    if failed:
+        abort(red("Fetching failed for %s" % ", ".join(failed)))
 
 
 #
@@ -324,7 +1156,12 @@ def _run_hook(repo, hook_name, default_hook, *args, **kwargs):
 
     if hook:
         puts(">>> Running hook %s" % hook.__name__)
-        hook(*args, **kwargs)
+        start = time.time()
+        note = hook(*args, **kwargs)
+        # Hooks may return a short note on what they did (e.g. skipped)
+        puts(">>> Hook %s finished in %.1fs%s" % (
+            hook.__name__, time.time() - start,
+            " (%s)" % note if isinstance(note, basestring) else ""))
     else:
         puts(">>> No hook found for %s" % hook_name)
 
@@ -335,18 +1172,53 @@ def _run_hook(repo, hook_name, default_hook, *args, **kwargs):
 def default_configure_hook(ctx):
     """
     Default way to configure a repo. Assumes repo has a configure script.
+
+    Configure test results are cached per repository in
+    ``var/inveniofab/config-<repo>.cache`` in the prefix, since the
+    configure scripts of different repositories test (and name) different
+    things.
     """
-    if exists_local(os.path.join(ctx['topsrcdir'], "configure")):
-        with settings(warn_only=True):
-            sudo_local("cd %(topsrcdir)s && make -s clean" % ctx, user=env.CFG_INVENIO_USER)
-    sudo_local("cd %(topsrcdir)s && ./configure --prefix=%(CFG_INVENIO_PREFIX)s "
-          "--with-python=%(CFG_INVENIO_PREFIX)s/bin/python" % ctx, user=env.CFG_INVENIO_USER)
+    ctx = dict(ctx)
+    ctx['cachefile'] = os.path.join(ctx['CFG_INVENIO_PREFIX'], 'var/inveniofab',
+                                    'config-%s.cache' % ctx['repo'])
+    sudo_local("mkdir -p %s" % os.path.dirname(ctx['cachefile']), user=env.CFG_INVENIO_USER)
+    ctx['configure'] = ("./configure --prefix=%(CFG_INVENIO_PREFIX)s "
+        "--with-python=%(CFG_INVENIO_PREFIX)s/bin/python --cache-file=%(cachefile)s" % ctx)
+    with settings(warn_only=True):
+        res = sudo_local("cd %(topsrcdir)s && %(configure)s" % ctx, user=env.CFG_INVENIO_USER, warn_only=True)
+    if res.failed:
+        # A cache from a changed environment makes configure fail, start afresh
+        warn("Configure of %s failed, retrying without cached results from %s" % (ctx['repo'], ctx['cachefile']))
+        sudo_local("rm -f %(cachefile)s && cd %(topsrcdir)s && %(configure)s" % ctx, user=env.CFG_INVENIO_USER)
     sudo_local("cd %(topsrcdir)s && make -s clean" % ctx, user=env.CFG_INVENIO_USER)
 
 
 def default_prepare_hook(ctx):
     """
     Default way to prepare source code which uses autotools.
+
+    Skipped if ``configure`` exists and the checksums of the autotools
+    inputs (``configure.ac``, ``Makefile.am`` and ``*.m4`` files) are the
+    same as when it was last generated.
     """
     if exists_local(os.path.join(ctx['topsrcdir'], "configure.ac")):
+        ctx = dict(ctx)
+        with settings(hide('everything')):
+            ctx['checksum'] = sudo_local(
+                "cd %(topsrcdir)s && find . -path ./.git -prune -o \\( -name configure.ac "
+                "-o -name Makefile.am -o -name '*.m4' ! -name aclocal.m4 \\) -type f -print "
+                "| sort | xargs md5sum | md5sum | cut -d ' ' -f 1" % ctx,
+                capture=True, user=env.CFG_INVENIO_USER).strip()
+            ctx['stampfile'] = os.path.join(sudo_local(
+                "cd %(topsrcdir)s && git rev-parse --git-dir" % ctx,
+                capture=True, user=env.CFG_INVENIO_USER).strip(), 'inveniofab-prepare')
+            if not os.path.isabs(ctx['stampfile']):
+                ctx['stampfile'] = os.path.join(ctx['topsrcdir'], ctx['stampfile'])
+
+        if exists_local(os.path.join(ctx['topsrcdir'], "configure")) and \
+           exists_local(ctx['stampfile']) and \
+           read_file(ctx['stampfile']).strip() == ctx['checksum']:
+            return "skipped, autotools inputs unchanged"
+
         sudo_local("cd %(topsrcdir)s; aclocal && automake -a && autoconf -f" % ctx, user=env.CFG_INVENIO_USER)
+        sudo_local("echo %(checksum)s > %(stampfile)s" % ctx, user=env.CFG_INVENIO_USER)
@@ -20,6 +20,7 @@
 from fabric.api import task, puts, local, env
 from fabric.colors import cyan
 from inveniofab.git import repo_check
+from inveniofab.mysql import mysql_app_exec
 
 @task
 def inspire_dbchanges():
@@ -34,9 +35,7 @@ def inspire_dbchanges():
     local("cd %(topsrcdir)s; make install-dbchanges" % ctx)
 
     # Look for the webcoll task id added by install-dbchanges and run it
-    query_output = local('echo "select max(id) from schTASK;" | %(CFG_INVENIO_PREFIX)s/bin/dbexec' % ctx,
-                        capture=True)
-    task_id = query_output.split('\n')[-1]
+    task_id = mysql_app_exec("select max(id) from schTASK;")[-1][0]
 
     puts(cyan(">>> Running webcoll task %s..." % task_id))
     ctx.update({'webcoll_task_id': task_id})
@@ -21,19 +21,101 @@ Library tasks for configuring and running MySQL for Invenio.
 
 from __future__ import with_statement
 from fabric.api import puts, task, env, local, abort, settings, hide, roles,\
-    execute
+    execute, warn
 from fabric.colors import red, cyan
 from fabric.contrib.console import confirm
+from fabric.state import connections
+from paramiko import SSHException
 from inveniofab.env import env_get
 from inveniofab.utils import prompt_and_check, exists_local, sudo_local, \
-    write_template
+    write_template, run_local, read_file, write_file, CODECS, codec_get, \
+    codec_ext, codec_compress_cmd, codec_decompress_cmd, command_available, \
+    is_local
 from jinja2.exceptions import TemplateNotFound
+from fnmatch import fnmatchcase
+from pipes import quote
+import atexit
+import json
 import os
+import subprocess
+import time
+
+MYSQL_DUMP_MANIFEST = 'manifest.json'
+"""
+Name of the manifest file in a dump directory created by :meth:`~mysql_dump`.
+"""
+
+MYSQLDUMP_OPTS = '--skip-opt --add-drop-table --add-locks --create-options ' \
+    '--quick --extended-insert --set-charset --disable-keys'
+
+MYSQL_TRANSACTIONAL_ENGINES = ['InnoDB', 'TokuDB']
+"""
+Storage engines of which ``mysqldump --single-transaction`` dumps a
+consistent snapshot (see :meth:`~mysql_consistency_opts`).
+"""
+
+MYSQL_PROFILES = {
+    'invenio': {
+        'buffer_pool_share': 0.6,
+        'max_connections': 300,
+        'settings': {
+            'max_allowed_packet': '1G',
+            'query_cache_type': 1,
+            'query_cache_size': '64M',
+            'table_open_cache': 2000,
+            'tmp_table_size': '64M',
+            'max_heap_table_size': '64M',
+            'innodb_flush_log_at_trx_commit': 1,
+            'sync_binlog': 1,
+        },
+    },
+    'bulk-load': {
+        'buffer_pool_share': 0.75,
+        'max_connections': 50,
+        'settings': {
+            'max_allowed_packet': '1G',
+            'query_cache_type': 0,
+            'query_cache_size': 0,
+            'innodb_flush_log_at_trx_commit': 2,
+            'sync_binlog': 0,
+            'innodb_doublewrite': 0,
+            'innodb_adaptive_hash_index': 'OFF',
+            'innodb_log_buffer_size': '64M',
+        },
+    },
+}
+"""
+Workload profiles for :meth:`~mysql_tuning`. ``buffer_pool_share`` is the
+share of the host memory given to the InnoDB buffer pool (halved if the host
+is also a web node), ``max_connections`` an upper bound on connections (it is
+further limited by the memory left), and ``settings`` are fixed values.
+"""
+
+MYSQL_DYNAMIC_VARIABLES = ['max_allowed_packet', 'query_cache_type',
+    'query_cache_size', 'innodb_flush_log_at_trx_commit', 'sync_binlog',
+    'innodb_adaptive_hash_index', 'innodb_io_capacity', 'max_connections']
+"""
+Variables of a profile which can be switched at runtime with ``SET GLOBAL``
+(see :meth:`~mysql_profile_apply`).
+"""
 
 
 @task
-def mysql_conf_type(conf='', name=''):
-    """ Upload and update MySQL configuration """
+def mysql_conf_type(conf='', name='', profile=None):
+    """
+    Upload and update MySQL configuration
+
+    The host is probed for memory, cores and the disk type of the MySQL data
+    directory, and the settings recommended for the workload ``profile``
+    (default ``env.CFG_DATABASE_PROFILE``) are computed by
+    :meth:`~mysql_tuning`. The template context has the probed values in
+    ``mysql_facts`` and the settings in ``mysql_tuning``, e.g.::
+
+      [mysqld]
+      {% for key, value in mysql_tuning|dictsort %}
+      {{ key }} = {{ value }}
+      {% endfor %}
+    """
     puts(cyan(">>> Configuring MySQL (%s)..." % name))
 
     conf_files = [(conf, '/etc/my.cnf')]
@@ -41,6 +123,11 @@ def mysql_conf_type(conf='', name=''):
     ctx = {}
     ctx.update(env)
 
+    facts = mysql_host_facts()
+    ctx['mysql_facts'] = facts
+    ctx['mysql_tuning'] = mysql_tuning(facts, profile or env.CFG_DATABASE_PROFILE)
+    puts(">>> %(memory)s MB memory, %(cores)s cores, %(disk)s disk" % facts)
+
     for local_file, remote_file in conf_files:
         print local_file
         puts(">>> Writing %s ..." % remote_file)
@@ -66,38 +153,27 @@ def mysql_conf():
 def mysql_dropdb(stored_answers=None):
     """
     Drop database and user
+
+    All statements are run as one SQL script in a single client session,
+    which also checks the MySQL admin credentials.
     """
     with hide('commands'):
         puts(cyan(">>> Dropping database and user ..." % env))
 
-        answers = prompt_and_check([
-            ("MySQL admin user:", "user"),
-            ("MySQL admin password:", "password")
-        ], mysql_admin_check(env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
-        cache_key="mysql://%s:%s" % (env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
-        stored_answers=stored_answers)
-
-        # Escape quote characters
-        answers['password'] = answers['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-        user_pw = '-u %(user)s --password=%(password)s' % answers if answers['password'] else '-u %(user)s' % answers
-
         ctx = {
-            'user_pw': user_pw,
-            'host': env.CFG_DATABASE_HOST,
             'name':  env.CFG_DATABASE_NAME,
-            'user':  env.CFG_DATABASE_USER,
-            'password': env.CFG_DATABASE_PASS,
-            'port': env.CFG_DATABASE_PORT,
+            'user':  mysql_escape(env.CFG_DATABASE_USER),
         }
 
-        ctx['password'] = ctx['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
+        sql = ["DROP DATABASE IF EXISTS `%(name)s`;" % ctx]
+        for user_host in env.get('CFG_DATABASE_GRANT_HOSTS', ['%']):
+            ctx.update({'user_host': mysql_escape(user_host)})
+            sql.append("REVOKE ALL PRIVILEGES ON `%(name)s`.* FROM '%(user)s'@'%(user_host)s';" % ctx)
+        sql.append("FLUSH PRIVILEGES;")
 
-        local('mysql %(user_pw)s -h %(host)s -P %(port)s -e "DROP DATABASE IF EXISTS %(name)s"' % ctx)
-        with settings(warn_only=True):
-            for user_host in env.get('CFG_DATABASE_GRANT_HOSTS', ['%']):
-                ctx.update({'user_host': user_host})
-                local('mysql %(user_pw)s -h %(host)s -P %(port)s -e "REVOKE ALL PRIVILEGES ON %(name)s.* FROM %(user)s@\'%(user_host)s\'"' % ctx)
-        local('mysqladmin %(user_pw)s -h %(host)s -P %(port)s flush-privileges' % ctx)
+        # Revoking privileges which was never granted is not an error.
+        return mysql_admin_exec("\n".join(sql), stored_answers=stored_answers,
+                                ignore_errors=[1141, 1147, 1269])
 
 
 @task
@@ -105,45 +181,87 @@ def mysql_dropdb(stored_answers=None):
 def mysql_createdb(stored_answers=None,):
     """
     Create database and user
+
+    All statements are run as one SQL script in a single client session,
+    which also checks the MySQL admin credentials.
     """
     with hide('commands'):
         puts(cyan(">>> Creating database and user ..." % env))
 
-        answers = prompt_and_check([
-            ("MySQL admin user:", "user"),
-            ("MySQL admin password:", "password")
-        ], mysql_admin_check(env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
-        cache_key="mysql://%s:%s" % (env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
-        stored_answers=stored_answers)
-
-        # Escape quote characters
-        answers['password'] = answers['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-        user_pw = '-u %(user)s --password=%(password)s' % answers if answers['password'] else '-u %(user)s' % answers
-
         ctx = {
-            'user_pw': user_pw,
-            'host':  env.CFG_DATABASE_HOST,
             'name':  env.CFG_DATABASE_NAME,
-            'user':  env.CFG_DATABASE_USER,
-            'password': env.CFG_DATABASE_PASS,
-            'port': env.CFG_DATABASE_PORT,
+            'user':  mysql_escape(env.CFG_DATABASE_USER),
+            'password': mysql_escape(env.CFG_DATABASE_PASS),
         }
 
-        ctx['password'] = ctx['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-
-        # Run commands
-        local('mysql %(user_pw)s -h %(host)s -P %(port)s -e "CREATE DATABASE IF NOT EXISTS %(name)s DEFAULT CHARACTER SET utf8 COLLATE utf8_general_ci"' % ctx)
+        sql = ["CREATE DATABASE IF NOT EXISTS `%(name)s` DEFAULT CHARACTER SET utf8 COLLATE utf8_general_ci;" % ctx]
         for user_host in env.get('CFG_DATABASE_GRANT_HOSTS', ['%']):
-            ctx.update({'user_host': user_host})
-            local('mysql %(user_pw)s -h %(host)s -P %(port)s -e "GRANT ALL PRIVILEGES ON %(name)s.* TO %(user)s@\'%(user_host)s\' IDENTIFIED BY \'%(password)s\';"' % ctx)
-        local('mysqladmin %(user_pw)s -h %(host)s -P %(port)s flush-privileges' % ctx)
+            ctx.update({'user_host': mysql_escape(user_host)})
+            sql.append("GRANT ALL PRIVILEGES ON `%(name)s`.* TO '%(user)s'@'%(user_host)s' IDENTIFIED BY '%(password)s';" % ctx)
+        sql.append("FLUSH PRIVILEGES;")
+
+        return mysql_admin_exec("\n".join(sql), stored_answers=stored_answers)
 
 
 @task
 @roles('web')
-def mysql_dump(outputdir=None):
+def mysql_dump(outputdir=None, parallel=False, workers=None, master=False,
+               incremental=False, repository=False):
     """
     Dump database to file
+
+    By default the database is dumped to a single ``<name>.sql.gz`` file
+    (the extension depends on the compression codec ``env.CFG_DUMP_CODEC``,
+    see :data:`inveniofab.utils.CODECS`). If ``parallel`` is set, the tables
+    are instead dumped concurrently by ``workers`` (default
+    ``env.CFG_DATABASE_DUMP_WORKERS``) mysqldump processes into a dump
+    directory ``<name>.dump/`` (see :meth:`~mysql_dump_dir`).
+
+    If ``incremental`` is set, an existing dump directory is instead updated
+    with the binary log events since the last snapshot (see
+    :meth:`~mysql_dump_incremental`).
+
+    If ``repository`` is set, a new snapshot is added to the dump repository
+    ``<name>.repo/`` instead, which keeps the snapshots of the last
+    ``env.CFG_DATABASE_DUMP_RETENTION`` days and stores tables in
+    deduplicated chunks (see :meth:`~mysql_dump_repository`). Existing dumps
+    are not removed.
+
+    The dump is read from a slave in the ``db-slave`` role if one is
+    available and up to date (see :meth:`~mysql_source_host`). It is taken
+    in a single transaction if all tables are InnoDB tables, which gives a
+    consistent snapshot without blocking writes. Otherwise (e.g. MyISAM
+    tables, as most of the Invenio schema) the tables are locked for reading
+    while they are dumped, which blocks writes for the duration of the dump
+    (see :meth:`~mysql_consistency_opts`). Parallel and repository dumps are
+    taken as the MySQL admin user, which locks all tables until the
+    mysqldump processes have started their transaction, or until they have
+    finished if MyISAM tables are dumped, so they are consistent snapshots
+    as well (see :meth:`~mysql_dumper`).
+
+    :param outputdir: Directory to write the dump to (default
+        ``env.CFG_DATABASE_DUMPDIR``).
+    :param parallel: Set to ``True`` to dump tables in parallel.
+    :param workers: Number of concurrent mysqldump processes.
+    :param master: Set to ``True`` to always dump from the master.
+    :param incremental: Set to ``True`` to add an incremental snapshot to an
+        existing dump directory.
+    :param repository: Set to ``True`` to add a snapshot to the dump
+        repository.
+
+    Tables can be left out of the dump with the glob patterns in
+    ``env.CFG_DATABASE_DUMP_INCLUDE``, ``env.CFG_DATABASE_DUMP_EXCLUDE`` and
+    ``env.CFG_DATABASE_DUMP_SCHEMA_ONLY`` (see :meth:`~mysql_filter_tables`).
+    Their table definitions are still dumped, so they are re-created empty
+    when the dump is loaded.
+
+    A single file dump is accompanied by a ``<name>.sql.gz.manifest.json``
+    file with its size and MD5 checksum and the row count of each table,
+    which are used by :meth:`~mysql_verify`.
+
+    Progress is shown with ``pv`` if it is installed (see
+    :meth:`~mysql_progress`), and a summary of the dump is appended to the
+    statistics file (see :meth:`~mysql_stats`).
     """
     with hide('commands'):
         puts(cyan(">>> Dumping database ..." % env))
@@ -153,57 +271,163 @@ def mysql_dump(outputdir=None):
             'password': env.CFG_DATABASE_PASS,
         }
 
-        # Escape quote characters
-        answers['password'] = answers['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-
         if not outputdir:
             outputdir = env.CFG_DATABASE_DUMPDIR
 
         if not exists_local(outputdir):
             abort(red("Output directory %s does not exists" % outputdir))
 
-        user_pw = '-u %(user)s --password=%(password)s' % answers if answers['password'] else '-u %(user)s' % answers
+        if incremental:
+            return mysql_dump_incremental(
+                os.path.join(outputdir, "%s.dump" % env.CFG_DATABASE_NAME))
+
+        admin = None
+        if parallel or repository:
+            admin = prompt_and_check([
+                ("MySQL admin user:", "user"),
+                ("MySQL admin password:", "password")
+            ], mysql_admin_check(env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
+            cache_key="mysql://%s:%s" % (env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT))
+
+        host, port = mysql_source_host(env, admin, master=master)
+
+        if repository:
+            return mysql_dump_repository(
+                os.path.join(outputdir, "%s.repo" % env.CFG_DATABASE_NAME),
+                admin, workers=workers, host=host, port=port)
+
         outfile = os.path.join(outputdir, "%s.sql" % env.CFG_DATABASE_NAME)
-        outfile_gz = "%s.gz" % outfile
+        outfile_codec = "%s%s" % (outfile, codec_ext())
+        dumpdir = os.path.join(outputdir, "%s.dump" % env.CFG_DATABASE_NAME)
 
-        for f in [outfile, outfile_gz]:
+        existing = [outfile] + ["%s%s" % (outfile, x['ext']) for x in CODECS.values()]
+        for f in sorted(set(existing)) + [dumpdir]:
             if exists_local(f):
                 res = confirm("Remove existing DB dump in %s ?" % f)
                 if not res:
                     abort(red("Cannot continue") % env)
                 else:
-                    sudo_local("rm -Rf %s" % f)
+                    sudo_local("rm -Rf %s %s" % (f, mysql_manifest_file(f)))
+
+        if parallel:
+            return mysql_dump_dir(dumpdir, admin, workers=workers,
+                                  host=host, port=port)
 
         ctx = {
-            'user_pw': user_pw,
-            'host':  env.CFG_DATABASE_HOST,
+            'mysql_env': mysql_env(answers),
+            'mysql_args': mysql_args(answers, host, port),
             'name':  env.CFG_DATABASE_NAME,
-            'port': env.CFG_DATABASE_PORT,
-            'outfile_gz': outfile_gz,
+            'outfile_codec': outfile_codec,
             'outfile': outfile,
+            'opts': MYSQLDUMP_OPTS,
+            'compress': codec_compress_cmd(),
+            'ignore': '',
+            'skipped': '',
         }
 
+        start = time.time()
+
+        # Tables excluded or schema only are dumped without data
+        tables, skipped = mysql_filter_tables(mysql_tables(answers, host, port))
+        ctx['opts'] += " " + mysql_consistency_opts(
+            tables, mysql_table_engines(answers, host, port))
+        skipped_tables = skipped['excluded'] + skipped['schema_only']
+        if skipped_tables:
+            puts(">>> Dumping %s tables without data" % len(skipped_tables))
+            ctx['ignore'] = " ".join(["--ignore-table=%s.%s" % (ctx['name'], t) for t in skipped_tables])
+            ctx['skipped'] = "; mysqldump %s %s --no-data %s %s" % (
+                ctx['mysql_args'], ctx['opts'], ctx['name'], " ".join(skipped_tables))
+
+        sizes = mysql_table_sizes(answers, host, port)
+        ctx['progress'] = mysql_progress(
+            'dump', sum([sizes.get(t, (0, 0))[0] for t in tables]))
+
+        # Rows are counted from the dump, so they match the snapshot
+        ctx['python'] = mysql_python()
+        ctx['dumper'] = mysql_helper_script('dumper.py', outputdir)
+        ctx['rowsfile'] = os.path.join(outputdir, 'dumper.out')
+
         # Run commands
-        sudo_local('mysqldump %(user_pw)s -h %(host)s -P %(port)s --skip-opt '
-              '--add-drop-table --add-locks --create-options --quick '
-              '--extended-insert --set-charset --disable-keys %(name)s '
-              '| gzip -c > %(outfile_gz)s' % ctx, user=env.CFG_INVENIO_USER)
+        try:
+            sudo_local(mysql_script(
+                "%(mysql_env)s; (mysqldump %(mysql_args)s %(opts)s %(ignore)s "
+                "%(name)s%(skipped)s) | %(python)s %(dumper)s --count %(rowsfile)s "
+                "| %(progress)s | %(compress)s > %(outfile_codec)s" % ctx
+            ), user=env.CFG_INVENIO_USER)
+            counts = json.loads(read_file(ctx['rowsfile']))
+        finally:
+            sudo_local("rm -f %(dumper)s %(rowsfile)s" % ctx, user=env.CFG_INVENIO_USER)
+
+        puts(">>> Writing manifest ...")
+        rows = dict([(t, counts.get(t, 0)) for t in tables])
+        filename = os.path.basename(outfile_codec)
+        stats = mysql_file_stats(outputdir, [filename])
+        manifest = {
+            'version': 1,
+            'database': ctx['name'],
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'codec': codec_get(),
+            'skipped': skipped,
+            'file': dict(file=filename, **stats[filename]),
+            'tables': [dict(name=t, rows=rows[t]) for t in tables],
+        }
+        write_file(mysql_manifest_file(outfile_codec),
+                   json.dumps(manifest, indent=2, sort_keys=True), use_sudo=True)
+
+        mysql_stats('dump', start, mode='file', codec=manifest['codec'],
+                    tables=len(tables), rows=sum(rows.values()),
+                    bytes=stats[filename]['size'])
+        return outfile_codec
 
 
 @task
-def mysql_load(dumpfile=None, stored_answers=None):
+def mysql_load(dumpfile=None, stored_answers=None, workers=None,
+               incremental=False, snapshot=None, profile=None):
     """
     Load MySQL dump file
+
+    :param dumpfile: Either a single file dump (``.sql`` or compressed with any
+        of the supported codecs, which is detected from the file content) or a
+        dump directory created with ``mysql_dump:parallel=1`` or a dump
+        repository created with ``mysql_dump:repository=1``. Defaults to
+        the dump of the database found in ``env.CFG_DATABASE_DUMPDIR``.
+    :param workers: Number of concurrent connections used to load a dump
+        directory (default ``env.CFG_DATABASE_LOAD_WORKERS``). See
+        :meth:`~mysql_load_dir`.
+    :param incremental: Set to ``True`` to only replay the incremental
+        snapshots of a dump directory, which have not yet been applied to the
+        database (see :meth:`~mysql_replay_increments`).
+    :param snapshot: Snapshot of a dump repository to load (default the
+        latest). A prefix such as ``20130301`` selects the latest snapshot of
+        that day.
+    :param profile: Workload profile to switch the server to during the
+        load, e.g. ``bulk-load`` (default ``env.CFG_DATABASE_LOAD_PROFILE``,
+        i.e. none).
+
+    If a profile is given, its runtime settings are set as global variables
+    of the server (which may be shared with other databases) during the
+    load, and switched back afterwards (see :meth:`~mysql_profile_apply`).
+    They are not switched back if fab is killed during the load. As for
+    :meth:`~mysql_dump`, progress is shown with ``pv`` and a summary is
+    appended to the statistics file.
     """
     with hide('commands'):
         puts(cyan(">>> Loading database dump..."))
 
         if not dumpfile:
-            dumpfile = os.path.join(env.CFG_DATABASE_DUMPDIR, "%s.sql.gz" % env.CFG_DATABASE_NAME)
+            dumpfile = mysql_dumpfile(env.CFG_DATABASE_DUMPDIR)
 
         if not exists_local(dumpfile):
             abort("File %s does not exists." % dumpfile)
 
+        reader = None
+        if exists_local(os.path.join(dumpfile, 'snapshots')):
+            # The chunks are read from within the snapshot directory
+            dumpfile = mysql_host_path(dumpfile)
+            reader = mysql_repository_reader(dumpfile)
+            dumpfile = mysql_repository_snapshot(dumpfile, snapshot)
+            puts(">>> Loading snapshot %s" % dumpfile)
+
         answers = prompt_and_check([
             ("MySQL admin user:", "user"),
             ("MySQL admin password:", "password")
@@ -211,46 +435,89 @@ def mysql_load(dumpfile=None, stored_answers=None):
         cache_key="mysql://%s:%s" % (env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
         stored_answers=stored_answers)
 
-        # Escape quote characters
-        answers['password'] = answers['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-        user_pw = '-u %(user)s --password=%(password)s' % answers if answers['password'] else '-u %(user)s' % answers
+        is_dir = exists_local(os.path.join(dumpfile, MYSQL_DUMP_MANIFEST))
+        if incremental:
+            if not is_dir:
+                abort(red("Incremental load requires a dump directory."))
+            mysql_replay_increments(dumpfile, answers)
+            return dumpfile
 
-        if dumpfile.endswith(".gz"):
-            dumpfile_stream = "gunzip -c %s" % dumpfile
+        if is_dir:
+            dumpfile_stream = None
         else:
-            dumpfile_stream = "cat %s" % dumpfile
+            dumpfile_stream = "%s < %s | %s" % (
+                mysql_progress('load', mysql_file_size(dumpfile)), dumpfile,
+                codec_decompress_cmd(dumpfile))
 
         ctx = {
-            'user_pw': user_pw,
-            'host':  env.CFG_DATABASE_HOST,
+            'mysql_env': mysql_env(answers),
+            'mysql_args': mysql_args(answers, env.CFG_DATABASE_HOST,
+                                     env.CFG_DATABASE_PORT),
             'name':  env.CFG_DATABASE_NAME,
-            'user':  env.CFG_DATABASE_USER,
-            'password': env.CFG_DATABASE_PASS,
-            'port': env.CFG_DATABASE_PORT,
             'dumpfile': dumpfile,
             'dumpfile_stream': dumpfile_stream,
         }
 
-        # Escape quote characters
-        ctx['password'] = ctx['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-
         if confirm("This will erease all data in the existing database. Are you sure you want to load %(dumpfile)s?" % ctx):
             mysql_dropdb(stored_answers=answers)
             mysql_createdb(stored_answers=answers)
 
-            sudo_local('%(dumpfile_stream)s | mysql %(user_pw)s -h %(host)s -P %(port)s -f %(name)s' % ctx, user=env.CFG_INVENIO_USER)
+            saved = mysql_profile_apply(profile or env.CFG_DATABASE_LOAD_PROFILE)
+            try:
+                if is_dir:
+                    start = time.time()
+                    summary = mysql_load_dir(dumpfile, answers,
+                                             workers=workers, reader=reader)
+                    mysql_stats('load', start, mode='parallel', **summary)
+                    mysql_replay_increments(dumpfile, answers, reset=True)
+                else:
+                    start = time.time()
+                    sudo_local(mysql_script(
+                        "%(mysql_env)s; %(dumpfile_stream)s | mysql %(mysql_args)s -f %(name)s" % ctx
+                    ), user=env.CFG_INVENIO_USER)
+                    rows = None
+                    if exists_local(mysql_manifest_file(dumpfile)):
+                        manifest = json.loads(read_file(mysql_manifest_file(dumpfile)))
+                        rows = sum([t['rows'] for t in manifest['tables']])
+                    mysql_stats('load', start, mode='file', rows=rows,
+                                bytes=mysql_file_size(dumpfile))
+            finally:
+                mysql_profile_revert(saved)
 
         return dumpfile
 
 
 @task
-def mysql_copy(from_env):
+def mysql_copy(from_env, limit=None, restart=False, master=False):
     """
-    Copy database from latest available dump.
+    Copy database from another environment
+
+    The database is copied table by table, streaming each table from
+    mysqldump directly into the database of the active environment. Both
+    client connections use compression (``--compress``), and the bandwidth
+    can be capped with ``limit`` (requires ``pv``).
+
+    The database is read from a slave of the other environment if one is
+    available and up to date (see :meth:`~mysql_source_host`).
+
+    Tables matching ``env.CFG_DATABASE_DUMP_EXCLUDE`` or
+    ``env.CFG_DATABASE_DUMP_SCHEMA_ONLY`` (or not matching
+    ``env.CFG_DATABASE_DUMP_INCLUDE``) are copied without data.
 
-    Currently it is assumed that the dump file is accessible on the
-    same path on both environment host systems. This usually means that
-    the dumps are stored on a shared network storage.
+    Each finished table is recorded in a checkpoint file, so if the copy
+    fails, running the task again resumes with the remaining tables instead
+    of dropping and recreating the whole database.
+
+    Example::
+
+      fab int mysql_copy:prod,limit=10m
+
+    :param from_env: Name of environment to copy the database from.
+    :param limit: Maximum transfer rate in bytes per second, with optional
+        ``k``, ``m`` or ``g`` suffix (default ``env.CFG_DATABASE_COPY_LIMIT``).
+    :param restart: Set to ``True`` to ignore an existing checkpoint and copy
+        the entire database.
+    :param master: Set to ``True`` to always copy from the master.
     """
     with hide('commands'):
         to_env = env
@@ -266,58 +533,2020 @@ def mysql_copy(from_env):
             ("TO MySQL admin password:", "password")
         ], mysql_admin_check(to_env.CFG_DATABASE_HOST, to_env.CFG_DATABASE_PORT))
 
-        # Escape quote characters
-        answers_from['password'] = answers_from['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-        answers_to['password'] = answers_to['password'].replace("'", "\'").replace('"', '\"').replace('$', '\\$')
-
-        user_pw_from = '-u %(user)s --password=%(password)s' % answers_from if answers_from['password'] else '-u %(user)s' % answers_from
-        user_pw_to = '-u %(user)s --password=%(password)s' % answers_to if answers_to['password'] else '-u %(user)s' % answers_to
+        from_host, from_port = mysql_source_host(from_env, answers_from, master=master)
 
         ctx = {
-            'user_pw_from': user_pw_from,
-            'user_pw_to': user_pw_to,
-            'from_host' :  from_env.CFG_DATABASE_HOST,
+            'from_host' :  from_host,
             'from_name' :  from_env.CFG_DATABASE_NAME,
             'from_user' :  from_env.CFG_DATABASE_USER,
             'from_password' : from_env.CFG_DATABASE_PASS,
-            'from_port': from_env.CFG_DATABASE_PORT,
+            'from_port': from_port,
             'to_host' :  to_env.CFG_DATABASE_HOST,
             'to_name' :  to_env.CFG_DATABASE_NAME,
             'to_user' :  to_env.CFG_DATABASE_USER,
             'to_password' : to_env.CFG_DATABASE_PASS,
             'to_port': to_env.CFG_DATABASE_PORT,
+            'from_pwd': quote(answers_from['password'] or ''),
+            'to_pwd': quote(answers_to['password'] or ''),
+            'opts': MYSQLDUMP_OPTS,
         }
+        ctx['from_args'] = mysql_args(answers_from, ctx['from_host'], ctx['from_port'])
+        ctx['to_args'] = mysql_args(answers_to, ctx['to_host'], ctx['to_port'])
 
+        limit = limit or env.get('CFG_DATABASE_COPY_LIMIT', None)
+        # The copy pipeline runs on the local machine, not on env.host
+        with settings(hide('everything'), warn_only=True):
+            use_pv = local("command -v pv", capture=True).succeeded
+        if limit and not use_pv:
+            abort(red("pv must be installed to limit the transfer rate."))
 
         puts(">>> You are about to copy:")
         puts(">>>   %(from_user)s@%(from_host)s:%(from_port)s/%(from_name)s" % ctx)
         puts(">>> to:")
         puts(">>>   %(to_user)s@%(to_host)s:%(to_port)s/%(to_name)s" % ctx)
 
-        if confirm("This will erease all data in the latter database and may impact performance on system being copied from. Are you sure you want to proceed?"):
+        checkpoint = mysql_copy_checkpoint(from_env, to_env)
+        done = []
+        if restart and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if os.path.exists(checkpoint):
+            f = open(checkpoint, 'r')
+            done = [l.strip() for l in f if l.strip() and not l.startswith('#')]
+            f.close()
+
+        if done:
+            puts(">>> Resuming copy from checkpoint %s (%s tables already copied)" % (checkpoint, len(done)))
+            if not confirm("Resume copying the remaining tables?"):
+                abort(red("Cannot continue (use mysql_copy:%s,restart=1 to start over)" % from_env.env_name))
+        elif confirm("This will erease all data in the latter database and may impact performance on system being copied from. Are you sure you want to proceed?"):
             mysql_dropdb(stored_answers=answers_to)
             mysql_createdb(stored_answers=answers_to)
 
-        local('mysqldump %(user_pw_from)s -h %(from_host)s -P %(from_port)s -f %(from_name)s | mysql %(user_pw_to)s -h %(to_host)s -P %(to_port)s -f %(to_name)s' % ctx)
+        sizes = mysql_table_sizes(answers_from, ctx['from_host'], ctx['from_port'], ctx['from_name'])
+        engines = mysql_table_engines(answers_from, ctx['from_host'], ctx['from_port'], ctx['from_name'])
+        tables, skipped = mysql_filter_tables(mysql_tables(answers_from, ctx['from_host'], ctx['from_port'], ctx['from_name']))
+        skipped = skipped['excluded'] + skipped['schema_only']
+        tables = [t for t in tables + skipped if t not in done]
+
+        if not done:
+            f = open(checkpoint, 'w')
+            f.write("# mysql_copy %s -> %s\n" % (from_env.env_name, to_env.env_name))
+            f.close()
+
+        start = time.time()
+        total = sum([sizes.get(t, (0, 0))[0] for t in tables if t not in skipped])
+        copied = 0
+        for i, table in enumerate(tables):
+            elapsed = time.time() - start
+            eta = ""
+            if copied and elapsed:
+                eta = ", %.1f MB/s, ETA %s" % (copied / 1048576.0 / elapsed, time.strftime(
+                    "%H:%M:%S", time.gmtime((total - copied) * elapsed / copied)))
+            puts(">>> Copying table %s (%s/%s, %.0f/%.0f MB%s) ..." % (
+                table, i + 1 + len(done), len(tables) + len(done),
+                copied / 1048576.0, total / 1048576.0, eta))
+            ctx['table'] = table
+            ctx['opts'] = "%s %s%s" % (MYSQLDUMP_OPTS, mysql_consistency_opts([table], engines),
+                                       " --no-data" if table in skipped else "")
+            ctx['pv'] = ""
+            if use_pv:
+                ctx['pv'] = "| pv -f -N %s -s %s %s" % (table, sizes.get(table, (0, 0))[0], "-L %s " % limit if limit else "")
+            local(mysql_script(
+                "MYSQL_PWD=%(from_pwd)s mysqldump --compress %(from_args)s %(opts)s "
+                "%(from_name)s %(table)s %(pv)s | MYSQL_PWD=%(to_pwd)s mysql "
+                "--compress %(to_args)s %(to_name)s" % ctx
+            ))
+
+            f = open(checkpoint, 'a')
+            f.write("%s\n" % table)
+            f.close()
+            if table not in skipped:
+                copied += sizes.get(table, (0, 0))[0]
+
+        os.remove(checkpoint)
+        puts(cyan(">>> Copied %s tables" % (len(tables) + len(done))))
+        mysql_stats('copy', start, source=from_env.env_name, tables=len(tables),
+                    rows=sum([sizes.get(t, (0, 0))[1] for t in tables if t not in skipped]),
+                    bytes=copied)
+
+
+@task
+def mysql_verify(dumpfile=None, restore=False, workers=None,
+                 stored_answers=None, snapshot=None):
+    """
+    Verify the integrity of a database dump
+
+    Each file of the dump is streamed once through its decompressor (so
+    memory use is constant whatever the size of the dump), which checks the
+    compression integrity and that the SQL ends on a statement boundary
+    (``-- Dump completed`` for mysqldump output). The size and MD5 checksum
+    are compared with the manifest written by :meth:`~mysql_dump`. Files
+    of a dump directory are checked concurrently by ``workers`` processes.
+
+    For a dump repository, a snapshot is verified: the chunk list of each
+    table must have as many chunks as recorded in the manifest, and each
+    chunk must decompress to content matching the SHA1 checksum in its name
+    (see :meth:`~mysql_verify_chunks`).
+
+    If ``restore`` is set, the dump is also loaded into a scratch database
+    ``<name>_verify`` (in parallel for dump directories, without rebuilding
+    secondary indexes and without replaying incremental snapshots), the row
+    count of each table is compared with the manifest, and the scratch
+    database is dropped again. Row counts can differ if the database was
+    written to while it was dumped.
+
+    Aborts if any check fails, so it can be run e.g. from cron.
+
+    :param dumpfile: Dump file or directory (default: the dump in
+        ``env.CFG_DATABASE_DUMPDIR``, see :meth:`~mysql_dumpfile`).
+    :param restore: Set to ``True`` to restore into a scratch database.
+    :param workers: Number of concurrent processes (default
+        ``env.CFG_DATABASE_LOAD_WORKERS``).
+    :param snapshot: Snapshot of a dump repository, or a prefix of its name
+        (default: latest snapshot).
+    """
+    with hide('commands'):
+        puts(cyan(">>> Verifying database dump..."))
+        start = time.time()
+
+        if not dumpfile:
+            dumpfile = mysql_dumpfile(env.CFG_DATABASE_DUMPDIR)
+
+        if not exists_local(dumpfile):
+            abort("File %s does not exists." % dumpfile)
+
+        workers = int(workers or env.CFG_DATABASE_LOAD_WORKERS)
+        errors = []
+
+        repodir = None
+        if exists_local(os.path.join(dumpfile, 'snapshots')):
+            # The chunks are read from within the snapshot directory
+            repodir = mysql_host_path(dumpfile)
+            dumpfile = mysql_repository_snapshot(repodir, snapshot)
+            puts(">>> Verifying snapshot %s" % os.path.basename(dumpfile))
+
+        if exists_local(os.path.join(dumpfile, MYSQL_DUMP_MANIFEST)):
+            is_dir = True
+            basedir = dumpfile
+            manifest = mysql_read_manifest(dumpfile)
+            if repodir:
+                # The schema is dumped without comments, and the tables are
+                # chunk lists checked below.
+                files = [(manifest['schema'], 'statements')]
+            else:
+                files = [(manifest['schema'], 'mysqldump')] + \
+                    [(t, 'mysqldump') for t in manifest['tables']] + \
+                    [(i, 'statements') for i in manifest.get('increments', [])]
+        else:
+            is_dir = False
+            basedir = os.path.dirname(mysql_host_path(dumpfile))
+            if exists_local(mysql_manifest_file(dumpfile)):
+                manifest = json.loads(read_file(mysql_manifest_file(dumpfile)))
+                files = [(manifest['file'], 'mysqldump')]
+            else:
+                warn("No manifest found for %s - checksums and row counts are not verified." % dumpfile)
+                manifest = None
+                files = [({'file': os.path.basename(dumpfile)}, 'mysqldump')]
+
+        puts(">>> Checking %s files with %s workers ..." % (len(files), workers))
+        results = mysql_verify_files(basedir, [f['file'] for f, kind in files], workers)
+        for f, kind in files:
+            res = results.get(f['file'])
+            if not res:
+                errors.append("%s: not checked" % f['file'])
+                continue
+            if res['status'] != 0:
+                errors.append("%s: cannot be decompressed (corrupt or truncated)" % f['file'])
+                continue
+            if 'size' in f and res['size'] != f['size']:
+                errors.append("%s: size %s differs from manifest (%s)" % (f['file'], res['size'], f['size']))
+            if 'md5' in f and res['md5'] != f['md5']:
+                errors.append("%s: MD5 checksum %s differs from manifest (%s)" % (f['file'], res['md5'], f['md5']))
+            if kind == 'mysqldump' and not res['last'].startswith("-- Dump completed"):
+                errors.append("%s: dump is incomplete (last line: %s)" % (f['file'], res['last'][:80]))
+            elif kind == 'statements' and not res['last'].endswith(";"):
+                errors.append("%s: dump does not end on a statement boundary" % f['file'])
+
+        if repodir:
+            errors += mysql_verify_chunks(repodir, dumpfile, manifest, workers)
+
+        if restore and not errors:
+            if not manifest:
+                abort(red("Cannot compare row counts without a manifest."))
+            errors += mysql_verify_restore(
+                dumpfile, manifest, is_dir, workers, stored_answers,
+                reader=mysql_repository_reader(repodir) if repodir else None)
+
+        for e in errors:
+            puts(red(">>>   %s" % e))
+        if errors:
+            abort(red("Dump %s failed verification (%s errors)." % (dumpfile, len(errors))))
+
+        puts(cyan(">>> Dump %s verified in %.1fs" % (dumpfile, time.time() - start)))
+        return dumpfile
 
 
 #
 # Helpers
 #
 
-def mysql_admin_check(host, port):
-    def _mysql_admin_check(answers):
-        ctx = {'host': host, 'port': port}
-        ctx.update(answers)
-        try:
-            if answers['password']:
-                res = local("""mysql -u %(user)s --password=%(password)s -h %(host)s -P %(port)s -e 'SELECT 1'""" % ctx)
+def mysql_dump_dir(dumpdir, answers, workers=None, host=None, port=None,
+                   name=None):
+    """
+    Dump database tables in parallel to a dump directory
+
+    The dump directory contains:
+
+     * ``schema.sql.gz`` - table definitions of all tables.
+     * ``tables/<table>.sql.gz`` - data of each table.
+     * ``manifest.json`` - codec, row count, size and MD5 checksum of each
+       file, the tables which were dumped without data (see
+       :meth:`~mysql_filter_tables`), as well as the binary log position
+       the tables were dumped at (if binary logging is enabled).
+
+    The files are compressed with the codec ``env.CFG_DUMP_CODEC`` (the
+    extension of the files varies accordingly). All tables are dumped from
+    the same point in time (see :meth:`~mysql_dumper`).
+
+    :param dumpdir: Dump directory to create.
+    :param answers: Dictionary with ``user`` and ``password`` keys. The user
+        needs the ``RELOAD`` and ``REPLICATION CLIENT`` privileges to lock
+        the tables and read the binary log position.
+    :param workers: Number of concurrent mysqldump processes (default
+        ``env.CFG_DATABASE_DUMP_WORKERS``).
+    """
+    ctx = {
+        'mysql_env': mysql_env(answers),
+        'mysql_args': mysql_args(answers, host or env.CFG_DATABASE_HOST,
+                                 port or env.CFG_DATABASE_PORT),
+        'name': name or env.CFG_DATABASE_NAME,
+        'dumpdir': dumpdir,
+        'workers': int(workers or env.CFG_DATABASE_DUMP_WORKERS),
+        'opts': MYSQLDUMP_OPTS,
+        'codec': codec_get(),
+        'ext': codec_ext(),
+        'compress': codec_compress_cmd(),
+    }
+
+    start = time.time()
+    tables = mysql_tables(answers, host, port, name)
+    if not tables:
+        abort(red("No tables found in database %(name)s" % ctx))
+    tables, skipped = mysql_filter_tables(tables)
+    groups = mysql_dump_groups(tables, mysql_table_sizes(answers, host, port, name),
+                               ctx['workers'])
+
+    sudo_local("mkdir -p %s" % os.path.join(dumpdir, 'tables'), user=env.CFG_INVENIO_USER)
+
+    puts(">>> Dumping schema of %s tables ..." % (
+        len(tables) + len(skipped['excluded']) + len(skipped['schema_only'])))
+    sudo_local(mysql_script(
+        "%(mysql_env)s; mysqldump %(mysql_args)s %(opts)s --no-data %(name)s "
+        "| %(compress)s > %(dumpdir)s/schema.sql%(ext)s" % ctx
+    ), user=env.CFG_INVENIO_USER)
+
+    puts(">>> Dumping data of %s tables with %s workers ..." % (len(tables), len(groups)))
+    result = mysql_dumper(
+        dumpdir, groups, '%(compress)s > "$1".sql%(ext)s' % ctx,
+        os.path.join(dumpdir, 'tables'), answers, host, port, name,
+        opts="%(opts)s --no-create-info" % ctx)
+    binlog = result['binlog']
+    if binlog:
+        puts(">>> Binary log position: %(file)s:%(position)s" % binlog)
+
+    puts(">>> Writing manifest ...")
+    rows = dict([(t, result['tables'][t]['rows']) for t in tables])
+    schema = 'schema.sql%(ext)s' % ctx
+    files = [schema] + ['tables/%s.sql%s' % (t, ctx['ext']) for t in tables]
+    stats = mysql_file_stats(dumpdir, files)
+
+    manifest = {
+        'version': 1,
+        'database': ctx['name'],
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'codec': ctx['codec'],
+        'binlog': binlog,
+        'increments': [],
+        'skipped': skipped,
+        'schema': dict(file=schema, **stats[schema]),
+        'tables': [],
+    }
+    for t in tables:
+        f = 'tables/%s.sql%s' % (t, ctx['ext'])
+        manifest['tables'].append(dict(name=t, file=f, rows=rows[t], **stats[f]))
+
+    mysql_write_manifest(dumpdir, manifest)
+
+    mysql_stats('dump', start, mode='parallel', codec=ctx['codec'],
+                tables=len(tables), rows=sum(rows.values()),
+                bytes=sum([x['size'] for x in stats.values()]))
+    return dumpdir
+
+
+def mysql_dump_repository(repodir, answers, workers=None, host=None,
+                          port=None, name=None):
+    """
+    Add a snapshot of the database to a dump repository
+
+    The dump repository contains:
+
+     * ``chunks/<xx>/<sha1>.gz`` - chunks of table data, stored by the hash
+       of their content (see :mod:`inveniofab.chunker`).
+     * ``snapshots/<YYYYmmdd-HHMMSS>/`` - one directory per snapshot, laid
+       out like a dump directory (see :meth:`~mysql_dump_dir`), except that
+       ``tables/<table>.chunks`` lists the chunks of each table.
+
+    Tables are dumped in parallel by ``workers`` processes from the same
+    point in time (see :meth:`~mysql_dumper`) and split into content-defined
+    chunks, so only chunks which changed since any retained snapshot take
+    new disk space. Tables whose fingerprint (update time, row count and
+    data length from ``information_schema``, or ``CHECKSUM TABLE`` for
+    engines not tracking update times) did not change since the previous
+    snapshot are not dumped at all, but reuse its chunk list. Fingerprints
+    are read just before the tables are locked, so a table changing in
+    between is only picked up by the next snapshot.
+
+    The MySQL user needs the ``RELOAD`` and ``REPLICATION CLIENT``
+    privileges, as for :meth:`~mysql_dump_dir`.
+
+    Snapshots older than ``env.CFG_DATABASE_DUMP_RETENTION`` days are removed
+    afterwards (see :meth:`~mysql_repository_prune`).
+    """
+    ctx = {
+        'mysql_env': mysql_env(answers),
+        'mysql_args': mysql_args(answers, host or env.CFG_DATABASE_HOST,
+                                 port or env.CFG_DATABASE_PORT),
+        'name': name or env.CFG_DATABASE_NAME,
+        'repodir': repodir,
+        'workers': int(workers or env.CFG_DATABASE_DUMP_WORKERS),
+        'opts': MYSQLDUMP_OPTS.replace('--extended-insert', '--skip-extended-insert'),
+        'codec': codec_get(),
+        'ext': codec_ext(),
+        'compress': codec_compress_cmd(),
+        'python': mysql_python(),
+        'snapshot': time.strftime("%Y%m%d-%H%M%S"),
+    }
+    ctx['snapdir'] = os.path.join(repodir, 'snapshots', ctx['snapshot'])
+    start = time.time()
+
+    if exists_local(ctx['snapdir']):
+        abort(red("Snapshot %(snapshot)s already exists in %(repodir)s" % ctx))
+
+    tables = mysql_tables(answers, host, port, name)
+    if not tables:
+        abort(red("No tables found in database %(name)s" % ctx))
+    tables, skipped = mysql_filter_tables(tables)
+
+    previous = mysql_repository_snapshots(repodir)
+    if previous:
+        ctx['prevdir'] = os.path.join(repodir, 'snapshots', previous[-1])
+        prev_tables = dict([(t['name'], t) for t in
+                            mysql_read_manifest(ctx['prevdir'])['tables']])
+    else:
+        prev_tables = {}
+
+    sudo_local("mkdir -p %(snapdir)s/tables %(repodir)s/chunks" % ctx, user=env.CFG_INVENIO_USER)
+    ctx['chunker'] = mysql_helper_script('chunker.py', repodir)
+
+    fingerprints = mysql_table_fingerprints(tables, answers, host, port, name)
+    unchanged = [t for t in tables if t in prev_tables and fingerprints.get(t)
+                 and prev_tables[t].get('fingerprint') == fingerprints[t]]
+    changed = [t for t in tables if t not in unchanged]
+
+    try:
+        puts(">>> Dumping schema of %s tables ..." % (
+            len(tables) + len(skipped['excluded']) + len(skipped['schema_only'])))
+        sudo_local(mysql_script(
+            "%(mysql_env)s; mysqldump %(mysql_args)s %(opts)s --skip-comments "
+            "--no-data %(name)s | %(compress)s > %(snapdir)s/schema.sql%(ext)s" % ctx
+        ), user=env.CFG_INVENIO_USER)
+
+        if unchanged:
+            puts(">>> Reusing %s unchanged tables of snapshot %s" % (len(unchanged), previous[-1]))
+            ctx['lists'] = " ".join([quote("%s.chunks" % t) for t in unchanged])
+            sudo_local("cd %(prevdir)s/tables && cp %(lists)s %(snapdir)s/tables/" % ctx,
+                       user=env.CFG_INVENIO_USER)
+
+        stats = {}
+        if changed:
+            groups = mysql_dump_groups(
+                changed, mysql_table_sizes(answers, host, port, name), ctx['workers'])
+            puts(">>> Dumping data of %s tables with %s workers ..." % (len(changed), len(groups)))
+            result = mysql_dumper(
+                ctx['snapdir'], groups,
+                '%(python)s %(chunker)s %(repodir)s/chunks %(ext)s %(compress)s "$1".chunks'
+                % dict(ctx, compress=quote(ctx['compress'])),
+                os.path.join(ctx['snapdir'], 'tables'), answers, host, port, name,
+                opts="%(opts)s --skip-comments --no-create-info" % ctx)
+            binlog = result['binlog']
+            for t, res in result['tables'].items():
+                parts = res['output'].split()
+                if len(parts) == 5 and parts[0] == 'CHUNKED':
+                    stats[t] = [int(x) for x in parts[1:]] + [res['rows']]
+        else:
+            # Nothing to lock, the reused tables are as of the current position
+            binlog = mysql_master_status(answers, host, port)
+
+        schema = 'schema.sql%(ext)s' % ctx
+        manifest = {
+            'version': 1,
+            'database': ctx['name'],
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'snapshot': ctx['snapshot'],
+            'codec': ctx['codec'],
+            'binlog': binlog,
+            'increments': [],
+            'skipped': skipped,
+            'schema': dict(file=schema, **mysql_file_stats(ctx['snapdir'], [schema])[schema]),
+            'tables': [],
+        }
+        new_chunks = new_bytes = dumped_rows = dumped_bytes = 0
+        for t in tables:
+            entry = {'name': t, 'file': 'tables/%s.chunks' % t,
+                     'fingerprint': fingerprints.get(t)}
+            if t in unchanged:
+                entry.update(rows=prev_tables[t]['rows'], size=prev_tables[t]['size'],
+                             chunks=prev_tables[t]['chunks'])
             else:
-                res = local("""mysql -u %(user)s -h %(host)s -P %(port)s -e 'SELECT 1'""" % ctx)
+                chunks, new, size, written, rows = stats.get(t, [0, 0, 0, 0, 0])
+                entry.update(rows=rows, size=size, chunks=chunks)
+                new_chunks += new
+                new_bytes += written
+                dumped_rows += rows
+                dumped_bytes += size
+            manifest['tables'].append(entry)
+        mysql_write_manifest(ctx['snapdir'], manifest)
+    except SystemExit:
+        # Do not leave a partial snapshot behind
+        sudo_local("rm -Rf %(snapdir)s" % ctx, user=env.CFG_INVENIO_USER)
+        raise
+
+    puts(">>> Snapshot %s: %s tables dumped, %s unchanged, %s new chunks (%.1f MB)" % (
+        ctx['snapshot'], len(changed), len(unchanged), new_chunks, new_bytes / 1048576.0))
+
+    mysql_stats('dump', start, mode='repository', codec=ctx['codec'],
+                tables=len(changed), unchanged=len(unchanged), rows=dumped_rows,
+                bytes=dumped_bytes, new_chunks=new_chunks, new_bytes=new_bytes)
+
+    mysql_repository_prune(repodir)
+    return ctx['snapdir']
+
+
+def mysql_dumper(workdir, groups, sink, sinkdir, answers, host=None,
+                 port=None, name=None, opts=MYSQLDUMP_OPTS):
+    """
+    Dump tables concurrently from one consistent snapshot with the helper
+    script ``dumper.py`` (see :mod:`inveniofab.dumper`)
+
+    The tables are locked with ``FLUSH TABLES WITH READ LOCK`` and the
+    binary log position is read, then one ``mysqldump --single-transaction``
+    process per group of tables is started, and the lock is released as soon
+    as all of them have started their transaction. A transaction is only a
+    snapshot of InnoDB tables, so if any table uses another engine (e.g.
+    MyISAM), the lock is held until all groups are dumped, which blocks
+    writes for the duration of the dump. If the tables cannot be locked
+    (e.g. the user lacks the ``RELOAD`` privilege), a warning is shown and
+    each group is dumped in its own transaction without binary log position.
+
+    :param workdir: Directory for the script, its configuration and result
+        (removed afterwards).
+    :param groups: Lists of tables dumped by each worker (see
+        :meth:`~mysql_dump_groups`).
+    :param sink: Shell command writing the dump of table ``$1`` from its
+        standard input, run in ``sinkdir``.
+    :param opts: Options of mysqldump.
+    :return: Dictionary with the binary log position ``binlog`` (``None`` if
+        unknown) and the output of the sink of each table in ``tables``.
+    """
+    host = host or env.CFG_DATABASE_HOST
+    port = port or env.CFG_DATABASE_PORT
+    engines = mysql_table_engines(answers, host, port, name)
+    client = ['-u', answers['user'], '-h', str(host), '-P', str(port)]
+    config = {
+        'mysql': ['mysql'] + client,
+        'mysqldump': ['mysqldump'] + client + opts.split() +
+                     ['--single-transaction', name or env.CFG_DATABASE_NAME],
+        'hold': mysql_consistency_opts(sum(groups, []), engines) != '--single-transaction',
+        'groups': groups,
+        'sink': sink,
+        'dir': sinkdir,
+        'result': os.path.join(workdir, 'dumper.out'),
+    }
+    ctx = {
+        'mysql_env': mysql_env(answers),
+        'python': mysql_python(),
+        'dumper': mysql_helper_script('dumper.py', workdir),
+        'config': os.path.join(workdir, 'dumper.json'),
+        'result': config['result'],
+        'progress': mysql_progress('tables', sum([len(g) for g in groups]), lines=True),
+    }
+    write_file(ctx['config'], json.dumps(config), use_sudo=True)
+    try:
+        sudo_local(mysql_script(
+            "%(mysql_env)s; %(python)s %(dumper)s %(config)s | %(progress)s > /dev/null" % ctx
+        ), user=env.CFG_INVENIO_USER)
+        result = json.loads(read_file(ctx['result']))
+    finally:
+        sudo_local("rm -f %(dumper)s %(config)s %(result)s" % ctx, user=env.CFG_INVENIO_USER)
+
+    if result['binlog']:
+        result['binlog'].update(host=host, port=port)
+    return result
+
+
+def mysql_dump_groups(tables, sizes, workers):
+    """
+    Distribute tables over at most ``workers`` groups of about the same size
+    (largest table first to the smallest group).
 
-            return True
-        except SystemExit:
+    :param sizes: Table sizes from :meth:`~mysql_table_sizes`.
+    """
+    groups = [[] for i in range(min(int(workers), len(tables)))]
+    totals = [0] * len(groups)
+    for t in sorted(tables, key=lambda t: sizes.get(t, (0, 0))[0], reverse=True):
+        i = totals.index(min(totals))
+        groups[i].append(t)
+        totals[i] += sizes.get(t, (0, 0))[0] + 1
+    return groups
+
+
+def mysql_helper_script(script, directory):
+    """
+    Copy a helper script of the package (e.g. ``chunker.py``) to a directory
+    on the host, to be run there. Returns the path of the copy.
+    """
+    path = os.path.join(directory, script)
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    write_file(path, open(source).read(), use_sudo=True)
+    return path
+
+
+def mysql_python():
+    """
+    Python interpreter running the helper scripts on the host: the one of
+    the virtual environment in ``env.CFG_INVENIO_PREFIX`` if it exists, else
+    ``python`` (``env.PYTHON`` is the interpreter of the machine running
+    fab, which usually does not exist on the host).
+    """
+    python = os.path.join(env.CFG_INVENIO_PREFIX, 'bin/python')
+    return python if exists_local(python) else 'python'
+
+
+def mysql_repository_snapshots(repodir):
+    """ List complete snapshots of a dump repository, oldest first """
+    if not exists_local(os.path.join(repodir, 'snapshots')):
+        return []
+    with hide('commands'):
+        output = run_local("cd %s && ls -1d */%s 2>/dev/null; true" % (
+            os.path.join(repodir, 'snapshots'), MYSQL_DUMP_MANIFEST), capture=True)
+    snapshots = []
+    for s in [os.path.dirname(f) for f in output.split()]:
+        try:
+            time.strptime(s, "%Y%m%d-%H%M%S")
+            snapshots.append(s)
+        except ValueError:
+            pass
+    return sorted(snapshots)
+
+
+def mysql_repository_snapshot(repodir, snapshot=None):
+    """
+    Get directory of a snapshot in a dump repository. ``snapshot`` can be a
+    prefix of the snapshot name, in which case the latest match is used.
+    """
+    snapshots = mysql_repository_snapshots(repodir)
+    matches = [s for s in snapshots if s.startswith(snapshot or '')]
+    if not matches:
+        abort(red("No snapshot %s in %s (available: %s)" % (
+            snapshot, repodir, ", ".join(snapshots) or "none")))
+    return os.path.join(repodir, 'snapshots', matches[-1])
+
+
+def mysql_repository_prune(repodir, retention=None):
+    """
+    Remove snapshots older than ``retention`` days (default
+    ``env.CFG_DATABASE_DUMP_RETENTION``) from a dump repository, and the
+    chunks no longer used by any remaining snapshot. The latest snapshot is
+    always kept.
+    """
+    if retention is None:
+        retention = env.CFG_DATABASE_DUMP_RETENTION
+    cutoff = time.time() - float(retention) * 86400
+
+    snapshots = mysql_repository_snapshots(repodir)
+    expired = [s for s in snapshots[:-1]
+               if time.mktime(time.strptime(s, "%Y%m%d-%H%M%S")) < cutoff]
+    if not expired:
+        return
+
+    puts(">>> Removing %s expired snapshots ..." % len(expired))
+    ctx = {
+        'repodir': repodir,
+        'expired': " ".join(["snapshots/%s" % s for s in expired]),
+    }
+    sudo_local(mysql_script(
+        "cd %(repodir)s && rm -Rf %(expired)s && "
+        "(cat snapshots/*/tables/*.chunks; true) | sort -u > chunks.live && "
+        "(cd chunks && find . -type f ! -name '*.tmp' | sed 's|^\\./||' | sort) "
+        "| comm -23 - chunks.live | (cd chunks && xargs -r rm -f) && rm -f chunks.live" % ctx
+    ), user=env.CFG_INVENIO_USER)
+
+
+def mysql_repository_reader(repodir):
+    """
+    Shell command writing the SQL of the chunk list ``$1`` of a dump
+    repository to stdout (for :meth:`~mysql_load_dir`). Chunks are
+    decompressed according to their extension.
+    """
+    return 'while read c; do %s < %s/chunks/"$c" || exit 1; done < "$1"' % (
+        mysql_chunk_decompress('c'), repodir)
+
+
+def mysql_chunk_decompress(var):
+    """
+    Shell command decompressing stdin according to the extension of the
+    chunk named by the shell variable ``var``
+    """
+    cases = []
+    for ext in sorted(set([c['ext'] for c in CODECS.values()])):
+        codecs = [n for n, c in CODECS.items() if c['ext'] == ext]
+        codec = CODECS[sorted(codecs, key=lambda n: not command_available(CODECS[n]['tool']))[0]]
+        cases.append("*%s) %s;;" % (ext, codec['decompress']))
+    return 'case "$%s" in %s *) cat;; esac' % (var, " ".join(cases))
+
+
+def mysql_verify_chunks(repodir, snapdir, manifest, workers):
+    """
+    Check the chunks of a snapshot in a dump repository: the chunk list of
+    each table must have as many chunks as recorded in the manifest, and each
+    chunk must decompress to content matching the SHA1 checksum in its name.
+    Chunks are checked concurrently by ``workers`` processes.
+
+    :return: List of errors.
+    """
+    tables = manifest['tables']
+    if not tables:
+        return []
+    errors = []
+    ctx = {
+        'repodir': repodir,
+        'snapdir': snapdir,
+        'workers': workers,
+        'lists': " ".join([quote(t['file']) for t in tables]),
+    }
+
+    with hide('commands'):
+        output = run_local("cd %(snapdir)s && wc -l %(lists)s 2>/dev/null; true" % ctx,
+                           capture=True)
+    counts = {}
+    for line in output.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2 and parts[0].isdigit():
+            counts[parts[1]] = int(parts[0])
+    for t in tables:
+        if counts.get(t['file']) != t['chunks']:
+            errors.append("%s: %s chunks listed, manifest has %s" % (
+                t['file'], counts.get(t['file']), t['chunks']))
+
+    with hide('everything'):
+        ctx['results'] = run_local("mktemp", capture=True).strip()
+    ctx['worker'] = quote(
+        "set -o pipefail; h=$(%s < \"$1\" | sha1sum | cut -c 1-40); "
+        "printf 'CHUNK\\t%%s\\t%%s\\t%%s\\n' \"$1\" $? $h" % mysql_chunk_decompress('1'))
+    ctx['progress'] = mysql_progress('chunks', sum([t['chunks'] for t in tables]), lines=True)
+    try:
+        puts(">>> Checking chunks with %s workers ..." % workers)
+        run_local(mysql_script(
+            "(cd %(snapdir)s && cat %(lists)s 2>/dev/null; true) | sort -u | (cd %(repodir)s/chunks "
+            "&& xargs -n 1 -P %(workers)s bash -c %(worker)s _) | %(progress)s > %(results)s" % ctx
+        ))
+        with hide('commands'):
+            output = read_file(ctx['results'])
+    finally:
+        with hide('commands'):
+            run_local("rm -f %(results)s" % ctx)
+
+    checked = 0
+    for line in output.splitlines():
+        parts = line.rstrip("\r").split("\t")
+        if len(parts) != 4 or parts[0] != 'CHUNK':
+            continue
+        checked += 1
+        if parts[2] != '0':
+            errors.append("chunks/%s: cannot be decompressed (corrupt, truncated or missing)" % parts[1])
+        elif not os.path.basename(parts[1]).startswith(parts[3]):
+            errors.append("chunks/%s: SHA1 checksum %s differs from name" % (parts[1], parts[3]))
+    puts(">>> Checked %s chunks" % checked)
+    return errors
+
+
+def mysql_table_fingerprints(tables, answers, host=None, port=None, name=None):
+    """
+    Get a fingerprint of each table which changes when its content changes:
+    update time, row count and data length from ``information_schema``, or
+    the live checksum for tables without update time (e.g. InnoDB before
+    MySQL 5.7).
+    """
+    name = name or env.CFG_DATABASE_NAME
+    fingerprints = {}
+    for t, update_time, rows, length in mysql_query(
+            "SELECT TABLE_NAME, IFNULL(UPDATE_TIME, '-'), TABLE_ROWS, DATA_LENGTH "
+            "FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%s'" % name,
+            answers, host, port, name):
+        if update_time != '-':
+            fingerprints[t] = "%s/%s/%s" % (update_time, rows, length)
+
+    missing = [t for t in tables if t not in fingerprints]
+    if missing:
+        for t, checksum in mysql_query(
+                "CHECKSUM TABLE %s" % ", ".join(["`%s`" % t for t in missing]),
+                answers, host, port, name):
+            fingerprints[t.split(".", 1)[-1]] = "checksum/%s" % checksum
+    return fingerprints
+
+
+def mysql_dump_incremental(dumpdir):
+    """
+    Add an incremental snapshot to a dump directory
+
+    The binary log events of the database since the position of the last
+    snapshot (recorded in the manifest) are read with ``mysqlbinlog`` from
+    the same host the dump directory was created from, and stored in
+    ``incremental/<number>.sql.gz``. The events can be replayed onto a
+    previously loaded copy with ``mysql_load:incremental=1``.
+
+    The host must have binary logging enabled, and the MySQL admin user must
+    have the ``REPLICATION SLAVE`` and ``REPLICATION CLIENT`` privileges.
+    Binary logging can be enabled on a local mysqld for testing by adding
+    ``log-bin`` and ``server-id=1`` to ``my.cnf``.
+
+    The binary log position of the base snapshot is read while the tables
+    are locked for the dump (see :meth:`~mysql_dumper`), so each event is
+    either part of the dump or replayed, never both.
+
+    The whole cycle can be checked by hand against such a local mysqld:
+
+    #. ``fab <env> mysql_dump:parallel=1`` and ``fab <env> mysql_load`` into
+       a second environment (another ``CFG_DATABASE_NAME``).
+    #. Insert, update and delete some rows in the first database.
+    #. ``fab <env> mysql_dump:incremental=1`` and ``fab <env>
+       mysql_load:incremental=1`` into the second environment.
+    #. ``CHECKSUM TABLE`` of each table must be the same in both databases.
+    """
+    if not exists_local(os.path.join(dumpdir, MYSQL_DUMP_MANIFEST)):
+        abort(red("No dump directory found in %s - create a full dump with mysql_dump:parallel=1 first." % dumpdir))
+
+    manifest = mysql_read_manifest(dumpdir)
+    binlog = manifest.get('binlog')
+    if not binlog:
+        abort(red("Dump in %s has no binary log position (is binary logging enabled?)" % dumpdir))
+
+    answers = prompt_and_check([
+        ("MySQL admin user:", "user"),
+        ("MySQL admin password:", "password")
+    ], mysql_admin_check(binlog['host'], binlog['port']),
+    cache_key="mysql://%s:%s" % (binlog['host'], binlog['port']))
+    answers = dict(answers)
+
+    increments = manifest.setdefault('increments', [])
+    start = increments[-1]['end'] if increments else binlog
+    end = mysql_master_status(answers, binlog['host'], binlog['port'])
+    if not end:
+        abort(red("Binary logging is not enabled on %(host)s:%(port)s" % binlog))
+
+    if (start['file'], int(start['position'])) == (end['file'], int(end['position'])):
+        puts(">>> No changes since last snapshot (%(file)s:%(position)s)" % end)
+        return dumpdir
+
+    logs = [r[0] for r in mysql_query("SHOW BINARY LOGS", answers, binlog['host'], binlog['port'])]
+    if start['file'] not in logs:
+        abort(red("Binary log %s has been purged - a new full dump is needed." % start['file']))
+    logs = logs[logs.index(start['file']):logs.index(end['file']) + 1]
+
+    ctx = {
+        'mysql_env': mysql_env(answers),
+        'mysql_args': mysql_args(answers, binlog['host'], binlog['port']),
+        'name': manifest['database'],
+        'start': start['position'],
+        'end': end['position'],
+        'logs': " ".join(logs),
+        'compress': codec_compress_cmd(manifest.get('codec')),
+        'file': "incremental/%04d.sql%s" % (len(increments) + 1, codec_ext(manifest.get('codec'))),
+        'dumpdir': dumpdir,
+    }
+
+    puts(">>> Dumping binary log from %s:%s to %s:%s ..." % (
+        start['file'], start['position'], end['file'], end['position']))
+    sudo_local("mkdir -p %s" % os.path.join(dumpdir, 'incremental'), user=env.CFG_INVENIO_USER)
+    sudo_local(mysql_script(
+        "%(mysql_env)s; mysqlbinlog --read-from-remote-server %(mysql_args)s "
+        "--database=%(name)s --start-position=%(start)s --stop-position=%(end)s "
+        "%(logs)s | %(compress)s > %(dumpdir)s/%(file)s" % ctx
+    ), user=env.CFG_INVENIO_USER)
+
+    stats = mysql_file_stats(dumpdir, [ctx['file']])
+    increments.append(dict(
+        file=ctx['file'],
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        start=start,
+        end=end,
+        **stats[ctx['file']]
+    ))
+    mysql_write_manifest(dumpdir, manifest)
+
+    return dumpdir
+
+
+def mysql_replay_increments(dumpdir, answers, host=None, port=None, name=None,
+                            reset=False):
+    """
+    Replay incremental snapshots of a dump directory onto a database
+
+    The number of increments applied to a database is recorded in
+    ``applied/<host>_<port>_<name>`` in the dump directory, so only new
+    increments are replayed. Set ``reset`` after a full load of the dump
+    directory to replay all increments.
+
+    If the target database has a different name than the dumped database,
+    ``use`` statements are rewritten accordingly. This only works with
+    statement based binary logging.
+    """
+    manifest = mysql_read_manifest(dumpdir)
+    host = host or env.CFG_DATABASE_HOST
+    port = port or env.CFG_DATABASE_PORT
+    name = name or env.CFG_DATABASE_NAME
+
+    statefile = os.path.join(dumpdir, 'applied', "%s_%s_%s" % (host, port, name))
+    applied = 0
+    if not reset:
+        if not exists_local(statefile):
+            abort(red("Database %s has not been loaded from %s - cannot replay increments." % (name, dumpdir)))
+        applied = int(read_file(statefile).strip())
+
+    increments = manifest.get('increments', [])[applied:]
+    if not increments:
+        puts(">>> No incremental snapshots to replay")
+    else:
+        ctx = {
+            'mysql_env': mysql_env(answers),
+            'mysql_args': mysql_args(answers, host, port),
+            'name': name,
+            'dumpdir': dumpdir,
+        }
+        for inc in increments:
+            puts(">>> Replaying %(file)s (%(start)s to %(end)s) ..." % dict(
+                file=inc['file'],
+                start="%(file)s:%(position)s" % inc['start'],
+                end="%(file)s:%(position)s" % inc['end']))
+            ctx['file'] = inc['file']
+            ctx['decompress'] = codec_decompress_cmd(os.path.join(dumpdir, inc['file']))
+            ctx['rewrite'] = ""
+            if manifest['database'] != name:
+                # Rewrite statements for the source database to the target
+                # database (row based events cannot be rewritten).
+                ctx['rewrite'] = "| sed -e %s" % quote(
+                    "s/^use `%s`/use `%s`/" % (manifest['database'], name))
+            sudo_local(mysql_script(
+                "%(mysql_env)s; cd %(dumpdir)s && %(decompress)s < %(file)s "
+                "%(rewrite)s | mysql %(mysql_args)s %(name)s" % ctx
+            ), user=env.CFG_INVENIO_USER)
+
+    sudo_local("mkdir -p %s" % os.path.dirname(statefile), user=env.CFG_INVENIO_USER)
+    write_file(statefile, "%s\n" % len(manifest.get('increments', [])), use_sudo=True)
+
+
+def mysql_load_dir(dumpdir, answers, workers=None, host=None, port=None,
+                   name=None, rebuild_indexes=True, reader=None):
+    """
+    Load a dump directory in parallel into an existing (empty) database
+
+    The load is performed in the following steps:
+
+     #. Create all tables from the schema file.
+     #. Drop the secondary indexes (except indexes on auto increment columns
+        and on tables with foreign keys).
+     #. Load the tables concurrently over ``workers`` connections (largest
+        table first), with unique checks, foreign key checks and binary
+        logging disabled for each session.
+     #. Rebuild the secondary indexes concurrently.
+
+    The throughput of each table and the total wall time is reported at the
+    end, and a summary (tables, rows, bytes and seconds per table) returned.
+
+    :param dumpdir: Dump directory created by :meth:`~mysql_dump_dir`.
+    :param answers: Dictionary with ``user`` and ``password`` keys. The user
+        must be allowed to set ``sql_log_bin``.
+    :param workers: Number of concurrent connections (default
+        ``env.CFG_DATABASE_LOAD_WORKERS``).
+    :param rebuild_indexes: Set to ``False`` to leave the secondary indexes
+        dropped (e.g. when only the data is checked).
+    :param reader: Shell command writing the SQL of the table file ``$1`` to
+        stdout (default: decompress the file).
+    """
+    manifest = mysql_read_manifest(dumpdir)
+    ctx = {
+        'mysql_env': mysql_env(answers),
+        'mysql_args': mysql_args(answers, host or env.CFG_DATABASE_HOST,
+                                 port or env.CFG_DATABASE_PORT),
+        'name': name or env.CFG_DATABASE_NAME,
+        'dumpdir': dumpdir,
+        'workers': int(workers or env.CFG_DATABASE_LOAD_WORKERS),
+        'schema': manifest['schema']['file'],
+        'decompress': codec_decompress_cmd(
+            os.path.join(dumpdir, manifest['schema']['file'])),
+    }
+    start = time.time()
+
+    skipped = manifest.get('skipped', {})
+    puts(">>> Creating %s tables (%s without data) ..." % (
+        len(manifest['tables']) + len(skipped.get('excluded', [])) + len(skipped.get('schema_only', [])),
+        len(skipped.get('excluded', [])) + len(skipped.get('schema_only', []))))
+    sudo_local(mysql_script(
+        "%(mysql_env)s; cd %(dumpdir)s && %(decompress)s < %(schema)s "
+        "| mysql %(mysql_args)s %(name)s" % ctx
+    ), user=env.CFG_INVENIO_USER)
+
+    indexes = mysql_secondary_indexes(answers, host, port, ctx['name'])
+    if indexes:
+        puts(">>> Deferring %s secondary indexes ..." % sum([len(v) for v in indexes.values()]))
+        mysql_query("; ".join([
+            "ALTER TABLE `%s` %s" % (t, ", ".join(["DROP INDEX `%s`" % i for i, d in idx]))
+            for t, idx in indexes.items()
+        ]), answers, host, port, ctx['name'])
+
+    puts(">>> Loading data with %(workers)s workers ..." % ctx)
+    tables = sorted(manifest['tables'], key=lambda t: t['size'], reverse=True)
+    ctx['files'] = " ".join([quote(t['file']) for t in tables])
+    ctx['reader'] = reader or '%(decompress)s < "$1"' % ctx
+    ctx['worker'] = quote(
+        "set -o pipefail; s=$(date +%%s.%%N); "
+        "(echo 'SET SESSION unique_checks=0; SET SESSION foreign_key_checks=0; "
+        "SET SESSION sql_log_bin=0;'; %(reader)s) "
+        "| mysql %(mysql_args)s %(name)s && echo \"LOADED $1 $s $(date +%%s.%%N)\"" % ctx
+    )
+    ctx['progress'] = mysql_progress('tables', len(tables), lines=True)
+    # Not captured, so the progress meter is shown while loading
+    with hide('everything'):
+        ctx['results'] = sudo_local("mktemp", user=env.CFG_INVENIO_USER, capture=True).strip()
+    try:
+        sudo_local(mysql_script(
+            "%(mysql_env)s; cd %(dumpdir)s && printf '%%s\\0' %(files)s "
+            "| xargs -0 -n 1 -P %(workers)s bash -c %(worker)s _ | %(progress)s > %(results)s" % ctx
+        ), user=env.CFG_INVENIO_USER)
+        with hide('commands'):
+            output = read_file(ctx['results'])
+    finally:
+        with hide('commands'):
+            sudo_local("rm -f %(results)s" % ctx, user=env.CFG_INVENIO_USER)
+
+    timings = {}
+    for line in output.splitlines():
+        parts = line.strip().split()
+        if len(parts) == 4 and parts[0] == 'LOADED':
+            timings[parts[1]] = float(parts[3]) - float(parts[2])
+
+    for t in tables:
+        secs = max(timings.get(t['file'], 0), 0.001)
+        puts(">>>   %-30s %12s rows %10.1f MB %8.1fs %8.1f MB/s %10.0f rows/s" % (
+            t['name'], t['rows'], t['size'] / 1048576.0, secs,
+            t['size'] / 1048576.0 / secs, t['rows'] / secs))
+
+    if indexes and rebuild_indexes:
+        puts(">>> Rebuilding secondary indexes ...")
+        index_start = time.time()
+        ctx['statements'] = " ".join([quote(
+            "ALTER TABLE `%s` %s" % (t, ", ".join(["ADD %s" % d for i, d in idx]))
+        ) for t, idx in indexes.items()])
+        ctx['worker'] = quote("echo \"$1\" | mysql %(mysql_args)s %(name)s" % ctx)
+        sudo_local(mysql_script(
+            "%(mysql_env)s; printf '%%s\\0' %(statements)s "
+            "| xargs -0 -n 1 -P %(workers)s bash -c %(worker)s _" % ctx
+        ), user=env.CFG_INVENIO_USER)
+        puts(">>> Rebuilt indexes in %.1fs" % (time.time() - index_start))
+
+    puts(cyan(">>> Loaded %s tables in %.1fs" % (len(tables), time.time() - start)))
+    return {
+        'tables': len(tables),
+        'rows': sum([t['rows'] for t in tables]),
+        'bytes': sum([t['size'] for t in tables]),
+        'table_seconds': dict([(t['name'], round(timings.get(t['file'], 0), 3)) for t in tables]),
+    }
+
+
+def mysql_verify_files(basedir, files, workers):
+    """
+    Stream files through their decompressor concurrently, and get the
+    decompression status, size, MD5 checksum and last non-empty line of
+    each file (dictionary keyed by file name relative to ``basedir``).
+    """
+    if not files:
+        return {}
+
+    # All files of a dump share the codec, except for incremental
+    # snapshots which are detected on their own.
+    decompress = {}
+    for f in files:
+        key = os.path.dirname(f)
+        if key not in decompress:
+            decompress[key] = codec_decompress_cmd(os.path.join(basedir, f))
+
+    ctx = {'basedir': basedir, 'workers': workers, 'results': {}}
+    for key, cmd in decompress.items():
+        group = [f for f in files if os.path.dirname(f) == key]
+        ctx['files'] = " ".join([quote(f) for f in group])
+        ctx['progress'] = mysql_progress('files', len(group), lines=True)
+        ctx['worker'] = quote(
+            "set -o pipefail; s=$(stat -c %%s \"$1\"); m=$(md5sum < \"$1\" | cut -c 1-32); "
+            "l=$(%s < \"$1\" | tail -c 4096 | sed '/^[[:space:]]*$/d' | tail -n 1); "
+            "r=$?; printf 'VERIFY\\t%%s\\t%%s\\t%%s\\t%%s\\t%%s\\n' \"$1\" $r $s $m \"$l\"" % cmd
+        )
+        # Not captured, so the progress meter is shown while checking
+        with hide('everything'):
+            ctx['output'] = run_local("mktemp", capture=True).strip()
+        try:
+            run_local(mysql_script(
+                "cd %(basedir)s && printf '%%s\\0' %(files)s "
+                "| xargs -0 -n 1 -P %(workers)s bash -c %(worker)s _ | %(progress)s > %(output)s" % ctx
+            ))
+            with hide('commands'):
+                output = read_file(ctx['output'])
+        finally:
+            with hide('commands'):
+                run_local("rm -f %(output)s" % ctx)
+        for line in output.splitlines():
+            parts = line.rstrip("\r").split("\t", 5)
+            if len(parts) >= 5 and parts[0] == 'VERIFY':
+                ctx['results'][parts[1]] = {
+                    'status': int(parts[2]),
+                    'size': int(parts[3]),
+                    'md5': parts[4],
+                    'last': parts[5].strip() if len(parts) > 5 else '',
+                }
+    return ctx['results']
+
+
+def mysql_verify_restore(dumpfile, manifest, is_dir, workers,
+                         stored_answers=None, reader=None):
+    """
+    Restore a dump into the scratch database ``<name>_verify``, and compare
+    the row counts with the manifest. The scratch database is dropped
+    afterwards. ``reader`` is passed on to :meth:`~mysql_load_dir`.
+
+    :return: List of errors.
+    """
+    name = "%s_verify" % env.CFG_DATABASE_NAME
+    answers = prompt_and_check([
+        ("MySQL admin user:", "user"),
+        ("MySQL admin password:", "password")
+    ], mysql_admin_check(env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
+    cache_key="mysql://%s:%s" % (env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
+    stored_answers=stored_answers)
+
+    puts(">>> Restoring into scratch database %s ..." % name)
+    mysql_admin_exec("DROP DATABASE IF EXISTS `%s`; CREATE DATABASE `%s` "
+                     "DEFAULT CHARACTER SET utf8 COLLATE utf8_general_ci;" % (name, name),
+                     stored_answers=answers)
+    try:
+        if is_dir:
+            mysql_load_dir(dumpfile, answers, workers=workers, name=name,
+                           rebuild_indexes=False, reader=reader)
+        else:
+            ctx = {
+                'mysql_env': mysql_env(answers),
+                'mysql_args': mysql_args(answers, env.CFG_DATABASE_HOST, env.CFG_DATABASE_PORT),
+                'name': name,
+                'decompress': codec_decompress_cmd(dumpfile),
+                'dumpfile': dumpfile,
+            }
+            sudo_local(mysql_script(
+                "%(mysql_env)s; (echo 'SET SESSION unique_checks=0; "
+                "SET SESSION foreign_key_checks=0; SET SESSION sql_log_bin=0;'; "
+                "%(decompress)s < %(dumpfile)s) | mysql %(mysql_args)s %(name)s" % ctx
+            ), user=env.CFG_INVENIO_USER)
+
+        expected = dict([(t['name'], t['rows']) for t in manifest['tables']])
+        rows = mysql_row_counts(sorted(expected.keys()), answers, name=name)
+        errors = []
+        for t in sorted(expected.keys()):
+            if rows.get(t) != expected[t]:
+                errors.append("%s: %s rows restored, manifest has %s" % (t, rows.get(t), expected[t]))
+        puts(">>> Compared row counts of %s tables" % len(expected))
+        return errors
+    finally:
+        mysql_admin_exec("DROP DATABASE IF EXISTS `%s`;" % name, stored_answers=answers)
+
+
+def mysql_table_sizes(answers, host=None, port=None, name=None):
+    """
+    Get data length and (estimated) row count of each table from
+    ``information_schema``, used as denominator for progress meters.
+    """
+    name = name or env.CFG_DATABASE_NAME
+    rows = mysql_query(
+        "SELECT TABLE_NAME, IFNULL(DATA_LENGTH, 0), IFNULL(TABLE_ROWS, 0) "
+        "FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%s'" % name,
+        answers, host, port, name)
+    return dict([(t, (int(size), int(count))) for t, size, count in rows])
+
+
+def mysql_host_path(path):
+    """ Absolute path of a (possibly relative) file or directory on the host """
+    with hide('everything'):
+        return run_local("readlink -f %s" % quote(path), capture=True).strip()
+
+
+def mysql_table_engines(answers, host=None, port=None, name=None):
+    """
+    Get the storage engine of each table from ``information_schema`` (views
+    have none).
+    """
+    name = name or env.CFG_DATABASE_NAME
+    rows = mysql_query(
+        "SELECT TABLE_NAME, IFNULL(ENGINE, '') FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA = '%s'" % name, answers, host, port, name)
+    return dict([(r[0], r[1] if len(r) > 1 else '') for r in rows])
+
+
+def mysql_consistency_opts(tables, engines):
+    """
+    mysqldump option giving a consistent dump of ``tables``:
+    ``--single-transaction`` if all of them use a transactional engine (see
+    :data:`~MYSQL_TRANSACTIONAL_ENGINES`), otherwise ``--lock-tables``,
+    which locks the tables for reading while they are dumped.
+
+    :param engines: Storage engines from :meth:`~mysql_table_engines`.
+    """
+    if [t for t in tables if engines.get(t) and
+            engines[t] not in MYSQL_TRANSACTIONAL_ENGINES]:
+        return "--lock-tables"
+    return "--single-transaction"
+
+
+def mysql_file_size(path):
+    """ Size of a file on the host """
+    with hide('commands'):
+        return int(run_local("stat -c %%s %s" % quote(path), capture=True).strip())
+
+
+def mysql_progress(label, size=None, lines=False):
+    """
+    Pipe segment showing a progress meter of a stream with ``pv`` (bytes or
+    lines processed, current throughput and, if ``size`` is known, the ETA),
+    or ``cat`` if pv is not installed.
+
+    :param lines: Set to ``True`` to count lines (e.g. tables reported by
+        parallel workers) instead of bytes.
+    """
+    if not command_available('pv'):
+        return "cat"
+    return "pv -f -p -t -e -r -b%s -N %s%s" % (
+        " -l" if lines else "", label, " -s %s" % int(size) if size else "")
+
+
+def mysql_stats(operation, start, **values):
+    """
+    Append a summary of an operation as a JSON object on one line to
+    ``env.CFG_DATABASE_STATS_FILE`` (default ``mysql-stats.json`` in
+    ``env.CFG_DATABASE_DUMPDIR``), to track the speed of dumps and loads
+    over time. Failing to write the record only gives a warning.
+    """
+    seconds = max(time.time() - start, 0.001)
+    record = {
+        'operation': operation,
+        'env': env.get('env_name'),
+        'database': env.CFG_DATABASE_NAME,
+        'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+        'seconds': round(seconds, 3),
+    }
+    record.update(values)
+    if record.get('bytes'):
+        record['mb_per_s'] = round(record['bytes'] / 1048576.0 / seconds, 2)
+    if record.get('rows'):
+        record['rows_per_s'] = round(record['rows'] / seconds, 1)
+
+    puts(">>> %s: %.1f MB, %s rows in %.1fs (%.1f MB/s)" % (
+        operation.capitalize(), record.get('bytes', 0) / 1048576.0,
+        record.get('rows', 0), seconds, record.get('mb_per_s', 0)))
+
+    statsfile = env.CFG_DATABASE_STATS_FILE or \
+        os.path.join(env.CFG_DATABASE_DUMPDIR, 'mysql-stats.json')
+    with settings(hide('everything'), warn_only=True):
+        res = sudo_local("mkdir -p %s && echo %s >> %s" % (
+            quote(os.path.dirname(statsfile) or '.'),
+            quote(json.dumps(record, sort_keys=True)), quote(statsfile)),
+            user=env.CFG_INVENIO_USER, warn_only=True)
+    if res.failed:
+        warn("Cannot write statistics to %s" % statsfile)
+    return record
+
+
+def mysql_host_facts():
+    """
+    Probe the current host for memory (MB), number of cores and whether the
+    disk of the MySQL data directory (``env.CFG_DATABASE_DATADIR``) is
+    rotational. Results are cached per host for the run.
+    """
+    if 'mysql_host_facts' not in env:
+        env.mysql_host_facts = {}
+    if env.host in env.mysql_host_facts:
+        return env.mysql_host_facts[env.host]
+
+    ctx = {'datadir': quote(env.CFG_DATABASE_DATADIR)}
+    with hide('commands'):
+        output = run_local(
+            "echo memory=$(awk '/^MemTotal:/ {print $2}' /proc/meminfo); "
+            "echo cores=$(nproc 2>/dev/null || grep -c ^processor /proc/cpuinfo); "
+            "d=$(df -P %(datadir)s 2>/dev/null | awk 'NR==2 {print $1}'); "
+            "echo rotational=$(lsblk -ndo ROTA \"$d\" 2>/dev/null | head -n 1)" % ctx,
+            capture=True)
+
+    values = {}
+    for line in output.splitlines():
+        if "=" in line:
+            key, value = line.strip().split("=", 1)
+            values[key] = value.strip()
+
+    facts = {
+        'memory': int(values.get('memory') or 0) / 1024,
+        'cores': int(values.get('cores') or 1),
+        # Assume rotational disks if the type cannot be found out.
+        'ssd': values.get('rotational') == '0',
+    }
+    facts['disk'] = 'SSD' if facts['ssd'] else 'rotational'
+    if not facts['memory']:
+        abort(red("Cannot find out memory of host %s" % env.host))
+
+    env.mysql_host_facts[env.host] = facts
+    return facts
+
+
+def mysql_tuning(facts, profile='invenio'):
+    """
+    Compute recommended MySQL settings for a host and workload profile (see
+    :data:`~MYSQL_PROFILES`). Settings in ``env.CFG_DATABASE_TUNING`` take
+    precedence over the computed ones.
+
+    :param facts: Host facts from :meth:`~mysql_host_facts`.
+    :param profile: Name of a profile in :data:`~MYSQL_PROFILES`.
+    """
+    if profile not in MYSQL_PROFILES:
+        abort(red("Unknown MySQL profile %s (available: %s)" % (
+            profile, ", ".join(sorted(MYSQL_PROFILES.keys())))))
+    conf = MYSQL_PROFILES[profile]
+
+    memory = facts['memory']
+    share = conf['buffer_pool_share']
+    if env.host in env.roledefs.get('web', []):
+        share = share / 2
+
+    # Buffer pool in multiples of 128 MB, one instance per GB (max 8)
+    pool = max(128, int(memory * share) / 128 * 128)
+    # Redo log (two files) about a quarter of the buffer pool
+    log_file = min(2047, max(48, pool / 8))
+    # Session buffers may use a few MB per connection.
+    connections = max(20, min(conf['max_connections'], (memory - pool) / 2 / 8))
+
+    tuning = {
+        'innodb_buffer_pool_size': '%sM' % pool,
+        'innodb_buffer_pool_instances': min(8, max(1, pool / 1024)),
+        'innodb_log_file_size': '%sM' % log_file,
+        'innodb_log_files_in_group': 2,
+        'innodb_file_per_table': 1,
+        'innodb_flush_method': 'O_DIRECT',
+        'innodb_read_io_threads': min(64, max(4, facts['cores'])),
+        'innodb_write_io_threads': min(64, max(4, facts['cores'])),
+        'innodb_thread_concurrency': 0,
+        'innodb_io_capacity': 2000 if facts['ssd'] else 200,
+        'innodb_flush_neighbors': 0 if facts['ssd'] else 1,
+        'max_connections': connections,
+        'thread_cache_size': min(100, connections / 4),
+    }
+    tuning.update(conf['settings'])
+    tuning.update(env.CFG_DATABASE_TUNING)
+    return tuning
+
+
+def mysql_profile_apply(profile, host=None, port=None):
+    """
+    Switch the server to the runtime settings of a workload profile (the
+    settings which can be changed with ``SET GLOBAL``, see
+    :data:`~MYSQL_DYNAMIC_VARIABLES`). Requires the admin session to have
+    the ``SUPER`` privilege, otherwise the server is left unchanged.
+
+    :return: Previous values of the changed variables, to be passed to
+        :meth:`~mysql_profile_revert`.
+    """
+    if not profile:
+        return None
+    if profile not in MYSQL_PROFILES:
+        abort(red("Unknown MySQL profile %s" % profile))
+
+    variables = dict([(k, v) for k, v in MYSQL_PROFILES[profile]['settings'].items()
+                     if k in MYSQL_DYNAMIC_VARIABLES])
+    session = mysql_session('admin', host=host, port=port)
+    saved = dict(mysql_session_exec(session,
+        "SHOW GLOBAL VARIABLES WHERE Variable_name IN (%s);" % ", ".join(
+            ["'%s'" % k for k in sorted(variables.keys())])))
+
+    variables = dict([(k, v) for k, v in variables.items() if k in saved])
+    puts(">>> Changing global MySQL variables for the %s profile: %s" % (
+        profile, ", ".join(["%s=%s" % (k, variables[k]) for k in sorted(variables.keys())])))
+    rows, errors = mysql_session_send(session, mysql_set_global(variables))
+    if errors:
+        warn("Cannot switch MySQL to the %s profile: %s" % (profile, errors[0][1]))
+        mysql_session_send(session, mysql_set_global(saved))
+        return None
+
+    puts(">>> Switched MySQL to the %s profile" % profile)
+    return {'host': host, 'port': port, 'variables': saved}
+
+
+def mysql_profile_revert(saved):
+    """ Restore variables changed by :meth:`~mysql_profile_apply` """
+    if not saved:
+        return
+    session = mysql_session('admin', host=saved['host'], port=saved['port'])
+    mysql_session_exec(session, mysql_set_global(saved['variables']))
+    puts(">>> Restored MySQL settings")
+
+
+def mysql_set_global(variables):
+    """ SQL statements setting global variables """
+    return "\n".join(["SET GLOBAL %s = %s;" % (k, mysql_literal(v))
+                      for k, v in sorted(variables.items())])
+
+
+def mysql_literal(value):
+    """
+    Convert a setting value to a SQL literal (sizes with ``K``, ``M`` or
+    ``G`` suffix are converted to bytes).
+    """
+    value = str(value)
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1:] in units and value[:-1].isdigit():
+        return str(int(value[:-1]) * units[value[-1]])
+    if value.isdigit():
+        return value
+    return "'%s'" % mysql_escape(value)
+
+
+def mysql_secondary_indexes(answers, host=None, port=None, name=None):
+    """
+    Get the secondary indexes which can be deferred until after a bulk load
+
+    Returns a dictionary mapping table names to a list of ``(index name,
+    index definition)`` tuples. Indexes covering an auto increment column and
+    indexes on tables with foreign keys are never included, since they cannot
+    be dropped while the table is in use.
+    """
+    name = name or env.CFG_DATABASE_NAME
+    skip_tables = set([r[0] for r in mysql_query(
+        "SELECT DISTINCT TABLE_NAME FROM information_schema.KEY_COLUMN_USAGE "
+        "WHERE TABLE_SCHEMA = '%s' AND REFERENCED_TABLE_NAME IS NOT NULL "
+        "UNION SELECT DISTINCT REFERENCED_TABLE_NAME FROM "
+        "information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = '%s' AND "
+        "REFERENCED_TABLE_NAME IS NOT NULL" % (name, name),
+        answers, host, port, name)])
+    autoinc = set([tuple(r) for r in mysql_query(
+        "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = '%s' AND EXTRA LIKE '%%auto_increment%%'" % name,
+        answers, host, port, name)])
+
+    rows = mysql_query(
+        "SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, INDEX_TYPE, COLUMN_NAME, "
+        "IFNULL(SUB_PART, 0) FROM information_schema.STATISTICS WHERE "
+        "TABLE_SCHEMA = '%s' AND INDEX_NAME != 'PRIMARY' "
+        "ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX" % name,
+        answers, host, port, name)
+
+    columns = {}
+    info = {}
+    for table, index, non_unique, index_type, column, sub_part in rows:
+        key = (table, index)
+        columns.setdefault(key, []).append(
+            "`%s`(%s)" % (column, sub_part) if sub_part != '0' else "`%s`" % column)
+        info[key] = (non_unique, index_type)
+        if (table, column) in autoinc:
+            skip_tables.add(key)
+
+    indexes = {}
+    for key in sorted(columns.keys()):
+        table, index = key
+        if table in skip_tables or key in skip_tables:
+            continue
+        non_unique, index_type = info[key]
+        if index_type == 'FULLTEXT':
+            kind = 'FULLTEXT INDEX'
+        elif index_type == 'SPATIAL':
+            kind = 'SPATIAL INDEX'
+        elif non_unique == '0':
+            kind = 'UNIQUE INDEX'
+        else:
+            kind = 'INDEX'
+        indexes.setdefault(table, []).append(
+            (index, "%s `%s` (%s)" % (kind, index, ", ".join(columns[key]))))
+    return indexes
+
+
+def mysql_source_host(some_env, answers=None, master=False):
+    """
+    Select the database host to read dumps and copies from
+
+    Prefers the first host in the ``db-slave`` role of the environment,
+    whose replication is running and lags at most
+    ``CFG_DATABASE_MAX_SLAVE_LAG`` seconds behind the master (checked with a
+    query from the local machine). Otherwise the master
+    (``CFG_DATABASE_HOST``) is used.
+
+    :param some_env: Environment to select the host from.
+    :param answers: Dictionary with ``user`` and ``password`` keys of the
+        MySQL admin user, which needs the ``REPLICATION CLIENT`` privilege
+        on the slaves. Prompted for if the environment has slaves.
+    :param master: Set to ``True`` to always use the master.
+    :return: Tuple ``(host, port)``.
+    """
+    master_host = (some_env.CFG_DATABASE_HOST, some_env.CFG_DATABASE_PORT)
+    slaves = some_env.roledefs.get('db-slave', [])
+    if master or not slaves:
+        return master_host
+
+    if not answers:
+        answers = prompt_and_check([
+            ("MySQL admin user:", "user"),
+            ("MySQL admin password:", "password")
+        ], mysql_admin_check(*master_host),
+        cache_key="mysql://%s:%s" % master_host)
+
+    port = some_env.get('CFG_DATABASE_SLAVE_PORT', None) or some_env.CFG_DATABASE_PORT
+    max_lag = int(some_env.get('CFG_DATABASE_MAX_SLAVE_LAG', 60))
+
+    for host in slaves:
+        # Strip user and SSH port from the host string
+        host = host.split('@')[-1].split(':')[0]
+        status = mysql_slave_status(answers, host, port)
+        if status is None:
+            warn("Cannot get replication status of slave %s" % host)
+        elif status.get('Slave_IO_Running') != 'Yes' or \
+                status.get('Slave_SQL_Running') != 'Yes':
+            warn("Replication is not running on slave %s" % host)
+        elif status.get('Seconds_Behind_Master', 'NULL') == 'NULL' or \
+                int(status['Seconds_Behind_Master']) > max_lag:
+            warn("Slave %s is %s seconds behind master (max %s)" % (
+                host, status.get('Seconds_Behind_Master'), max_lag))
+        else:
+            puts(">>> Reading from slave %s (%s seconds behind master)" % (
+                host, status['Seconds_Behind_Master']))
+            return (host, port)
+
+    return master_host
+
+
+def mysql_slave_status(answers, host, port):
+    """
+    Get output of ``SHOW SLAVE STATUS`` on a host as a dictionary, or
+    ``None`` if the status could not be retrieved.
+    """
+    session = mysql_session_open(answers, host, port, warn_only=True,
+                                 on_host=False)
+    if not session:
+        return None
+    rows, errors = mysql_session_send(session, "SHOW SLAVE STATUS\\G")
+    mysql_session_close(session)
+    if errors:
+        return None
+
+    status = {}
+    for line in ["\t".join(r) for r in rows]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            status[key.strip()] = value.strip()
+    return status or None
+
+
+def mysql_copy_checkpoint(from_env, to_env):
+    """
+    Path of the checkpoint file used by :meth:`~mysql_copy` (in
+    ``env.CFG_DATABASE_COPY_CHECKPOINTDIR`` on the local machine).
+    """
+    return os.path.join(
+        env.get('CFG_DATABASE_COPY_CHECKPOINTDIR', None) or os.getcwd(),
+        ".mysql_copy-%s-%s-%s" % (from_env.env_name, to_env.env_name, to_env.CFG_DATABASE_NAME)
+    )
+
+
+def mysql_dumpfile(dumpdir, name=None):
+    """
+    Locate the dump of a database in a directory. A dump repository takes
+    precedence over a dump directory, which takes precedence over a single
+    file dump.
+    """
+    name = name or env.CFG_DATABASE_NAME
+    repodump = os.path.join(dumpdir, "%s.repo" % name)
+    if exists_local(os.path.join(repodump, 'snapshots')):
+        return repodump
+    dirdump = os.path.join(dumpdir, "%s.dump" % name)
+    if exists_local(os.path.join(dirdump, MYSQL_DUMP_MANIFEST)):
+        return dirdump
+    for ext in sorted(set([c['ext'] for c in CODECS.values()])) + ['']:
+        dumpfile = os.path.join(dumpdir, "%s.sql%s" % (name, ext))
+        if exists_local(dumpfile):
+            return dumpfile
+    return os.path.join(dumpdir, "%s.sql%s" % (name, codec_ext()))
+
+
+def mysql_read_manifest(dumpdir):
+    """ Read manifest of a dump directory """
+    return json.loads(read_file(os.path.join(dumpdir, MYSQL_DUMP_MANIFEST)))
+
+
+def mysql_write_manifest(dumpdir, manifest):
+    """ Write manifest of a dump directory """
+    write_file(os.path.join(dumpdir, MYSQL_DUMP_MANIFEST),
+               json.dumps(manifest, indent=2, sort_keys=True), use_sudo=True)
+
+
+def mysql_manifest_file(dumpfile):
+    """ Manifest of a single file dump, stored next to the file """
+    return "%s.%s" % (dumpfile, MYSQL_DUMP_MANIFEST)
+
+
+def mysql_row_counts(tables, answers, host=None, port=None, name=None):
+    """ Count rows of tables (dictionary of table name to row count) """
+    if not tables:
+        return {}
+    rows = mysql_query(
+        " UNION ALL ".join(["SELECT '%s', COUNT(*) FROM `%s`" % (t, t) for t in tables]),
+        answers, host, port, name
+    )
+    return dict([(t, int(c)) for t, c in rows])
+
+
+def mysql_master_status(answers, host=None, port=None):
+    """
+    Get current binary log position of a host, or ``None`` if binary
+    logging is disabled or the user lacks the ``REPLICATION CLIENT``
+    privilege (with a warning).
+    """
+    rows, errors = mysql_session_send(mysql_user_session(answers, host, port),
+                                      "SHOW MASTER STATUS;")
+    if errors:
+        warn("Cannot read binary log position: %s" % errors[0][1])
+        return None
+    if not rows:
+        return None
+    return {
+        'host': host or env.CFG_DATABASE_HOST,
+        'port': port or env.CFG_DATABASE_PORT,
+        'file': rows[0][0],
+        'position': int(rows[0][1]),
+    }
+
+
+def mysql_file_stats(basedir, files):
+    """
+    Get size and MD5 checksum of files (relative to ``basedir``)
+    """
+    ctx = {'basedir': basedir, 'files': " ".join(files)}
+    stats = dict([(f, {}) for f in files])
+
+    output = run_local("cd %(basedir)s && stat -c '%%s %%n' %(files)s" % ctx, capture=True)
+    for line in output.splitlines():
+        size, f = line.strip().split(" ", 1)
+        stats[f]['size'] = int(size)
+
+    output = run_local("cd %(basedir)s && md5sum %(files)s" % ctx, capture=True)
+    for line in output.splitlines():
+        md5, f = line.strip().split(None, 1)
+        stats[f]['md5'] = md5
+
+    return stats
+
+
+def mysql_filter_enabled():
+    """ Determine if any table include/exclude patterns are defined """
+    return bool(env.get('CFG_DATABASE_DUMP_INCLUDE') or
+                env.get('CFG_DATABASE_DUMP_EXCLUDE') or
+                env.get('CFG_DATABASE_DUMP_SCHEMA_ONLY'))
+
+
+def mysql_filter_tables(tables):
+    """
+    Split tables into tables to dump with data and tables to dump without
+    data, based on glob patterns in the environment
+
+     * ``env.CFG_DATABASE_DUMP_INCLUDE`` - only tables matching one of the
+       patterns are dumped with data (default all tables).
+     * ``env.CFG_DATABASE_DUMP_EXCLUDE`` - tables matching one of the
+       patterns are excluded.
+     * ``env.CFG_DATABASE_DUMP_SCHEMA_ONLY`` - tables matching one of the
+       patterns are dumped without data.
+
+    Example::
+
+      env.CFG_DATABASE_DUMP_EXCLUDE = ['idxWORD*', 'idxPAIR*', 'idxPHRASE*',
+                                       'rnkCITATIONDATA*']
+      env.CFG_DATABASE_DUMP_SCHEMA_ONLY = ['session', 'schTASK']
+
+    :return: Tuple ``(tables, skipped)`` where ``skipped`` is a dictionary
+        with the keys ``excluded`` and ``schema_only``.
+    """
+    def _match(t, patterns):
+        return any([fnmatchcase(t, p) for p in patterns])
+
+    include = env.get('CFG_DATABASE_DUMP_INCLUDE') or []
+    exclude = env.get('CFG_DATABASE_DUMP_EXCLUDE') or []
+    schema_only = env.get('CFG_DATABASE_DUMP_SCHEMA_ONLY') or []
+
+    skipped = {'excluded': [], 'schema_only': []}
+    data_tables = []
+    for t in tables:
+        if (include and not _match(t, include)) or _match(t, exclude):
+            skipped['excluded'].append(t)
+        elif _match(t, schema_only):
+            skipped['schema_only'].append(t)
+        else:
+            data_tables.append(t)
+    return (data_tables, skipped)
+
+
+def mysql_tables(answers, host=None, port=None, name=None):
+    """ List tables in database """
+    return [r[0] for r in mysql_query("SHOW TABLES", answers, host, port, name)]
+
+
+def mysql_query(sql, answers, host=None, port=None, name=None):
+    """
+    Run a SQL query over the session of the user (see
+    :meth:`~mysql_user_session`) and return the result as a list of rows
+    (lists of column values).
+    """
+    session = mysql_user_session(answers, host, port)
+    return mysql_session_exec(session, "USE `%s`;\n%s" % (
+        name or env.CFG_DATABASE_NAME, sql))
+
+
+def mysql_env(answers):
+    """
+    Shell statement exporting the password for MySQL client programs. Using
+    ``MYSQL_PWD`` keeps the password out of the process list and avoids
+    quoting issues when commands are nested.
+    """
+    return "export MYSQL_PWD=%s" % quote(answers['password'] or '')
+
+
+def mysql_args(answers, host, port):
+    """ Connection arguments for MySQL client programs """
+    return "-u %s -h %s -P %s" % (quote(answers['user']), host, port)
+
+
+def mysql_script(script):
+    """
+    Wrap a shell script in ``bash -c`` so it can be run as a single command
+    by :meth:`~inveniofab.utils.sudo_local` (pipes fail if any part fails).
+    """
+    return "bash -c %s" % quote("set -o pipefail; %s" % script)
+
+
+def mysql_admin_exec(sql, stored_answers=None, host=None, port=None,
+                     ignore_errors=[]):
+    """
+    Run a SQL script as MySQL admin user in a single round-trip over the
+    admin session (see :meth:`~mysql_session`)
+
+    The admin credentials are checked by opening the session, i.e. if access
+    is denied the user is asked for the credentials again.
+
+    :param sql: SQL statements to run.
+    :param stored_answers: Dictionary with ``user`` and ``password`` keys.
+    :param ignore_errors: MySQL error codes which do not make the script
+        fail. The script continues after such errors.
+    :return: The admin credentials.
+    """
+    session = mysql_session('admin', host=host, port=port,
+                            stored_answers=stored_answers)
+    mysql_session_exec(session, sql, ignore_errors=ignore_errors)
+    return session['answers']
+
+
+def mysql_app_exec(sql, ignore_errors=[]):
+    """
+    Run a SQL script as the Invenio database user over the application
+    session (see :meth:`~mysql_session`) and return the result rows.
+
+    Replaces piping statements into ``bin/dbexec``.
+    """
+    return mysql_session_exec(mysql_session('app'), sql,
+                              ignore_errors=ignore_errors)
+
+
+def mysql_session(kind='admin', host=None, port=None, stored_answers=None):
+    """
+    Get the MySQL session of a kind for a database server, opening it if
+    needed. Sessions are kept open for the whole fab run, so tasks issuing
+    SQL do not fork and authenticate a new client for each statement.
+
+    There is one ``admin`` session per server (prompting for the MySQL admin
+    user, with the same ``mysql://host:port`` key which caches the admin
+    credentials), and one ``app`` session per server and database (as
+    ``CFG_DATABASE_USER`` on ``CFG_DATABASE_NAME``). A session is a ``mysql``
+    client process reading statements from a pipe. As for the ``mysql`` and
+    ``mysqladmin`` commands this layer replaces, the ``admin`` session runs
+    on the machine running fab, while the ``app`` session runs on
+    ``env.host`` like ``bin/dbexec`` did (see :meth:`~mysql_session_open`).
+
+    :param kind: ``admin`` or ``app``.
+    :param stored_answers: Admin credentials, to avoid prompting.
+    """
+    host = host or env.CFG_DATABASE_HOST
+    port = port or env.CFG_DATABASE_PORT
+    cache_key = "mysql://%s:%s" % (host, port)
+
+    if kind == 'app':
+        answers = {'user': env.CFG_DATABASE_USER,
+                   'password': env.CFG_DATABASE_PASS}
+        key = mysql_session_key('app', answers, host, port,
+                                env.CFG_DATABASE_NAME)
+        session = mysql_sessions().get(key)
+        if session and mysql_session_alive(session):
+            return session
+        session = mysql_session_open(answers, host, port,
+                                     env.CFG_DATABASE_NAME)
+        if not session:
+            abort(red("Cannot connect to %s as %s." % (cache_key, answers['user'])))
+    else:
+        key = ('admin', cache_key)
+        session = mysql_sessions().get(key)
+        if session and mysql_session_alive(session):
+            return session
+
+        opened = {}
+
+        def _mysql_admin_check(answers):
+            opened['session'] = mysql_session_open(answers, host, port,
+                                                   on_host=False)
+            if opened['session']:
+                return True
             puts(red("MySQL admin user/password is not valid. Please try again."))
             return False
 
+        answers = prompt_and_check([
+            ("MySQL admin user:", "user"),
+            ("MySQL admin password:", "password")
+        ], _mysql_admin_check, cache_key=cache_key,
+        stored_answers=stored_answers)
+
+        session = opened.get('session')
+        # Cached credentials are returned without running the check.
+        if not session or session['answers'] != answers:
+            if session:
+                mysql_session_close(session)
+            session = mysql_session_open(answers, host, port, on_host=False)
+            if not session:
+                abort(red("MySQL admin user/password is not valid."))
+
+    mysql_sessions()[key] = session
+    return session
+
+
+def mysql_user_session(answers, host=None, port=None):
+    """
+    Get a session on ``env.host`` for the MySQL user in ``answers`` (see
+    :meth:`~mysql_session`), opening it if needed. The ``app`` session is
+    reused if the credentials match, and so is the ``admin`` session if fab
+    runs on the database host.
+    """
+    host = host or env.CFG_DATABASE_HOST
+    port = port or env.CFG_DATABASE_PORT
+    answers = {'user': answers['user'], 'password': answers['password']}
+    if answers == {'user': env.CFG_DATABASE_USER,
+                   'password': env.CFG_DATABASE_PASS}:
+        return mysql_session('app', host, port)
+
+    key = mysql_session_key('user', answers, host, port)
+    for k in [key, ('admin', "mysql://%s:%s" % (host, port))]:
+        session = mysql_sessions().get(k)
+        if session and mysql_session_alive(session) and \
+                session['answers'] == answers and \
+                session['location'] == mysql_session_location():
+            return session
+
+    session = mysql_session_open(answers, host, port)
+    if not session:
+        abort(red("Cannot connect to mysql://%s:%s as %s." % (host, port, answers['user'])))
+    mysql_sessions()[key] = session
+    return session
+
+
+def mysql_sessions():
+    """
+    Sessions opened in this run, closed by ``atexit`` when fab exits.
+    """
+    if 'mysql_sessions' not in env:
+        env.mysql_sessions = {}
+        atexit.register(mysql_session_close_all)
+    return env.mysql_sessions
+
+
+def mysql_session_key(kind, answers, host, port, name=None):
+    """
+    Key of a session on ``env.host`` in ``env.mysql_sessions``: the kind,
+    user, server, database and the host the client runs on.
+    """
+    return (kind, answers['user'], "mysql://%s:%s" % (host, port), name,
+            mysql_session_location())
+
+
+def mysql_session_location():
+    """ Host a session client started now runs on (``None`` for local) """
+    return None if is_local() else env.host_string
+
+
+def mysql_session_open(answers, host, port, name=None, warn_only=False,
+                       on_host=True):
+    """
+    Start a ``mysql`` client process and check that it is connected.
+
+    The client runs on ``env.host`` (over the SSH connection of Fabric for
+    remote hosts), or with ``on_host=False`` on the machine running fab. The
+    password is sent on the first line of the standard input, so it does not
+    show up in the process list or the command line of the host.
+
+    :param warn_only: Set to ``True`` to return ``None`` on any error instead
+        of aborting.
+    :return: The session dictionary, or ``None`` if access was denied.
+    """
+    args = ['mysql', '-u', answers['user'], '-h', str(host), '-P', str(port),
+            '-N', '-B', '--unbuffered', '--force']
+    if name:
+        args.append(name)
+    command = "bash -c %s" % quote(
+        "IFS= read -r MYSQL_PWD; export MYSQL_PWD; exec %s" %
+        " ".join([quote(a) for a in args]))
+
+    location = mysql_session_location() if on_host else None
+    if location is None:
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        stdin, stdout, stderr = process.stdin, process.stdout, process.stderr
+    else:
+        process = connections[env.host_string].get_transport().open_session()
+        process.exec_command(command)
+        stdin, stdout = process.makefile('wb'), process.makefile('rb')
+        stderr = process.makefile_stderr('rb')
+
+    session = {
+        'process': process,
+        'stdin': stdin,
+        'stdout': stdout,
+        'stderr': stderr,
+        'answers': dict(answers),
+        'host': host,
+        'port': port,
+        'name': name,
+        'location': location,
+    }
+    rows, errors = mysql_session_send(session, "SELECT 1;",
+                                      init="%s\n" % (answers['password'] or ''))
+    if errors:
+        mysql_session_close(session)
+        if warn_only or [code for code, error in errors if code == 1045]:
+            return None
+        abort(red(errors[0][1]))
+    return session
+
+
+def mysql_session_exec(session, sql, ignore_errors=[]):
+    """
+    Run SQL statements over a session and return the result rows.
+
+    The client runs with ``--force``, so all statements are sent even if one
+    fails, but any error not listed in ``ignore_errors`` aborts afterwards.
+    """
+    rows, errors = mysql_session_send(session, sql)
+    for code, error in errors:
+        if code not in ignore_errors:
+            abort(red(error))
+    return rows
+
+
+def mysql_session_send(session, sql, init=''):
+    """
+    Send SQL statements to a session, and read back result rows and errors
+    as ``(code, message)`` tuples.
+
+    A marker query is sent after the statements, and the marker is echoed
+    to the error output of the client with the ``\\!`` (system) command. The
+    result rows are read from the output up to the marker, and the errors
+    from the error output up to the marker, so a row is never mistaken for
+    an error. If the client exits (e.g. access denied or lost connection),
+    its error messages and exit status are returned as errors.
+
+    :param init: Text sent before the statements (e.g. the password).
+    """
+    session['serial'] = session.get('serial', 0) + 1
+    marker = "-- inveniofab %s %s" % (os.getpid(), session['serial'])
+
+    sql = sql.strip()
+    if not sql.endswith(";") and not sql.endswith("\\G"):
+        sql += ";"
+    try:
+        session['stdin'].write("%s%s\nSELECT '%s';\n\\! echo '%s' >&2\n" % (
+            init, sql, marker, marker))
+        session['stdin'].flush()
+    except (EnvironmentError, EOFError, SSHException):
+        # Client exited, its error message is read below.
+        pass
+
+    rows = []
+    while True:
+        line = session['stdout'].readline()
+        if not line or line.rstrip("\r\n") == marker:
+            break
+        if line.strip():
+            rows.append(line.rstrip("\r\n").split("\t"))
+
+    errors = []
+    while True:
+        line = session['stderr'].readline()
+        if not line or line.rstrip("\r\n") == marker:
+            break
+        if line.startswith("ERROR"):
+            errors.append(line.strip())
+
+    if not line:
+        status = mysql_session_wait(session)
+        if not errors:
+            errors.append("ERROR 2013: Lost connection to MySQL server")
+        if status:
+            errors[-1] += " (mysql client exited with status %s)" % status
+
+    result = []
+    for error in errors:
+        try:
+            code = int(error.split()[1].rstrip(":"))
+        except (IndexError, ValueError):
+            code = None
+        result.append((code, error))
+    return (rows, result)
+
+
+def mysql_session_alive(session):
+    """ Determine if the client process of a session is still running """
+    if isinstance(session['process'], subprocess.Popen):
+        return session['process'].poll() is None
+    return not session['process'].exit_status_ready()
+
+
+def mysql_session_wait(session):
+    """
+    Wait for the client of a session to exit (e.g. after its output was
+    closed), and return its exit status
+    """
+    if isinstance(session['process'], subprocess.Popen):
+        return session['process'].wait()
+    return session['process'].recv_exit_status()
+
+
+def mysql_session_close(session):
+    """ Close a session """
+    if mysql_session_alive(session):
+        try:
+            session['stdin'].close()
+            if isinstance(session['process'], subprocess.Popen):
+                session['process'].wait()
+            else:
+                session['process'].shutdown_write()
+                session['process'].recv_exit_status()
+        except (EnvironmentError, EOFError, SSHException):
+            pass
+
+
+def mysql_session_close_all():
+    """ Close all sessions opened in this run (registered with ``atexit``) """
+    for session in env.get('mysql_sessions', {}).values():
+        mysql_session_close(session)
+    env.mysql_sessions = {}
+
+
+def mysql_escape(value):
+    """ Escape a value for use in a quoted SQL string """
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def mysql_admin_check(host, port):
+    """
+    Return a check function for :meth:`~inveniofab.utils.prompt_and_check`,
+    which validates admin credentials by opening the admin session.
+    """
+    def _mysql_admin_check(answers):
+        key = ('admin', "mysql://%s:%s" % (host, port))
+        session = mysql_session_open(answers, host, port, on_host=False)
+        if session:
+            if key in mysql_sessions():
+                mysql_session_close(mysql_sessions()[key])
+            mysql_sessions()[key] = session
+            return True
+        puts(red("MySQL admin user/password is not valid. Please try again."))
+        return False
+
     return _mysql_admin_check
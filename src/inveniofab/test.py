@@ -23,7 +23,8 @@ against a known state.
 from fabric.api import task, puts, env, roles
 from fabric.colors import cyan
 from fabric.contrib.console import confirm
-from inveniofab.mysql import mysql_dump, mysql_load
+from inveniofab.mysql import mysql_dump, mysql_load, mysql_dumpfile, \
+    mysql_app_exec
 from inveniofab.git import repo_all_configure_make
 from inveniofab.utils import sudo_local
 import os
@@ -39,8 +40,7 @@ def test_clean():
     sudo_local("rm -Rf %(CFG_INVENIO_PREFIX)s/var/tmp/*" % env, user=env.CFG_INVENIO_USER)
     sudo_local("rm -Rf %(CFG_INVENIO_PREFIX)s/var/log/*" % env, user=env.CFG_INVENIO_USER)
     sudo_local("rm -Rf %(CFG_INVENIO_PREFIX)s/var/cache/*" % env, user=env.CFG_INVENIO_USER)
-    sudo_local("""echo "TRUNCATE schTASK;" | %(CFG_INVENIO_PREFIX)s/bin/dbexec""" % env, user=env.CFG_INVENIO_USER)
-    sudo_local("""echo "TRUNCATE session;" | %(CFG_INVENIO_PREFIX)s/bin/dbexec""" % env, user=env.CFG_INVENIO_USER)
+    mysql_app_exec("TRUNCATE schTASK; TRUNCATE session;")
 
 
 @task
@@ -66,7 +66,7 @@ def test_dump():
 def test_reset_admin():
     """ Reset admin password """
     puts(cyan(">>> Resetting Invenio admin password..." % env))
-    sudo_local("""echo "UPDATE user SET password=AES_ENCRYPT(email,'') WHERE nickname='admin';" | %(CFG_INVENIO_PREFIX)s/bin/dbexec""" % env, user=env.CFG_INVENIO_USER)
+    mysql_app_exec("UPDATE user SET password=AES_ENCRYPT(email,'') WHERE nickname='admin';")
 
 
 @task
@@ -79,7 +79,7 @@ def test_load(repo=None, quite=True):
         sudo_local("rsync --delete -rLptgoDv %(CFG_INVENIO_PREFIX)s/tests/etc/ %(CFG_INVENIO_PREFIX)s/etc/" % env)
 
     if quite or confirm(cyan("Run step load_db?")):
-        mysql_load(dumpfile=os.path.join(env.CFG_INVENIO_PREFIX, "tests/%s.sql.gz" % env.CFG_DATABASE_NAME))
+        mysql_load(dumpfile=mysql_dumpfile(os.path.join(env.CFG_INVENIO_PREFIX, "tests")))
 
     if quite or confirm(cyan("Run step configure_make_install?")):
         repo_all_configure_make(repo, target_key='deploy_targets')
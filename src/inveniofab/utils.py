@@ -16,7 +16,7 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 from fabric.api import prompt, env, abort, warn, get, put, task, \
-    puts, execute
+    puts, execute, settings, hide
 from fabric.api import local as fab_local, run as fab_run, sudo as fab_sudo
 from fabric.colors import red, cyan
 from fabric.contrib.files import exists as fab_exists, append as fab_append
@@ -166,6 +166,157 @@ def write_template(filename, context, tpl_str=None, tpl_file=None, remote_tpl_fi
             put(StringIO(content.encode('utf8')), filename, use_sudo=use_sudo)
 
 
+def read_file(filename):
+    """
+    Read content of a file on the local or remote host.
+    """
+    if is_local():
+        f = open(filename, 'r')
+        content = f.read()
+        f.close()
+    else:
+        f = StringIO()
+        get(filename, f)
+        content = f.getvalue()
+        f.close()
+    return content
+
+
+def write_file(filename, content, use_sudo=False):
+    """
+    Write content (without any template rendering) to a file on the local or
+    remote host.
+    """
+    if is_local():
+        f = open(filename, 'w')
+        f.write(content)
+        f.close()
+    else:
+        put(StringIO(content), filename, use_sudo=use_sudo)
+
+
+#
+# Compression codecs
+#
+CODECS = {
+    'gzip': {
+        'tool': 'gzip',
+        'ext': '.gz',
+        'magic': '1f8b',
+        'compress': 'gzip -c%(level)s',
+        'decompress': 'gzip -dc',
+        'test': 'gzip -t',
+    },
+    'pigz': {
+        'tool': 'pigz',
+        'ext': '.gz',
+        'magic': '1f8b',
+        'compress': 'pigz -c%(level)s%(threads)s',
+        'decompress': 'pigz -dc',
+        'test': 'pigz -t',
+    },
+    'zstd': {
+        'tool': 'zstd',
+        'ext': '.zst',
+        'magic': '28b52ffd',
+        'compress': 'zstd -q -c%(level)s -T%(threads)s',
+        'decompress': 'zstd -q -dc',
+        'test': 'zstd -q -t',
+    },
+    'lz4': {
+        'tool': 'lz4',
+        'ext': '.lz4',
+        'magic': '04224d18',
+        'compress': 'lz4 -q -c%(level)s',
+        'decompress': 'lz4 -q -dc',
+        'test': 'lz4 -q -t',
+    },
+}
+"""
+Compression codecs supported for database dumps and virtualenv archives. The
+codec is selected with ``env.CFG_DUMP_CODEC``, while
+``env.CFG_DUMP_CODEC_LEVEL`` and ``env.CFG_DUMP_CODEC_THREADS`` (``0`` for
+all cores) control the compression level and number of threads.
+"""
+
+
+def command_available(command):
+    """ Check if a command is installed on the host """
+    if 'commands_cache' not in env:
+        env.commands_cache = {}
+    key = (env.host, command)
+    if key not in env.commands_cache:
+        with settings(hide('everything'), warn_only=True):
+            res = run_local("command -v %s" % command, capture=True, warn_only=True)
+        env.commands_cache[key] = res.succeeded
+    return env.commands_cache[key]
+
+
+def codec_get(codec=None):
+    """
+    Get name of the codec to use for compression (default
+    ``env.CFG_DUMP_CODEC``). Falls back to gzip if the tool for the
+    requested codec is not installed on the host.
+    """
+    codec = codec or env.get('CFG_DUMP_CODEC', 'gzip')
+    if codec not in CODECS:
+        abort(red("Unknown compression codec %s (valid: %s)" % (codec, ", ".join(sorted(CODECS.keys())))))
+    if codec != 'gzip' and not command_available(CODECS[codec]['tool']):
+        warn("Compression tool %s not found - falling back to gzip" % CODECS[codec]['tool'])
+        codec = 'gzip'
+    return codec
+
+
+def codec_ext(codec=None):
+    """ File extension for a codec (e.g. ``.gz``) """
+    return CODECS[codec_get(codec)]['ext']
+
+
+def codec_compress_cmd(codec=None):
+    """
+    Command which compresses stdin to stdout with a codec.
+    """
+    codec = codec_get(codec)
+    level = env.get('CFG_DUMP_CODEC_LEVEL', None)
+    threads = int(env.get('CFG_DUMP_CODEC_THREADS', 0) or 0)
+
+    ctx = {
+        'level': ' -%s' % level if level else '',
+        'threads': threads if codec == 'zstd' else (' -p %s' % threads if threads else ''),
+    }
+    return CODECS[codec]['compress'] % ctx
+
+
+def codec_detect(path):
+    """
+    Detect codec of a file from its magic number. Returns ``None`` for
+    uncompressed files.
+    """
+    with settings(hide('everything'), warn_only=True):
+        magic = run_local("head -c 4 %s | od -An -tx1 | tr -d ' \\n'" % path, capture=True)
+    magic = magic.strip()
+
+    for codec in ['gzip', 'zstd', 'lz4']:
+        if magic.startswith(CODECS[codec]['magic']):
+            if codec == 'gzip' and command_available('pigz'):
+                return 'pigz'
+            return codec
+    return None
+
+
+def codec_decompress_cmd(path, what='decompress'):
+    """
+    Command which decompresses (or with ``what='test'`` tests) a file read
+    from stdin, based on the file's magic number.
+    """
+    codec = codec_detect(path)
+    if codec is None:
+        return 'cat' if what == 'decompress' else 'true'
+    if not command_available(CODECS[codec]['tool']):
+        abort(red("%s is compressed with %s, which is not installed." % (path, codec)))
+    return CODECS[codec][what]
+
+
 def python_version():
     """ Determine Python version """
     return run_local(("%(CFG_INVENIO_PREFIX)s/bin/python -c \"import sys;print str(sys.version_info[0]) + '.' + str(sys.version_info[1])\"") % env, capture=True)
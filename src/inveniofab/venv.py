@@ -21,12 +21,22 @@ Tasks for creating and installing Python virtual environments.
 All task works on local system.
 """
 
-from fabric.api import task, puts, env, local, abort, roles
+from fabric.api import task, puts, env, local, abort, roles, settings, hide, \
+    get, put
 from fabric.contrib.console import confirm
 from fabric.colors import red, cyan
 from inveniofab.utils import write_template, python_version, sudo_local, \
-    exists_local
+    exists_local, is_local, read_file, write_file, CODECS, codec_ext, \
+    codec_compress_cmd, codec_decompress_cmd
+from pipes import quote
+import hashlib
 import os
+import re
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
 
 
 @task
@@ -85,6 +95,18 @@ def venv_requirements(upgrade=False):
     Install Python packages
 
     The task will install Python packages defined in PIP requirements file.
+
+    The requirement files of all repositories are merged into one set
+    (see :meth:`~venv_requirements_merge`), ``<prefix>/requirements.txt``,
+    which is installed by a single pip run. The installed packages are then
+    recorded with ``pip freeze`` in the lock file
+    ``<prefix>/requirements.lock``; as long as the merged requirements are
+    unchanged, later runs skip pip (unless ``upgrade`` is set).
+
+    If ``env.CFG_WHEELHOUSE_DIR`` is set, packages are installed from wheels
+    in a wheelhouse for the Python version and platform of the virtualenv
+    (see :meth:`~venv_pip_install`), so they are only downloaded and
+    compiled once.
     """
     requirements = []
     for repo, info in env.CFG_INVENIO_REPOS:
@@ -110,13 +132,25 @@ def venv_requirements(upgrade=False):
         write_template(reqpath, ctx, remote_tpl_file=reqfile, use_sudo=True)
         reqpaths.append(reqpath)
 
-    for reqpath in reqpaths:
-        ctx = {'reqpath': reqpath, 'pyver': pyver, 'upgrade': '--upgrade' if upgrade else ''}
-        ctx.update(env)
-        puts(">>> Installing requirements from %(reqpath)s ..." % ctx)
-        cmds = [env.ACTIVATE] if env.WITH_VIRTUALENV else []
-        cmds.append("pip install %(upgrade)s -r %(reqpath)s")
-        sudo_local(" && ".join(cmds) % ctx, user=env.CFG_INVENIO_USER)
+    merged = venv_requirements_merge(reqpaths)
+    checksum = hashlib.md5(merged).hexdigest()
+    mergedpath = os.path.join(env.CFG_INVENIO_PREFIX, 'requirements.txt')
+    lockpath = os.path.join(env.CFG_INVENIO_PREFIX, 'requirements.lock')
+
+    if not upgrade and exists_local(lockpath) and \
+       read_file(lockpath).startswith("# requirements %s\n" % checksum):
+        puts(">>> Requirements unchanged since %s, skipping pip ..." % lockpath)
+        return
+
+    write_file(mergedpath, merged, use_sudo=True)
+    puts(">>> Installing requirements from %s ..." % mergedpath)
+    venv_pip_install(mergedpath, upgrade=upgrade)
+
+    cmds = [env.ACTIVATE % env] if env.WITH_VIRTUALENV else []
+    cmds.append("pip freeze")
+    with settings(hide('everything')):
+        frozen = sudo_local(" && ".join(cmds), capture=True, user=env.CFG_INVENIO_USER)
+    write_file(lockpath, "# requirements %s\n%s\n" % (checksum, frozen.strip()), use_sudo=True)
 
 
 @task
@@ -126,8 +160,9 @@ def venv_dump():
     Archive a virtualenv
 
     The task will create an archive ``<virtualenv name>.tar.gz`` of the entire
-    virtual environment. If an existing archive already exists, the user will
-    be asked for confirmation to remove it. Normally this command is invoked
+    virtual environment (the extension depends on the compression codec
+    ``env.CFG_DUMP_CODEC``). If an existing archive already exists, the user
+    will be asked for confirmation to remove it. Normally this command is invoked
     indirectly via the compound task :meth:`inveniofab.compound.dump` which
     takes care of dumping the database prior to archiving the virtual
     environment.
@@ -137,21 +172,24 @@ def venv_dump():
     ctx = {
         'dirname': os.path.dirname(env.CFG_INVENIO_PREFIX),
         'basename': os.path.basename(env.CFG_INVENIO_PREFIX),
+        'ext': codec_ext(),
+        'compress': codec_compress_cmd(),
     }
 
-    archive_file = "%(dirname)s/%(basename)s.tar.gz" % ctx
-    if exists_local(archive_file):
-        res = confirm("Existing archive already exists - remove?")
+    for archive_file in venv_archives(ctx):
+        res = confirm("Existing archive %s already exists - remove?" % archive_file)
         if not res:
             abort(red("Cannot continue") % env)
         else:
             sudo_local("rm -Rf %s" % archive_file, user=env.CFG_INVENIO_USER)
 
+    # Without pipefail, a failing tar would leave a truncated archive behind.
     cmds = [
         "cd %(dirname)s",
-        "tar -cvzf %(basename)s.tar.gz %(basename)s",
+        "tar -cvf - %(basename)s | %(compress)s > %(basename)s.tar%(ext)s",
     ]
-    sudo_local(" && ".join(cmds) % ctx, user=env.CFG_INVENIO_USER)
+    sudo_local("bash -o pipefail -c %s" % quote(" && ".join(cmds) % ctx),
+               user=env.CFG_INVENIO_USER)
 
 
 @task
@@ -173,9 +211,13 @@ def venv_load():
         'basename': os.path.basename(env.CFG_INVENIO_PREFIX),
     }
 
-    archive_file = "%(dirname)s/%(basename)s.tar.gz" % ctx
-    if not exists_local(archive_file):
+    archives = venv_archives(ctx)
+    if not archives:
         abort(red("Archived virtualenv does not exists - cannot continue") % env)
+    if len(archives) > 1:
+        puts(">>> Several archives found, loading the newest one: %s" % archives[0])
+    ctx['archive_file'] = archives[0]
+    ctx['decompress'] = codec_decompress_cmd(ctx['archive_file'])
 
     # Remove previous installation
     if exists_local(env.CFG_INVENIO_PREFIX):
@@ -187,9 +229,10 @@ def venv_load():
 
     cmds = [
         "cd %(dirname)s",
-        "tar -xvzf %(basename)s.tar.gz",
+        "%(decompress)s < %(archive_file)s | tar -xvf -",
     ]
-    sudo_local(" && ".join(cmds) % ctx, user=env.CFG_INVENIO_USER)
+    sudo_local("bash -o pipefail -c %s" % quote(" && ".join(cmds) % ctx),
+               user=env.CFG_INVENIO_USER)
 
 
 @task
@@ -202,7 +245,6 @@ def venv_create():
     create ``lib/python/invenio/`` and symlink it the virtualenv's
     site-packages, as well as ``var/tmp/ooffice-tmp-files`` (via sudo). If
     ``env.WITH_DEVSCRIPTS`` is ``True``, invenio-devscripts will be installed.
-    If ``env.WITH_WORKDIR`` is ``True`` git-new-workdir will be installed.
 
     Lastly, it will append render the template ``activate-profile.tpl`` and
     append it to ``bin/activate``. The script will setup common needed
@@ -251,11 +293,6 @@ def venv_create():
         sudo_local("cd %(CFG_INVENIO_PREFIX)s && git clone https://github.com/tiborsimko/invenio-devscripts.git" % env, user=env.CFG_INVENIO_USER)
         sudo_local("cd %(CFG_INVENIO_PREFIX)s && mv invenio-devscripts/* bin/" % env, user=env.CFG_INVENIO_USER)
 
-    if env.WITH_WORKDIR:
-        puts(">>> Installing git-new-workdir...")
-        sudo_local('wget -O %(CFG_INVENIO_PREFIX)s/bin/git-new-workdir "http://repo.or.cz/w/git.git/blob_plain/HEAD:/contrib/workdir/git-new-workdir"' % env, user=env.CFG_INVENIO_USER)
-        sudo_local("chmod +x %(CFG_INVENIO_PREFIX)s/bin/git-new-workdir" % env, user=env.CFG_INVENIO_USER)
-
     # OpenOffice temporary directory
     sudo_local("mkdir -p %(CFG_INVENIO_PREFIX)s/var/tmp/ooffice-tmp-files" % env, user=env.CFG_INVENIO_USER)
     sudo_local("sudo chown -R nobody %(CFG_INVENIO_PREFIX)s/var/tmp/ooffice-tmp-files" % env)
@@ -281,3 +318,255 @@ def venv_drop():
             sudo_local("sudo rm -Rf %(CFG_INVENIO_PREFIX)s" % env)
     else:
         puts(">>> Nothing to remove - %(CFG_INVENIO_PREFIX)s does not exists..." % env)
+
+
+#
+# Helpers
+#
+def venv_requirements_merge(reqpaths):
+    """
+    Merge requirement files into one deduplicated set.
+
+    Included requirement files (``-r``) are merged as well (see
+    :meth:`~venv_requirements_lines`). Requirements for the same project
+    (names normalised as in PEP 503) are combined into one line with all
+    version specifiers. Specifiers no version can satisfy (see
+    :meth:`~venv_specifiers_conflict`) abort the task. Options (e.g. ``-e``,
+    ``-c`` or ``--find-links``), URLs and lines with environment markers are
+    kept as they are, without duplicates. Order of first appearance is kept.
+
+    :return: Content of the merged requirements file.
+    """
+    order = []
+    specs = {}
+    sources = {}
+
+    for reqpath in reqpaths:
+        for line, path in venv_requirements_lines(reqpath):
+            m = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(\[[^\]]*\])?\s*([<>=!~].*)?$', line)
+            if not m:
+                # Options, URLs and markers
+                if line not in order:
+                    order.append(line)
+                continue
+
+            name = re.sub(r'[-_.]+', '-', m.group(1)).lower()
+            if name not in specs:
+                order.append(name)
+                specs[name] = [m.group(1) + (m.group(2) or ''), []]
+                sources[name] = []
+            for spec in (m.group(3) or '').replace(' ', '').split(','):
+                if spec and spec not in specs[name][1]:
+                    specs[name][1].append(spec)
+            sources[name].append("%s (%s)" % (line, os.path.basename(path)))
+
+    for name, (project, spec) in specs.items():
+        if venv_specifiers_conflict(spec):
+            abort(red("Conflicting requirements for %s: %s" % (name, ", ".join(sources[name]))))
+
+    lines = []
+    for x in order:
+        if x in specs:
+            lines.append(specs[x][0] + ",".join(specs[x][1]))
+        else:
+            lines.append(x)
+    return "\n".join(lines) + "\n"
+
+
+def venv_requirements_lines(reqpath, seen=None):
+    """
+    Read the requirement lines of a file, without comments and with the
+    requirement files it includes (``-r``) inlined. Relative paths of
+    included requirement and constraint (``-c``) files are resolved
+    relative to the file including them.
+
+    :return: List of ``(line, path)`` tuples, ``path`` being the file the
+        line comes from.
+    """
+    seen = seen if seen is not None else set()
+    seen.add(os.path.normpath(reqpath))
+
+    lines = []
+    for line in read_file(reqpath).splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+
+        m = re.match(r'^(--requirement|--constraint|-r|-c)[=\s]*(\S.*)$', line)
+        if m:
+            path = m.group(2)
+            if '://' not in path and not os.path.isabs(path):
+                path = os.path.join(os.path.dirname(reqpath), path)
+            if m.group(1) in ('-c', '--constraint'):
+                line = "-c %s" % path
+            elif os.path.normpath(path) not in seen:
+                lines.extend(venv_requirements_lines(path, seen))
+                continue
+            else:
+                continue
+        lines.append((line, reqpath))
+    return lines
+
+
+def venv_specifiers_conflict(spec):
+    """
+    Check if no version satisfies all the version specifiers of a
+    requirement (e.g. ``==1.0`` and ``==1.1``, or ``>=2.0`` and ``<1.5``).
+
+    Without ``pkg_resources`` only pinned versions (``==``) are compared.
+
+    :param spec: List of version specifiers, e.g. ``['>=1.0', '!=1.2']``.
+    """
+    if not pkg_resources:
+        return len(set([x[2:] for x in spec if x.startswith('==')])) > 1
+
+    def _next(version):
+        # First version after all versions starting with ``version``
+        parts = version.split('.')
+        parts[-1] = str(int(re.match(r'\d*', parts[-1]).group() or 0) + 1)
+        return '.'.join(parts)
+
+    # Tightest bounds, as (version, inclusive) tuples
+    low, high = None, None
+    excluded = []
+    for x in spec:
+        m = re.match(r'^(===|==|!=|~=|<=|>=|<|>)(.+)$', x)
+        if not m:
+            continue
+        op, version = m.groups()
+        bounds = []
+        if op in ('==', '===') and version.endswith('.*'):
+            bounds = [('>=', version[:-2]), ('<', _next(version[:-2]))]
+        elif op in ('==', '==='):
+            bounds = [('>=', version), ('<=', version)]
+        elif op == '~=':
+            bounds = [('>=', version), ('<', _next(version.rsplit('.', 1)[0]))]
+        elif op == '!=':
+            if not version.endswith('.*'):
+                excluded.append(pkg_resources.parse_version(version))
+        else:
+            bounds = [(op, version)]
+
+        for op, version in bounds:
+            bound = (pkg_resources.parse_version(version), '=' in op)
+            if op.startswith('>'):
+                if low is None or bound[0] > low[0] or (bound[0] == low[0] and not bound[1]):
+                    low = bound
+            elif high is None or bound[0] < high[0] or (bound[0] == high[0] and not bound[1]):
+                high = bound
+
+    if low is None or high is None:
+        return False
+    if low[0] == high[0]:
+        return not (low[1] and high[1]) or low[0] in excluded
+    return low[0] > high[0]
+
+
+def venv_pip_install(reqpath, upgrade=False):
+    """
+    Install a requirements file with pip.
+
+    With a wheelhouse, pip first tries to install only from the wheelhouse
+    (``--no-index``). If wheels are missing (or ``upgrade`` is set), they
+    are built with ``pip wheel`` into the wheelhouse and installed from it.
+    The ``wheel`` package needed to build them is only installed if missing,
+    from the wheelhouse if possible, and is itself added to the wheelhouse.
+    Wheelhouses of remote hosts are synchronised with the one on the
+    machine running fab (``env.CFG_WHEELHOUSE_CACHE``), so wheels built on
+    one host are reused by all others.
+    """
+    ctx = {
+        'reqpath': reqpath,
+        'upgrade': '--upgrade' if upgrade else '',
+        'wheelhouse': venv_wheelhouse(),
+    }
+    ctx.update(env)
+    activate = [env.ACTIVATE] if env.WITH_VIRTUALENV else []
+
+    if not ctx['wheelhouse']:
+        sudo_local(" && ".join(activate + ["pip install %(upgrade)s -r %(reqpath)s"]) % ctx, user=env.CFG_INVENIO_USER)
+        return
+
+    venv_wheelhouse_sync(ctx['wheelhouse'], upload=True)
+
+    install = " && ".join(activate + ["pip install %(upgrade)s --no-index --find-links=%(wheelhouse)s -r %(reqpath)s"]) % ctx
+    if not upgrade:
+        with settings(warn_only=True):
+            if not sudo_local(install, user=env.CFG_INVENIO_USER).failed:
+                return
+
+    puts(">>> Building missing wheels in %(wheelhouse)s ..." % ctx)
+    sudo_local(" && ".join(activate + [
+        "mkdir -p %(wheelhouse)s",
+        # Prefer an installed wheel package or one from the wheelhouse
+        "(python -c 'import wheel' 2>/dev/null || "
+        "pip install --no-index --find-links=%(wheelhouse)s wheel || pip install wheel)",
+        "(ls %(wheelhouse)s/wheel-*.whl >/dev/null 2>&1 || pip wheel --wheel-dir=%(wheelhouse)s wheel)",
+        "pip wheel %(upgrade)s --find-links=%(wheelhouse)s --wheel-dir=%(wheelhouse)s -r %(reqpath)s",
+    ]) % ctx, user=env.CFG_INVENIO_USER)
+    sudo_local(install, user=env.CFG_INVENIO_USER)
+
+    venv_wheelhouse_sync(ctx['wheelhouse'], upload=False)
+
+
+def venv_wheelhouse():
+    """
+    Wheelhouse directory for the Python version and platform of the
+    virtualenv, or ``None`` if ``env.CFG_WHEELHOUSE_DIR`` is not set.
+    """
+    if not env.CFG_WHEELHOUSE_DIR:
+        return None
+    cmds = [env.ACTIVATE % env] if env.WITH_VIRTUALENV else []
+    cmds.append("python -c \"import sys, sysconfig; "
+                "print('py%d%d-%s' % (sys.version_info[0], sys.version_info[1], sysconfig.get_platform()))\"")
+    with settings(hide('everything')):
+        tag = sudo_local(" && ".join(cmds), capture=True, user=env.CFG_INVENIO_USER).strip()
+    return os.path.join(env.CFG_WHEELHOUSE_DIR, tag)
+
+
+def venv_wheelhouse_sync(wheelhouse, upload=True):
+    """
+    Upload wheels from the wheelhouse on the machine running fab to the
+    host, or download wheels built on the host. Nothing is done for a local
+    host, which uses ``env.CFG_WHEELHOUSE_DIR`` directly.
+    """
+    if is_local():
+        return
+
+    cache = os.path.join(os.path.expanduser(env.CFG_WHEELHOUSE_CACHE), os.path.basename(wheelhouse))
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+    local_wheels = set([f for f in os.listdir(cache) if f.endswith('.whl')])
+
+    with settings(hide('everything'), warn_only=True):
+        output = sudo_local("ls -1 %s" % wheelhouse, capture=True, user=env.CFG_INVENIO_USER)
+    remote_wheels = set([f for f in output.split() if f.endswith('.whl')]) if not output.failed else set()
+
+    if upload:
+        missing = sorted(local_wheels - remote_wheels)
+        if missing:
+            puts(">>> Uploading %s wheels to %s ..." % (len(missing), wheelhouse))
+            sudo_local("mkdir -p %s" % wheelhouse, user=env.CFG_INVENIO_USER)
+            for f in missing:
+                put(os.path.join(cache, f), os.path.join(wheelhouse, f), use_sudo=True, mode=0644)
+    else:
+        missing = sorted(remote_wheels - local_wheels)
+        if missing:
+            puts(">>> Downloading %s new wheels from %s ..." % (len(missing), wheelhouse))
+            for f in missing:
+                get(os.path.join(wheelhouse, f), os.path.join(cache, f))
+
+
+def venv_archives(ctx):
+    """
+    Find existing virtualenv archives (for any of the compression codecs),
+    newest first.
+    """
+    exts = sorted(set([c['ext'] for c in CODECS.values()]))
+    archives = ["%s/%s.tar%s" % (ctx['dirname'], ctx['basename'], ext) for ext in exts]
+    archives = [f for f in archives if exists_local(f)]
+    if len(archives) > 1:
+        with settings(hide('everything')):
+            archives = sudo_local("ls -1t %s" % " ".join(archives), capture=True,
+                                  user=env.CFG_INVENIO_USER).split()
+    return archives